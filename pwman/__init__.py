@@ -23,14 +23,9 @@ import os
 import re
 import string
 import shutil
-import ssl
 import sys
-import urllib.request
-
-from importlib.metadata import PackageNotFoundError, version, distribution
 
 from pwman.util import config
-from pwman.data.factory import check_db_version
 
 try:
     import cryptography  # noqa
@@ -43,14 +38,20 @@ appname = "pwman3"
 website = 'http://pwman3.github.io/pwman3/'
 
 try:
-    version = version('pwman3')
-except PackageNotFoundError:
-    version = '0.12.2'
+    # written by setuptools_scm, reading it is faster than the metadata
+    from pwman._version import version
+except ImportError:  # pragma: no cover
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        version = version('pwman3')
+    except PackageNotFoundError:
+        version = '0.12.2'
 
 
 class PkgMetadata(object):
 
     def __init__(self):
+        from importlib.metadata import distribution
         d = distribution("pwman3")
         self.summary = d.metadata.get("summary")
         self.author_email = d.metadata.get("author-email")
@@ -58,15 +59,21 @@ class PkgMetadata(object):
         self.home_page = d.metadata.get("project-url").split(", ")[-1]
 
 
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    Read the description from the package metadata only when the help
+    is shown, and not on every run.
+    """
 
+    def format_help(self):
+        if self.description is None:
+            self.description = PkgMetadata().summary
+        return super(ArgumentParser, self).format_help()
 
-def parser_options(formatter_class=argparse.HelpFormatter):  # pragma: no cover
-    pkg_meta = PkgMetadata()
-    description = pkg_meta.summary
 
-    parser = argparse.ArgumentParser(prog='pwman3',
-                                     description=description,
-                                     formatter_class=formatter_class)
+def parser_options(formatter_class=argparse.HelpFormatter):  # pragma: no cover
+    parser = ArgumentParser(prog='pwman3',
+                            formatter_class=formatter_class)
     parser.add_argument('-c', '--config', dest='cfile',
                         default=os.path.join(
                                              config.find_config_dir(
@@ -75,7 +82,11 @@ def parser_options(formatter_class=argparse.HelpFormatter):  # pragma: no cover
     parser.add_argument('-d', '--database', dest='dbase')
     parser.add_argument('-i', '--import', nargs=2, dest='file_delim',
                         help="Specify the file name and the delimeter type")
-    subparsers = parser.add_subparsers(help='commands', dest="cmd")
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=1000,
+                        help="number of rows imported in each transaction")
+    subparsers = parser.add_subparsers(help='commands', dest="cmd",
+                                       parser_class=argparse.ArgumentParser)
 
     printer = subparsers.add_parser('p', help='print password entry')
     printer.add_argument("node", type=int)
@@ -83,6 +94,28 @@ def parser_options(formatter_class=argparse.HelpFormatter):  # pragma: no cover
     copy = subparsers.add_parser('cp', help='copy password entry to clipboard')
     copy.add_argument("node", type=str)
 
+    subparsers.add_parser('convert',
+                          help='store every node as a single encrypted record')
+
+    subparsers.add_parser('agent', help='keep the database unlocked for `p` '
+                          'and `cp`, until lock_timeout')
+
+    migrate = subparsers.add_parser('migrate', help='copy the nodes to '
+                                    'another database, of any driver')
+    migrate.add_argument("--from", dest="source", type=str,
+                         help="URI of the database to copy, by default "
+                         "the configured one")
+    migrate.add_argument("--to", dest="target", type=str, required=True,
+                         help="URI of the database to copy to")
+
+    backup = subparsers.add_parser('backup', help='write the encrypted '
+                                   'nodes to a binary backup file')
+    backup.add_argument("file", type=str)
+
+    restore = subparsers.add_parser('restore', help='add the nodes of a '
+                                    'backup file to the database')
+    restore.add_argument("file", type=str)
+
     version = subparsers.add_parser('version', help='version')
     version.add_argument("--latest", action='store_true')
     return parser
@@ -131,6 +164,7 @@ def get_conf_options(args, OSX):
 
 
 def get_db_version(config, args):
+    from pwman.data.factory import check_db_version
     dburi = check_db_version(config.get_value("Database", "dburi"))
     return dburi
 
@@ -144,24 +178,111 @@ def calculate_client_info():  # pragma: no cover
     return hashinfo
 
 
-def is_latest_version(version, client_info):  # pragma: no cover
-    """check current version againt latest version"""
+# seconds until the cached result of a version check is stale
+VERSION_CHECK_TTL = 24 * 3600
+
+
+def parse_version(version):
+    """return the release numbers of a version as a tuple, '0.13.1' or
+    '0.13.1.dev3+g1234' give (0, 13, 1)"""
+    match = re.match(r'\d+(\.\d+)*', version.strip())
+    if not match:
+        return ()
+    return tuple(int(i) for i in match.group().split('.'))
+
+
+def version_cache_file():
+    cache_home = os.getenv('XDG_CACHE_HOME') or config.XDG_CACHE_HOME
+    return os.path.join(cache_home, 'pwman', 'version.json')
+
+
+def read_version_cache(ttl=VERSION_CHECK_TTL):
+    """
+    return the latest version found by the last check, '' if that check
+    failed, or None if there was no check during the last ttl seconds
+    """
+    import json
+    import time
     try:
-        hostname = os.getenv("PWMAN_HOSTNAME", "pwman.tiram.it")
-        url = (f"https://{hostname}/is_latest/?"
-               f"current_version={version}&os={sys.platform}&hash={client_info}")
+        with open(version_cache_file()) as f:
+            cache = json.load(f)
+        if time.time() - cache['checked'] < ttl:
+            return cache['latest'] or ''
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_version_cache(latest):
+    import json
+    import time
+    path = version_cache_file()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'checked': time.time(), 'latest': latest}, f)
+        os.replace(path + '.tmp', path)
+    except OSError:  # pragma: no cover
+        pass
+
+
+def fetch_latest_version(version, client_info, timeout=0.5):
+    """ask the pwman3 server for the latest version"""
+    import ssl
+    import urllib.request
+    hostname = os.getenv("PWMAN_HOSTNAME", "pwman.tiram.it")
+    url = os.getenv("PWMAN_UPDATE_URL", f"https://{hostname}/is_latest/")
+    url += (f"?current_version={version}&os={sys.platform}"
+            f"&hash={client_info}")
+    ctx = None
+    if os.getenv("TEST") == '1':
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    if not url.startswith('https'):
         ctx = None
-        if os.getenv("TEST") == '1':
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
 
-        res = urllib.request.urlopen(url, timeout=0.5, context=ctx)
-        data = res.read()  # This will return entire content.
+    res = urllib.request.urlopen(url, timeout=timeout, context=ctx)
+    data = res.read()  # This will return entire content.
+    if res.status != 200:
+        raise ValueError("unexpected response %d" % res.status)
+    return data.decode().strip()
 
-        if res.status != 200:
-            return None, True
-        if parse_version(data.decode()) > parse_version(version):
+
+def update_version_cache(version, client_info):
+    """fetch the latest version and cache it, a failure is cached too"""
+    try:
+        latest = fetch_latest_version(version, client_info)
+    except Exception:
+        latest = ''
+    write_version_cache(latest)
+    return latest
+
+
+def start_version_check(version, client_info, ttl=VERSION_CHECK_TTL):
+    """
+    Return whether version is the latest one, as known from the cache.
+    If the cache is stale, it is refreshed by a background thread, so
+    this never waits for the network. The thread is returned too, it
+    is None if the cache is fresh.
+    """
+    import threading
+    latest = read_version_cache(ttl)
+    thread = None
+    if latest is None:
+        thread = threading.Thread(target=update_version_cache,
+                                  args=(version, client_info), daemon=True)
+        thread.start()
+    return not latest or parse_version(latest) <= parse_version(version), \
+        thread
+
+
+def is_latest_version(version, client_info):  # pragma: no cover
+    """check current version againt latest version"""
+    try:
+        latest = fetch_latest_version(version, client_info)
+        write_version_cache(latest)
+        if parse_version(latest) > parse_version(version):
             return None, False
         else:
             return None, True
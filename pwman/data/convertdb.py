@@ -16,110 +16,141 @@
 # ============================================================================
 # Copyright (C) 2020 Oz N Tiram <oz.tiram@gmail.com>
 # ============================================================================
-from __future__ import print_function
-import os
-import shutil
-import time
+import hashlib
+from itertools import islice
+
 from pwman.util.crypto_engine import CryptoEngine
-import pwman.data.factory
-from pwman.util.callback import CLICallback
-import sqlite3 as sqlite
+from pwman.data.nodes import Node
+from pwman.ui.tools import CLICallback
 
-_NEWVERSION = 0.4
 
+class MigrationError(Exception):
+    pass
 
-class DBConverter(object):
-    """
-    A general class to provide a base template for converting a database
-    from one version to another
-    """
-    def __init__(self, args, config):
-        self.dbname = config.get_value('Database', 'filename')
-        self.dbtype = config.get_value("Database", "type")
-        if not args.output:
-            self.newdb_name = self.dbname
-        else:
-            self.newdb_name = '.new-%s'.join(os.path.splitext(self.dbname))
-
-    @staticmethod
-    def detect_db_version(filename):
-        """
-        This method should accept a pwman db file name, and it should try to
-        detect which database version it is.
-        """
-        con = sqlite.connect(filename)
-        cur = con.cursor()
-        cur.execute("SELECT DBVERSION FROM DBVERSION")
-        row = cur.fetchone()
-        if not row:
-            return "0.3"
-        else:
-            return row[0]
-
-    @staticmethod
-    def invoke_converter(dbversion, future_version):
-        """
-        this method should accept the two parameters and according to them
-        invoke the right converter
-        """
-        pass
-
-    def backup_old_db(self):
-        print("Will convert the following Database: %s " % self.dbname)
-        backup = '.backup-%s'.join(os.path.splitext(self.dbname)) % \
-            time.strftime(
-                '%Y-%m-%d-%H:%M')
-        shutil.copy(self.dbname, backup)
-        print("backup created in ", backup)
-
-    def read_old_db(self):
-        raise Exception("This methodod should be overriden")
-
-    def create_new_db(self, new_version=_NEWVERSION):
-        if os.path.exists(self.newdb_name):
-            os.remove(self.newdb_name)
-
-        self.newdb = pwman.data.factory.create(self.dbtype, new_version,
-                                               self.newdb_name)
-        self.newdb._open()
-
-    def convert_nodes(self):
-        raise Exception("This methodod should be overriden")
-
-    def save_new_nodes_to_db(self):
-        self.newdb.addnodes(self.NewNodes)
-        self.newdb._commit()
-
-    def save_old_key(self):
-        raise Exception("This methodod should be overriden")
-
-    def print_success(self):
-        print("pwman successfully converted the old database to the new "
-              "format.\nPlease run `pwman3 -d %s` to make sure your password "
-              "and data are still correct. If you found errors, please "
-              "report a bug in Pwman homepage in github. " % self.newdb_name)
 
-    def run(self):
-        self.backup_old_db()
-        self.read_old_db()
-        self.create_new_db()
-        self.convert_nodes()
-        self.save_new_nodes_to_db()
-        self.save_old_key()
-        self.print_success()
+def _bytes(value):
+    return value.encode() if isinstance(value, str) else bytes(value)
 
 
-class PwmanConvertKey(DBConverter):
+def _str(key):
+    if key is None or isinstance(key, str):
+        return key
+    return bytes(key).decode()
 
-    def read_old_db(self):
+
+def checksum(entries):
+    """
+    return the number of nodes, the number of tags and a digest of the
+    (fields, tags) pairs of Database.dump_nodes. It only depends on the
+    cipher texts and their order, not on the driver or the ids.
+    """
+    digest, nodes, tags = hashlib.sha256(), 0, set()
+    for fields, node_tags in entries:
+        for value in list(fields) + sorted(
+                b'%s:%s' % (idx.encode(), _bytes(tag))
+                for tag, idx in node_tags):
+            value = _bytes(value)
+            digest.update(b'%d:%s' % (len(value), value))
+        digest.update(b'.')
+        tags.update(idx for _, idx in node_tags)
+        nodes += 1
+    return nodes, len(tags), digest.hexdigest()
+
+
+class DBMigrator(object):
+    """
+    Copy the key and the nodes of one database to another, which can use
+    another driver. The cipher texts are copied as they are, in batches,
+    so nothing is decrypted and the memory used does not grow with the
+    database.
+
+    The target must be empty, or hold the nodes copied by an interrupted
+    migration from the same source. Those are checked and skipped, and
+    the migration goes on from there.
+    """
+    def __init__(self, source, target, batch_size=1000):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+
+    def copy_key(self):
+        key, target_key = (_str(self.source.loadkey()),
+                           _str(self.target.loadkey()))
+        if target_key is None:
+            if key is not None:
+                self.target.savekey(key)
+        elif target_key != key:
+            raise MigrationError("The target database has another master "
+                                 "password")
+
+    def copy_nodes(self):
+        """copy the nodes the target does not have, return how many"""
+        done = checksum(self.target.dump_nodes())
+        entries = iter(self.source.dump_nodes())
+        if done[0] and checksum(islice(entries, done[0])) != done:
+            raise MigrationError("The target database has other nodes than "
+                                 "the source")
+        if done[0]:
+            print("Resuming after {} nodes".format(done[0]))
+        return self.target.load_nodes(entries, self.batch_size)
+
+    def verify(self):
+        """compare the nodes of source and target, return their checksum"""
+        expected = checksum(self.source.dump_nodes())
+        found = checksum(self.target.dump_nodes())
+        if expected != found:
+            raise MigrationError(
+                "The target has {} nodes and {} tags, expected {} and {}, "
+                "or their cipher texts differ".format(
+                    found[0], found[1], expected[0], expected[1]))
+        return expected
+
+    def run(self):
+        # both are brought to the current format before they are read,
+        # the source last, so its key is the one the engine is left with
+        self.target._open_migrated()
+        self.source._open_migrated()
+        try:
+            self.copy_key()
+            copied = self.copy_nodes()
+            nodes, tags, digest = self.verify()
+        finally:
+            self.source.close()
+            self.target.close()
+        print("Copied {} nodes, the target has {} nodes and {} tags "
+              "(sha256 {})".format(copied, nodes, tags, digest))
+        return copied
+
+
+class RecordConverter(object):
+    """
+    Rewrite the nodes of a database so that the fields of each node are
+    encrypted as a single record. Nodes which are already records are
+    left alone, as are the tags of all nodes.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def convert_node(self, nid, node):
+        record = Node(clear_text=True, record=True,
+                      username=node.username, password=node.password,
+                      url=node.url, notes=node.notes, tags=[])
+        self.db.editnode(nid, username=record._username,
+                         password=record._password, url=record._url,
+                         notes=record._notes)
+
+    def run(self, callback=CLICallback):
         enc = CryptoEngine.get()
-        enc.callback = CLICallback()
+        enc.callback = callback()
         self.db.open()
-        self.oldnodes = self.db.listnodes()
-        self.oldnodes = self.db.getnodes(self.oldnodes)
-
-    def save_old_key(self):
-        CryptoEngine._instance = None
-        enc = CryptoEngine.get(0.5)
-        self.oldkey = enc.get_salt_digest()
-        self.newdb.savekey(self.oldkey)
+
+        converted = 0
+        with self.db.transaction():
+            for row, tags in self.db.getnodes(self.db.lazy_list_node_ids()):
+                node = Node.from_encrypted_entries(*row[1:5], tags)
+                if not node.is_record:
+                    self.convert_node(row[0], node)
+                    converted += 1
+
+        print("Converted {} nodes to the record format".format(converted))
+        self.db.close()
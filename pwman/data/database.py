@@ -19,9 +19,15 @@
 # Copyright (C) 2006 Ivan Kelly <ivan@ivankelly.net>
 # ============================================================================
 
+from contextlib import contextmanager
+from itertools import islice
+
+from pwman.data.nodes import Node
+from pwman.data.search import SearchIndex
+from pwman.data import tagfilter
 from pwman.util.crypto_engine import CryptoEngine
 
-__DB_FORMAT__ = 0.6
+__DB_FORMAT__ = 0.9
 
 
 class DatabaseException(Exception):
@@ -30,6 +36,54 @@ class DatabaseException(Exception):
 
 class Database(object):
 
+    # number of ids sent to the server in each IN (...) clause
+    fetch_size = 500
+
+    # number of rows read at a time from a streaming cursor
+    stream_size = 1000
+
+    # schema migrations, as pairs of the version a migration upgrades
+    # to and the name of the method which does it, oldest first
+    _migrations = [(0.7, '_add_tag_blind_index'),
+                   (0.8, '_add_lookup_indexes'),
+                   (0.9, '_add_crypto_kdf')]
+
+    # if True, factory.createdb checks the version on a connection of
+    # the connect class method and hands it to _open as _handover, so a
+    # remote server is connected only once
+    reuse_connection = False
+    _handover = None
+
+    # the depth of nested transaction scopes, and whether one of the
+    # inner scopes failed
+    _tx_depth = 0
+    _tx_failed = False
+
+    # the column type of the encrypted search index
+    longtext = "TEXT"
+
+    # the decrypted search index, once search_index loaded it, and
+    # whether the current transaction changed it
+    _search = None
+    _search_dirty = False
+
+    # the clear text of the tags by their id, and their ids by blind
+    # index, once _load_tags filled them
+    _tags = None
+    _tag_ids = None
+
+    # the ids of tags which lost a node, and may be orphans now
+    _dirty_tags = frozenset()
+
+    @classmethod
+    def connect(cls, dburi):  # pragma: no cover
+        """open a connection, dburi is what check_db_version takes"""
+        raise NotImplementedError
+
+    def _take_handover(self):
+        con, self._handover = self._handover, None
+        return con
+
     def open(self, dbver=None):
         """
         Open the database, by calling the _open method of the
@@ -39,13 +93,156 @@ class Database(object):
         enc = CryptoEngine.get()
         key = self.loadkey()
         """
+        if self._open_migrated() is None:
+            self.get_user_password()
+        elif CryptoEngine.get().needs_upgrade():
+            self._upgrade_key()
+
+    def _open_migrated(self):
+        """
+        Open the database and bring it to the current format, and return
+        its key. The password is only asked for if a migration needs it,
+        so this serves commands which copy the cipher texts as they are.
+        """
         self._open()
-        enc = CryptoEngine.get()
         key = self.loadkey()
         if key is not None:
-            enc.set_salt_digest(key)
-        else:
-            self.get_user_password()
+            CryptoEngine.get().set_salt_digest(key)
+            self._migrate()
+        return key
+
+    def _upgrade_key(self):
+        """
+        Move a database whose data is encrypted with the key of the
+        password to a random data key wrapped with it. The old key can
+        be read from the digest stored with it, so every node is
+        re-encrypted, once.
+        """
+        print("Moving the database to a random data key, this is done "
+              "only once")
+        enc = CryptoEngine.get()
+        recrypter = enc.rekey(self.pending_key())
+        self.reencrypt(recrypter)
+        enc.switch_key(recrypter)
+
+    @contextmanager
+    def transaction(self):
+        """
+        A unit of work::
+
+            with db.transaction():
+                db.removenodes([1])
+                db.removenodes([2])
+
+        Nested scopes join the outermost one, which commits when it
+        ends, or rolls back if an exception leaves it. If an exception
+        leaves an inner scope, the outermost one rolls back even if the
+        exception was handled in between.
+        """
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if self._tx_depth:
+                self._tx_failed = True
+            else:
+                self._tx_failed = False
+                self._rollback()
+            raise
+        self._tx_depth -= 1
+        if not self._tx_depth:
+            if self._tx_failed:
+                self._tx_failed = False
+                self._rollback()
+                raise DatabaseException("The transaction was rolled back, "
+                                        "because a part of it failed")
+            try:
+                self._flush_search_index()
+            except BaseException:
+                self._rollback()
+                raise
+            self._commit()
+
+    def _commit(self):
+        self._con.commit()
+
+    def _rollback(self):
+        # the caches may hold changes which are rolled back
+        self.clear_cache()
+        self._search_dirty = False
+        self._con.rollback()
+
+    def clear_cache(self):
+        """
+        drop the decrypted tags and search index. The CryptoEngine calls
+        this when it forgets the key or the lock times out.
+        """
+        self._tags = self._tag_ids = None
+        self._search = None
+
+    def _get_dbversion(self):
+        self._cur.execute("SELECT VERSION FROM DBVERSION")
+        return float(self._cur.fetchone()[0])
+
+    def _set_dbversion(self, version):
+        self._cur.execute("UPDATE DBVERSION SET VERSION = {}".format(
+            self._sub), (str(version),))
+
+    def _migrate(self):
+        """
+        Upgrade an existing database to the current format, by running
+        each migration newer than the version found in DBVERSION.
+        Every migration is committed together with its version.
+        """
+        current = self._get_dbversion()
+        for version, migration in self._migrations:
+            if current < version:
+                with self.transaction():
+                    getattr(self, migration)()
+                    self._set_dbversion(version)
+                current = version
+
+    def _add_tag_blind_index(self):
+        """
+        Add the BLINDIDX column to TAG and fill it. Every tag is decrypted
+        once here, so later lookups do not need to decrypt anything.
+        """
+        self._cur.execute("ALTER TABLE TAG ADD COLUMN BLINDIDX VARCHAR(64)")
+        self._cur.execute("SELECT ID, DATA FROM TAG")
+        tags = self._cur.fetchall()
+        sql = "UPDATE TAG SET BLINDIDX = {} WHERE ID = {}".format(
+            self._sub, self._sub)
+        for tid, cipher in tags:
+            if isinstance(cipher, memoryview):
+                cipher = cipher.tobytes()
+            self._cur.execute(sql, (self._tag_index(cipher), tid))
+        self._cur.execute("CREATE INDEX TAG_BLINDIDX ON TAG(BLINDIDX)")
+
+    def _add_lookup_indexes(self):
+        """
+        Remove duplicate rows from LOOKUP and index it. The unique index
+        on (nodeid, tagid) also serves the lookups by nodeid.
+        """
+        self._cur.execute("CREATE TABLE LOOKUP_DEDUP AS "
+                          "SELECT DISTINCT nodeid, tagid FROM LOOKUP")
+        self._cur.execute("DELETE FROM LOOKUP")
+        self._cur.execute("INSERT INTO LOOKUP(nodeid, tagid) "
+                          "SELECT nodeid, tagid FROM LOOKUP_DEDUP")
+        self._cur.execute("DROP TABLE LOOKUP_DEDUP")
+        self._create_lookup_indexes()
+
+    def _add_crypto_kdf(self):
+        """
+        Add the KDF column to CRYPTO. It stays empty for existing
+        databases, which use the legacy key derivation parameters.
+        """
+        self._cur.execute("ALTER TABLE CRYPTO ADD COLUMN KDF TEXT")
+
+    def _create_lookup_indexes(self):
+        self._cur.execute("CREATE UNIQUE INDEX LOOKUP_NODE_TAG "
+                          "ON LOOKUP(nodeid, tagid)")
+        self._cur.execute("CREATE INDEX LOOKUP_TAG ON LOOKUP(tagid)")
 
     def _check_tables(self):
         try:
@@ -71,44 +268,45 @@ class Database(object):
                           "URL TEXT NOT NULL, "
                           "NOTES TEXT NOT NULL"
                           ")")
-        self._con.commit()
 
     def _create_tag_table(self):
         self._cur.execute("CREATE TABLE TAG"
                           f"(ID  {self.integer} PRIMARY KEY {self.autoincr},"  # noqa
-                          "DATA TEXT NOT NULL)")
-        self._con.commit()
+                          "DATA TEXT NOT NULL, "
+                          "BLINDIDX VARCHAR(64))")
+        self._cur.execute("CREATE INDEX TAG_BLINDIDX ON TAG(BLINDIDX)")
 
     def _create_lookup_table(self):
         self._cur.execute("CREATE TABLE LOOKUP ("
                           "nodeid INTEGER NOT NULL REFERENCES NODE(ID),"
                           "tagid INTEGER NOT NULL REFERENCES TAG(ID)"
                           ")")
-        self._con.commit()
+        self._create_lookup_indexes()
 
     def _create_crypto_table(self):
         self._cur.execute("CREATE TABLE CRYPTO "
-                          "(SEED TEXT, DIGEST TEXT)")
+                          "(SEED TEXT, DIGEST TEXT, KDF TEXT)")
 
     def _create_dbversion_table(self):
         self._cur.execute("CREATE TABLE DBVERSION (VERSION TEXT NOT NULL)")
         self._cur.execute("INSERT INTO DBVERSION (VERSION) VALUES('%s')" %
                           self.dbversion)
-        self._con.commit()
+
+    def _create_search_table(self):
+        # the search index can be rebuilt from the nodes at any time, so
+        # it is created when missing instead of by a migration
+        self._cur.execute("CREATE TABLE IF NOT EXISTS SEARCHINDEX "
+                          "(DATA {})".format(self.longtext))
 
     def _create_tables(self):
-        if self._check_tables():
-            return
-        try:
-            self._create_node_table()
-            self._create_tag_table()
-            self._create_lookup_table()
-            self._create_crypto_table()
-            self._create_dbversion_table()
-            self._con.commit()
-        except Exception as e:  # pragma: no cover
-            self._con.rollback()
-            raise e
+        with self.transaction():
+            if not self._check_tables():
+                self._create_node_table()
+                self._create_tag_table()
+                self._create_lookup_table()
+                self._create_crypto_table()
+                self._create_dbversion_table()
+            self._create_search_table()
 
     def get_user_password(self):
         """
@@ -118,76 +316,286 @@ class Database(object):
         newkey = enc.changepassword()
         return self.savekey(newkey)
 
-    def _clean_orphans(self):
+    def _clean_orphans(self, tagids=None):
+        """
+        Delete the tags which no node uses, and return how many were
+        deleted. If tagids is given only those tags are checked,
+        otherwise the whole TAG table is.
+        """
         clean = ("delete from TAG where not exists "
                  "(select 'x' from LOOKUP l where l.TAGID = TAG.ID)")
-        self._cur.execute(clean)
-        self._con.commit()
-
-    def _get_node_tags(self, node):
-        sql = "SELECT tagid FROM LOOKUP WHERE NODEID = {}".format(self._sub)
-        self._cur.execute(sql, (str(node[0]),))
-        tagids = self._cur.fetchall()
-        if tagids:
-            sql = ("SELECT DATA FROM TAG WHERE ID IN"
-                   " ({})".format(','.join([self._sub]*len(tagids))))
-            tagids = [str(id[0]) for id in tagids]
-            self._cur.execute(sql, (tagids))
-            tags = self._cur.fetchall()
-            for t in tags:
-                yield t[0]
+        deleted = 0
+        with self.transaction():
+            if tagids is None:
+                self._cur.execute(clean)
+                deleted = self._cur.rowcount
+            else:
+                tagids = list(tagids)
+                for i in range(0, len(tagids), self.fetch_size):
+                    batch = tagids[i:i + self.fetch_size]
+                    self._cur.execute(clean + " and ID in ({})".format(
+                        ','.join([self._sub] * len(batch))), batch)
+                    deleted += self._cur.rowcount
+            if deleted and self._tags is not None:
+                self._uncache_deleted_tags(
+                    list(self._tags) if tagids is None else tagids)
+        return deleted
+
+    def _uncache_deleted_tags(self, tagids):
+        """drop the tags of tagids, which are not in TAG, from the cache"""
+        kept = set()
+        for i in range(0, len(tagids), self.fetch_size):
+            batch = tagids[i:i + self.fetch_size]
+            self._cur.execute("SELECT ID FROM TAG WHERE ID IN ({})".format(
+                ','.join([self._sub] * len(batch))), batch)
+            kept.update(row[0] for row in self._cur.fetchall())
+        for tagid in set(tagids) - kept:
+            self._tags.pop(tagid, None)
+        self._tag_ids = {idx: tid for idx, tid in self._tag_ids.items()
+                         if tid in self._tags}
+
+    def _mark_dirty_tags(self, nid):
+        """remember the tags of node nid, before it loses them"""
+        self._cur.execute("SELECT TAGID FROM LOOKUP WHERE NODEID = {}".format(
+            self._sub), nid)
+        self._dirty_tags = self._dirty_tags.union(
+            row[0] for row in self._cur.fetchall())
+
+    def vacuum(self):
+        """
+        delete all the tags which no node uses, and return how many
+        were deleted
+        """
+        deleted = self._clean_orphans()
+        self._dirty_tags = frozenset()
+        return deleted
 
     def _setnodetags(self, nodeid, tags):
-        for tag in tags:
-            tid = self._get_or_create_tag(tag)
-            self._update_tag_lookup(nodeid, tid)
+        tagids = self._get_or_create_tags(tags)
+        self._insert_lookup(self._lookup_rows(nodeid, tags, tagids))
 
-    def _get_tag(self, tagcipher):
-        sql_search = "SELECT * FROM TAG"
-        self._cur.execute(sql_search)
-        ce = CryptoEngine.get()
+    def _lookup_rows(self, nodeid, tags, tagids):
+        """return the LOOKUP rows of a node, without duplicates"""
+        return [(nodeid, tid) for tid in
+                dict.fromkeys(tagids[tag] for tag in tags)]
 
+    def _insert_lookup(self, rows):
+        sql_lookup = "INSERT INTO LOOKUP(nodeid, tagid) VALUES({}, {})".format(
+            self._sub, self._sub)
+        self._cur.executemany(sql_lookup, rows)
+
+    def _tag_text(self, tagcipher):
+        """the clear text of a tag, tags which are not encrypted are kept"""
         try:
-            tag = ce.decrypt(tagcipher)
-            encrypted = True
+            return CryptoEngine.get().decrypt(tagcipher)
         except Exception:
-            tag = tagcipher
-            encrypted = False
+            return tagcipher
+
+    def _tag_index(self, tagcipher):
+        """
+        Return the blind index of a tag. Tags which are not encrypted
+        are indexed as they are.
+        """
+        return CryptoEngine.get().blind_index(self._tag_text(tagcipher))
 
-        rv = self._cur.fetchall()
-        for idx, cipher in rv:
-            if encrypted and tag == ce.decrypt(cipher):
-                return idx
-            elif tag == cipher:
-                return idx
+    def _load_tags(self):
+        """
+        return the clear text of all tags by their id. They are
+        decrypted once, and kept until the CryptoEngine forgets the key.
+        """
+        if self._tags is None:
+            self._cur.execute("SELECT ID, DATA, BLINDIDX FROM TAG")
+            rows = self._cur.fetchall()
+            enc = CryptoEngine.get()
+            ciphers = [self._value(row[1]) for row in rows]
+            try:
+                texts = enc.decrypt_many(ciphers)
+            except Exception:
+                texts = [self._tag_text(cipher) for cipher in ciphers]
+            self._tags = {row[0]: text for row, text in zip(rows, texts)}
+            self._tag_ids = {row[2]: row[0] for row in rows}
+            enc.register_cache(self)
+        return self._tags
+
+    def _cache_tag(self, tagid, blindidx, text):
+        if self._tags is not None:
+            self._tags[tagid] = text
+            self._tag_ids[blindidx] = tagid
+
+    def tag_names(self):
+        """return the sorted clear text names of the tags in use"""
+        tags = self._load_tags()
+        self._cur.execute("SELECT DISTINCT TAGID FROM LOOKUP")
+        ids = {row[0] for row in self._cur.fetchall()}
+        if not ids.issubset(tags):
+            # tags were created by another client
+            self._tags = None
+            tags = self._load_tags()
+        return sorted(tags[tid].decode() for tid in ids if tid in tags)
+
+    def _get_tag_by_index(self, blindidx):
+        if self._tag_ids and blindidx in self._tag_ids:
+            return self._tag_ids[blindidx]
+        sql_search = "SELECT ID FROM TAG WHERE BLINDIDX = {}".format(
+            self._sub)
+        self._cur.execute(sql_search, (blindidx,))
+        rv = self._cur.fetchone()
+        if rv:
+            return rv[0]
+
+    def _get_tag(self, tagcipher):
+        return self._get_tag_by_index(self._tag_index(tagcipher))
 
     def _get_or_create_tag(self, tagcipher):
-        rv = self._get_tag(tagcipher)
+        text = self._tag_text(tagcipher)
+        blindidx = CryptoEngine.get().blind_index(text)
+        rv = self._get_tag_by_index(blindidx)
         if rv:
             return rv
         else:
-            self._cur.execute(self._insert_tag_sql, list(map(self._data_wrapper, (tagcipher,))))  # noqa
+            self._cur.execute(self._insert_tag_sql,
+                              (self._data_wrapper(tagcipher), blindidx))
             try:
-                return self._cur.fetchone()[0]
+                tagid = self._cur.fetchone()[0]
             except TypeError:
-                return self._cur.lastrowid
-
-    def _update_tag_lookup(self, nodeid, tid):
-        sql_lookup = "INSERT INTO LOOKUP(nodeid, tagid) VALUES({}, {})".format(
-            self._sub, self._sub)
-        self._cur.execute(sql_lookup, (nodeid, tid))
-        self._con.commit()
+                tagid = self._cur.lastrowid
+            self._cache_tag(tagid, blindidx, text)
+            return tagid
+
+    def _get_tags_by_index(self, blindidxs):
+        """return a dict mapping each blind index found in TAG to its id"""
+        cached = self._tag_ids or {}
+        found = {idx: cached[idx] for idx in blindidxs if idx in cached}
+        blindidxs = [idx for idx in blindidxs if idx not in found]
+        for i in range(0, len(blindidxs), self.fetch_size):
+            batch = blindidxs[i:i + self.fetch_size]
+            sql = "SELECT BLINDIDX, ID FROM TAG WHERE BLINDIDX IN ({})".format(
+                ','.join([self._sub] * len(batch)))
+            self._cur.execute(sql, batch)
+            found.update(self._cur.fetchall())
+        return found
+
+    def _get_or_create_tags(self, tagciphers):
+        """
+        return a dict mapping each of the tag cipher texts to the id of
+        its tag. Missing tags are created with a single executemany.
+        """
+        enc = CryptoEngine.get()
+        texts = {t: self._tag_text(t) for t in dict.fromkeys(tagciphers)}
+        index = {t: enc.blind_index(text) for t, text in texts.items()}
+        tagids = self._get_tags_by_index(dict.fromkeys(index.values()))
+        missing = {idx: t for t, idx in index.items() if idx not in tagids}
+        if missing:
+            sql = "INSERT INTO TAG(DATA, BLINDIDX) VALUES({}, {})".format(
+                self._sub, self._sub)
+            self._cur.executemany(sql, [(self._data_wrapper(t), idx)
+                                        for idx, t in missing.items()])
+            created = self._get_tags_by_index(missing)
+            for idx, tagid in created.items():
+                self._cache_tag(tagid, idx, texts[missing[idx]])
+            tagids.update(created)
+        return {t: tagids[idx] for t, idx in index.items()}
+
+    def _value(self, value):
+        """convert a value read from the database to what nodes expect"""
+        return value if value else b''
+
+    def _get_nodes_batch(self, ids, blindidx=False):
+        """
+        return the rows of the nodes with the given ids and the cipher
+        texts of their tags, using one query for each. With blindidx
+        each tag is a pair of its cipher text and blind index.
+        """
+        subs = ','.join([self._sub] * len(ids))
+        self._cur.execute(
+            "SELECT * FROM NODE WHERE ID IN ({})".format(subs), ids)
+        nodes = {row[0]: [row[0]] + [self._value(v) for v in row[1:]]
+                 for row in self._cur.fetchall()}
+        tags = {nid: [] for nid in nodes}
+        self._cur.execute(
+            "SELECT LOOKUP.NODEID, TAG.DATA, TAG.BLINDIDX FROM LOOKUP "
+            "JOIN TAG ON LOOKUP.TAGID = TAG.ID "
+            "WHERE LOOKUP.NODEID IN ({}) ORDER BY TAG.ID".format(subs), ids)
+        for nid, tag, idx in self._cur.fetchall():
+            if nid in tags:
+                tag = self._value(tag)
+                tags[nid].append((tag, idx) if blindidx else tag)
+        return nodes, tags
+
+    def dump_nodes(self):
+        """
+        yield a (fields, tags) pair for every node, without decrypting
+        anything. fields are the cipher texts of username, password, url
+        and notes, tags pairs of a cipher text and its blind index.
+        """
+        ids = self.lazy_list_node_ids()
+        while True:
+            batch = list(islice(ids, self.fetch_size))
+            if not batch:
+                return
+            nodes, tags = self._get_nodes_batch(batch, blindidx=True)
+            for nid in batch:
+                if nid in nodes:
+                    yield nodes[nid][1:5], tags[nid]
+
+    def load_nodes(self, entries, batch_size=1000):
+        """
+        Insert the (fields, tags) pairs of dump_nodes as they are, in
+        transactions of batch_size nodes, which join a transaction the
+        caller has open, and return how many were inserted. The cached
+        tags are dropped, and the nodes are only decrypted to add them
+        to the search index, see _index_loaded_nodes.
+        """
+        count = 0
+        entries = iter(entries)
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                return count
+            with self.transaction():
+                index = {idx: tag for _, tags in batch for tag, idx in tags}
+                tagids = self._get_tags_by_index(list(index))
+                missing = [(self._data_wrapper(tag), idx) for idx, tag in
+                           index.items() if idx not in tagids]
+                if missing:
+                    sql = "INSERT INTO TAG(DATA, BLINDIDX) VALUES({}, {})"
+                    self._cur.executemany(sql.format(self._sub, self._sub),
+                                          missing)
+                    tagids.update(self._get_tags_by_index(
+                        [idx for _, idx in missing]))
+                lookup, nids = [], []
+                for fields, tags in batch:
+                    nid = self._insert_node(list(fields))
+                    lookup.extend(self._lookup_rows(
+                        nid, [idx for _, idx in tags], tagids))
+                    nids.append(nid)
+                self._insert_lookup(lookup)
+                self._tags = self._tag_ids = None
+                self._index_loaded_nodes(nids)
+            count += len(batch)
 
     def getnodes(self, ids):
-        g = list(self.lazy_get_nodes(ids))
-        for node in g:
-            tags = [t for t in self._get_node_tags(node)]
-            yield node[0:], tags
+        """
+        yield a (node, tags) pair for each of the given ids.
+        The ids are fetched in batches of ``fetch_size``.
+        """
+        ids = iter(ids)
+        while True:
+            chunk = list(islice(ids, self.fetch_size))
+            if not chunk:
+                return
+            batch = [int(id_) for id_ in chunk if id_]
+            if not batch:
+                continue
+            nodes, tags = self._get_nodes_batch(batch)
+            for id_ in batch:
+                if id_ in nodes:
+                    yield nodes[id_], tags[id_]
 
     def get_node(self, id):
-        node = next(self.lazy_get_nodes([id]))
-        tags = [t for t in self._get_node_tags(node)]
-        return list(node[0:]), tags
+        for node, tags in self.getnodes([id]):
+            return node, tags
+        return [], []
 
     def lazy_get_nodes(self, ids):
         """
@@ -202,36 +610,143 @@ class Database(object):
                     node = list(map(lambda x: x if x else b'', node))
                     yield node
 
+    @contextmanager
+    def _stream_cursor(self):
+        """
+        a cursor of its own for _stream, so the caller can use _cur
+        while the rows are read
+        """
+        cur = self._con.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+    def _stream(self, sql, params=()):
+        """
+        yield the rows of a query, reading ``stream_size`` rows at a
+        time, so the memory used does not grow with the result.
+        """
+        with self._stream_cursor() as cur:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(self.stream_size)
+                if not rows:
+                    return
+                yield from rows
+
+    def _compile_filter(self, filter):
+        """
+        Compile a tag, or a filter parsed by tagfilter.parse, to a WHERE
+        clause on NODE and its parameters. The ids of all its tags are
+        read with one query. A tag which does not exist matches nothing.
+        """
+        if not isinstance(filter, tuple):
+            filter = ('tag', filter)
+        index = {t: self._tag_index(t) for t in tagfilter.tags(filter)}
+        tagids = self._get_tags_by_index(dict.fromkeys(index.values()))
+        params = []
+
+        def compile(expr):
+            if expr[0] == 'tag':
+                tagid = tagids.get(index[expr[1]])
+                if tagid is None:
+                    return "1 = 0"
+                params.append(tagid)
+                return ("ID IN (SELECT NODEID FROM LOOKUP "
+                        "WHERE TAGID = {})".format(self._sub))
+            if expr[0] == 'not':
+                return "NOT ({})".format(compile(expr[1]))
+            op = " {} ".format(expr[0].upper())
+            return "({})".format(op.join(compile(e) for e in expr[1:]))
+
+        return compile(filter), params
+
     def lazy_list_node_ids(self, filter=None):
-        """return a generator that yields the node ids"""
-        # self._con.set_trace_callback(print)
+        """
+        return a generator that yields the node ids in ascending order,
+        of the nodes which match filter if it is given. filter is a tag,
+        or a tag filter parsed by tagfilter.parse.
+        """
         if not filter:
-            sql_all = "SELECT ID FROM NODE"
-            self._cur.execute(sql_all)
+            rows = self._stream("SELECT ID FROM NODE ORDER BY ID")
         else:
-            tagid = self._get_tag(filter)
-            if not tagid:
-                yield []  # pragma: no cover
-            self._cur.execute(self._list_nodes_sql, (tagid,))
+            where, params = self._compile_filter(filter)
+            rows = self._stream(
+                "SELECT ID FROM NODE WHERE {} ORDER BY ID".format(where),
+                params)
 
-        for node_id in self._cur.fetchall():
+        for node_id in rows:
             yield node_id[0]
 
-    def add_node(self, node):
-        node_tags = list(node)
-        node, tags = node_tags[:4], node_tags[-1]
+    def list_node_ids_page(self, limit, after=None, before=None,
+                           filter=None):
+        """
+        return the ids of a page of at most limit nodes, in ascending
+        order. The page starts after the id ``after``, or ends before
+        the id ``before``. The page is found with the primary key
+        (keyset pagination), so it costs the same on any page.
+        """
+        where, params = [], []
+        if filter:
+            where, params = self._compile_filter(filter)
+            where = [where]
+        if before is not None:
+            where.append("ID < {}".format(self._sub))
+            params.append(before)
+            order = 'DESC'
+        else:
+            where.append("ID > {}".format(self._sub))
+            params.append(after or 0)
+            order = 'ASC'
+        params.append(limit)
+        self._cur.execute(
+            "SELECT ID FROM NODE WHERE {where} "
+            "ORDER BY ID {order} LIMIT {sub}".format(
+                where=' AND '.join(where), order=order, sub=self._sub),
+            params)
+        ids = [row[0] for row in self._cur.fetchall()]
+        return ids[::-1] if before is not None else ids
+
+    def _insert_node(self, node):
         self._cur.execute(self._add_node_sql, list(map(self._data_wrapper, (node))))  # noqa
         try:
-            nid = self._cur.fetchone()[0]
+            return self._cur.fetchone()[0]
         except TypeError:
-            nid = self._cur.lastrowid
-        self._setnodetags(nid, tags)
-        self._con.commit()
-        return nid
+            return self._cur.lastrowid
+
+    def add_node(self, node):
+        return self.add_nodes([node])[0]
+
+    def add_nodes(self, nodes, batch_size=1000):
+        """
+        Insert many nodes and return their ids, in the order given.
+        The tags of each batch are resolved together, the LOOKUP rows
+        are written with executemany and each batch of ``batch_size``
+        nodes is a transaction of its own, unless an outer transaction
+        is open.
+        """
+        nids = []
+        nodes = iter(nodes)
+        while True:
+            batch = [list(node) for node in islice(nodes, batch_size)]
+            if not batch:
+                return nids
+            with self.transaction():
+                tagids = self._get_or_create_tags(
+                    tag for node in batch for tag in node[-1])
+                lookup = []
+                for node in batch:
+                    nid = self._insert_node(node[:4])
+                    lookup.extend(self._lookup_rows(nid, node[-1], tagids))
+                    nids.append(nid)
+                self._insert_lookup(lookup)
+                self._update_search_index(nids[-len(batch):])
 
     def listtags(self):
-        self._clean_orphans()
-        get_tags = "select DATA from TAG"
+        """return the cipher texts of the tags in use"""
+        get_tags = ("select DATA from TAG where ID in "
+                    "(select TAGID from LOOKUP)")
         self._cur.execute(get_tags)
         tags = self._cur.fetchall()
         if tags:
@@ -246,63 +761,243 @@ class Database(object):
             ','.join(['{}={}'.format(k, self._sub) for k in list(kwargs)]),
             self._sub))
 
-        self._cur.execute(sql, (list(kwargs.values()) + [nid]))
-        if tags:
-            # update all old node entries in lookup
-            # create new entries
-            # clean all old tags
-            sql_clean = "DELETE FROM LOOKUP WHERE NODEID={}".format(self._sub)
-            self._cur.execute(sql_clean, (str(nid),))
-            self._setnodetags(nid, tags)
-
-        self._con.commit()
+        with self.transaction():
+            self._cur.execute(sql, (list(kwargs.values()) + [nid]))
+            if tags:
+                # update all old node entries in lookup
+                # create new entries
+                # clean all old tags
+                sql_clean = "DELETE FROM LOOKUP WHERE NODEID={}".format(
+                    self._sub)
+                self._mark_dirty_tags((str(nid),))
+                self._cur.execute(sql_clean, (str(nid),))
+                self._setnodetags(nid, tags)
+            self._update_search_index([nid])
 
     def removenodes(self, nid):
         # shall we do this also in the sqlite driver?
         sql_clean = "DELETE FROM LOOKUP WHERE NODEID={}".format(self._sub)
-        self._cur.execute(sql_clean, nid)
         sql_rm = "delete from NODE where ID = {}".format(self._sub)
-        self._cur.execute(sql_rm, nid)
-        self._con.commit()
-        self._con.commit()
+        with self.transaction():
+            self._mark_dirty_tags(nid)
+            self._cur.execute(sql_clean, nid)
+            self._cur.execute(sql_rm, nid)
+            self._update_search_index(removed=nid)
+
+    def _load_search_blob(self):
+        self._cur.execute("SELECT DATA FROM SEARCHINDEX")
+        row = self._cur.fetchone()
+        return row[0] if row else None
+
+    def _store_search_blob(self, data):
+        """store the encrypted search index, or drop it if data is None"""
+        self._cur.execute("DELETE FROM SEARCHINDEX")
+        if data is not None:
+            self._cur.execute(
+                "INSERT INTO SEARCHINDEX(DATA) VALUES({})".format(self._sub),
+                (data,))
+
+    def _node_pairs(self, ids):
+        """yield a (row, tags) pair for each id, like getnodes"""
+        return self.getnodes(ids)
+
+    def _index_nodes(self, index, ids):
+        """add the nodes with the given ids to index"""
+        pairs = self._node_pairs(ids)
+        while True:
+            nodes = []
+            for row, tags in islice(pairs, self.fetch_size):
+                node = Node.from_encrypted_entries(*row[1:5], tags)
+                node._id = row[0]
+                nodes.append(node)
+            if not nodes:
+                return
+            Node.prefetch(nodes, tags=False)
+            for node in nodes:
+                index.add(node._id, node.username, node.url, node.notes)
+
+    def search_index(self):
+        """
+        return the SearchIndex of the nodes. It is decrypted once, or
+        built and stored if the database has none.
+        """
+        if self._search is None and not self._load_search_index():
+            enc = CryptoEngine.get()
+            index = SearchIndex()
+            self._index_nodes(index, self.lazy_list_node_ids())
+            with self.transaction():
+                self._store_search_blob(enc.encrypt(index.dumps()).decode())
+            self._search = index
+            enc.register_cache(self)
+        return self._search
+
+    def _load_search_index(self):
+        """decrypt the stored search index, return False if there is none"""
+        data = self._load_search_blob()
+        if not data:
+            return False
+        enc = CryptoEngine.get()
+        self._search = SearchIndex.loads(enc.decrypt(data))
+        enc.register_cache(self)
+        return True
+
+    def _update_search_index(self, ids=(), removed=()):
+        """
+        Index the added or edited nodes ids and drop the removed ones.
+        The stored index is loaded first if needed, and stored once when
+        the transaction ends, see _flush_search_index. If there is none,
+        it is built when it is needed.
+        """
+        if self._search is None and not self._load_search_index():
+            return
+        for nid in removed:
+            # an id which is not a number matched no node
+            if str(nid).isdigit():
+                self._search.remove(int(nid))
+        self._index_nodes(self._search, ids)
+        self._search_dirty = True
+
+    def _index_loaded_nodes(self, ids):
+        """
+        index the nodes load_nodes inserted, if the key is at hand.
+        Otherwise the stored index is dropped, as it misses them.
+        """
+        if CryptoEngine.get().is_locked():
+            self._search = None
+            self._store_search_blob(None)
+        else:
+            self._update_search_index(ids)
+
+    def _flush_search_index(self):
+        """
+        encrypt and store the search index, if the transaction changed
+        it. If the key was forgotten in between, the stored index is
+        dropped, as it misses the changes.
+        """
+        if not self._search_dirty:
+            return
+        self._search_dirty = False
+        if self._search is None:
+            self._store_search_blob(None)
+        else:
+            self._store_search_blob(
+                CryptoEngine.get().encrypt(self._search.dumps()).decode())
 
     def fetch_crypto_info(self):
-        self._cur.execute("SELECT * FROM CRYPTO")
+        self._cur.execute("SELECT SEED, DIGEST FROM CRYPTO")
         row = self._cur.fetchone()
         return row
 
     def save_crypto_info(self, seed, digest):
         """save the random seed and the digested key"""
-        self._cur.execute("DELETE  FROM CRYPTO")
-        self._cur.execute("INSERT INTO CRYPTO VALUES({}, {})".format(self._sub,
-                                                                     self._sub),  # noqa
+        with self.transaction():
+            self._cur.execute("DELETE  FROM CRYPTO")
+            self._cur.execute("INSERT INTO CRYPTO(SEED, DIGEST) "
+                              "VALUES({}, {})".format(self._sub, self._sub),
+                              list(map(self._data_wrapper, (seed, digest))))
 
-                          list(map(self._data_wrapper, (seed, digest))))
-        self._con.commit()
+    def pending_key(self):
+        """the new key of an interrupted password change, see MongoDB"""
+        return None
+
+    def _recrypt_rows(self, table, columns, recrypt, progress=None):
+        """
+        re-encrypt the columns of a table, which are read and written
+        in keyset pages of fetch_size rows, and return the row count.
+        recrypt turns the rows into the parameters of the UPDATE.
+        """
+        select = "SELECT ID, {} FROM {} WHERE ID > {} ORDER BY ID LIMIT {}"
+        select = select.format(', '.join(columns), table, self._sub,
+                               self._sub)
+        update = "UPDATE {} SET {} WHERE ID = {}".format(
+            table, ', '.join('{} = {}'.format(c, self._sub)
+                             for c in columns), self._sub)
+        done, last = 0, 0
+        while True:
+            self._cur.execute(select, (last, self.fetch_size))
+            rows = [[v.tobytes() if isinstance(v, memoryview) else v
+                     for v in row] for row in self._cur.fetchall()]
+            if not rows:
+                return done
+            self._cur.executemany(update, recrypt(rows))
+            done, last = done + len(rows), rows[-1][0]
+            if progress is not None:
+                progress(done)
+
+    def reencrypt(self, recrypter, progress=None):
+        """
+        Re-encrypt the nodes, the tags and the search index with the new
+        key of a Recrypter, and store the key, all in one transaction.
+        The rows keep their ids, so LOOKUP stays as it is. Each batch is
+        decrypted and encrypted in parallel, and progress is called with
+        the number of nodes done.
+        """
+        wrap = self._data_wrapper
+
+        def nodes(rows):
+            fields = recrypter.recrypt_many(
+                [self._value(v) for row in rows for v in row[1:5]])
+            return [list(map(wrap, fields[i * 4:i * 4 + 4])) + [row[0]]
+                    for i, row in enumerate(rows)]
+
+        def tags(rows):
+            return [(wrap(data), idx, row[0]) for row, (data, idx) in
+                    zip(rows, recrypter.recrypt_tags([r[1] for r in rows]))]
+
+        with self.transaction():
+            self._flush_search_index()
+            done = self._recrypt_rows(
+                'NODE', ('USERNAME', 'PASSWORD', 'URL', 'NOTES'), nodes,
+                progress)
+            self._recrypt_rows('TAG', ('DATA', 'BLINDIDX'), tags)
+            data = self._load_search_blob()
+            if data:
+                self._store_search_blob(
+                    recrypter.recrypt_many([data])[0].decode())
+            self.savekey(recrypter.key)
+        self.clear_cache()
+        return done
+
+    def _key_sql(self):
+        """
+        the query of the key. The key is read before the migrations run,
+        since they need it, and CRYPTO has the KDF column since 0.9.
+        """
+        if self._get_dbversion() < 0.9:
+            return "SELECT SEED, DIGEST, NULL FROM CRYPTO"
+        return "SELECT SEED, DIGEST, KDF FROM CRYPTO"
 
     def loadkey(self):
         """
         return _keycrypted
         """
-        sql = "SELECT * FROM CRYPTO"
         try:
-            self._cur.execute(sql)
-            seed, digest = self._cur.fetchone()
-            return seed + '$6$' + digest
+            self._cur.execute(self._key_sql())
+            seed, digest, kdf = self._cur.fetchone()
+            return seed + '$6$' + digest + ('$' + kdf if kdf else '')
         except TypeError:  # pragma: no cover
             return None
 
     def savekey(self, key):
         salt, digest = key.split('$6$')
-        sql = "INSERT INTO CRYPTO(SEED, DIGEST) VALUES({},{})".format(self._sub,  # noqa
-                                                                      self._sub)  # noqa
-        self._cur.execute("DELETE FROM CRYPTO")
-        self._cur.execute(sql, list(map(self._data_wrapper, (salt, digest))))
+        digest, _, kdf = digest.partition('$')
+        sql = "INSERT INTO CRYPTO(SEED, DIGEST, KDF) VALUES({},{},{})".format(
+            self._sub, self._sub, self._sub)
+        with self.transaction():
+            self._cur.execute("DELETE FROM CRYPTO")
+            self._cur.execute(sql, list(map(self._data_wrapper,
+                                            (salt, digest))) + [kdf or None])
         self._digest = digest.encode()
         self._salt = salt.encode()
-        self._con.commit()
 
     def close(self):  # pragma: no cover
-        self._clean_orphans()
+        # a connection handed over by the factory which _open did not use
+        handover = self._take_handover()
+        if handover is not None:
+            handover.close()
+        # only the tags which lost a node can be orphans, see vacuum
+        if self._dirty_tags:
+            self._clean_orphans(self._dirty_tags)
+            self._dirty_tags = frozenset()
         self._cur.close()
         self._con.close()
@@ -1,21 +1,23 @@
-try:
-    from .sqlite import SQLite
-except ImportError:
-    SQLite = None
+# The drivers are imported when they are first used, so starting pwman
+# does not import the client libraries of every database.
+import importlib
 
-try:
-    from .postgresql import PostgresqlDatabase
-except ImportError:
-    PostgresqlDatabase = None
+_drivers = {'SQLite': '.sqlite',
+            'PostgresqlDatabase': '.postgresql',
+            'MySQLDatabase': '.mysql',
+            'MongoDB': '.mongodb'}
 
-try:
-    from .mysql import MySQLDatabase
-except ImportError:
-    MySQLDatabase = None
+__all__ = list(_drivers)
 
-try:
-    from .mongodb import MongoDB
-except ImportError:
-    MongoDB = None
 
-__all__ = [SQLite, PostgresqlDatabase, MySQLDatabase, MongoDB]
+def __getattr__(name):
+    try:
+        module = _drivers[name]
+    except KeyError:
+        raise AttributeError(name)
+    try:
+        cls = getattr(importlib.import_module(module, __name__), name)
+    except ImportError:
+        cls = None
+    globals()[name] = cls
+    return cls
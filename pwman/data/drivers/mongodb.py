@@ -17,6 +17,9 @@
 # Copyright (C) 2015 Oz Nahum Tiram <nahumoz@gmail.com>
 # ============================================================================
 
+from contextlib import contextmanager
+from itertools import islice
+
 from pwman.data.database import Database, __DB_FORMAT__
 from pwman.util.crypto_engine import CryptoEngine
 
@@ -31,30 +34,101 @@ class MongoDB(Database):
 
     def __init__(self, mongodb_uri, dbformat=__DB_FORMAT__):
         self.uri = mongodb_uri.geturl()
+        self._session = None
 
     def _open(self):
         self._con = pymongo.MongoClient(self.uri)
         self._db = self._con.get_default_database()
+        # transactions need a replica set or a sharded cluster
+        hello = self._db.command('hello')
+        self._has_transactions = 'setName' in hello or \
+            hello.get('msg') == 'isdbgrid'
 
         counters = self._db.counters.count_documents({})
         if not counters:
             self._db.counters.insert_one({'_id': 'nodeid', 'seq': 0})
+        self._db.nodes.create_index('tagidx')
+        state = self._db.rekey.find_one({'_id': 'rekey', 'swap': True})
+        if state:
+            self._swap_rekey(state)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the operations in a session with a transaction, if the
+        server supports them. Otherwise each operation is atomic on its
+        own. Nested scopes join the outermost one, which stores the
+        search index.
+        """
+        if self._session is not None or self._tx_depth:
+            yield self
+            return
+
+        if not self._has_transactions:
+            self._tx_depth += 1
+            try:
+                yield self
+            except BaseException:
+                # what was done before the error stays, the stored
+                # index misses it
+                self.clear_cache()
+                self._flush_search_index()
+                raise
+            finally:
+                self._tx_depth -= 1
+            self._flush_search_index()
+            return
+
+        with self._con.start_session() as session:
+            with session.start_transaction():
+                self._session = session
+                try:
+                    yield self
+                    self._flush_search_index()
+                except BaseException:
+                    self.clear_cache()
+                    self._search_dirty = False
+                    raise
+                finally:
+                    self._session = None
+
+    def _migrate(self):
+        """
+        Add the blind index of the tags to nodes created before it existed
+        """
+        for node in self._db.nodes.find({'tagidx': {'$exists': False}},
+                                        {'_id': 1, 'tags': 1},
+                                        session=self._session):
+            self._db.nodes.update_one(
+                {'_id': node['_id']},
+                {'$set': {'tagidx': self._tags_index(node['tags'])}},
+                session=self._session)
+
+    def _tags_index(self, tags):
+        return [self._tag_index(t) for t in tags]
 
-    def _get_next_node_id(self):
+    def _get_next_node_id(self, count=1):
+        """reserve count node ids and return the last one"""
         # for newer pymongo versions ...
         # return_document=ReturnDocument.AFTER
         nodeid = self._db.counters.find_one_and_update(
-            {'_id': 'nodeid'}, {'$inc': {'seq': 1}}, new=True,
-            fields={'seq': 1, '_id': 0})
+            {'_id': 'nodeid'}, {'$inc': {'seq': count}}, new=True,
+            fields={'seq': 1, '_id': 0}, session=self._session)
         return nodeid['seq']
 
     def getnodes(self, ids):
+        """
+        yield the nodes with the given ids, or all nodes if there are
+        none. The cursor reads ``stream_size`` documents at a time.
+        """
         if ids:
             ids = list(map(int, ids))
-            node_dicts = self._db.nodes.find({'_id': {'$in': ids}})
+            node_dicts = self._db.nodes.find({'_id': {'$in': ids}},
+                                             session=self._session,
+                                             batch_size=self.stream_size)
         else:
-            node_dicts = self._db.nodes.find({})
-        nodes = []
+            node_dicts = self._db.nodes.find({}, session=self._session,
+                                             batch_size=self.stream_size)
         for node in node_dicts:
             n = [node['_id'],
                  node['username'],
@@ -63,41 +137,149 @@ class MongoDB(Database):
                  node['notes']]
 
             [n.append(t) for t in node['tags']]
-            nodes.append(n)
+            yield n
 
-        return nodes
+    def _compile_filter(self, filter):
+        """compile a tag or a parsed tag filter to a query on tagidx"""
+        if not isinstance(filter, tuple):
+            filter = ('tag', filter)
+        if filter[0] == 'tag':
+            return {'tagidx': self._tag_index(filter[1])}
+        if filter[0] == 'not':
+            return {'$nor': [self._compile_filter(filter[1])]}
+        return {'$' + filter[0]: [self._compile_filter(f)
+                                  for f in filter[1:]]}
 
     def listnodes(self, filter_=None):
-        if not filter_:
-            nodes = self._db.nodes.find({}, {'_id': 1})
-            return [node["_id"] for node in nodes]
+        """yield the ids of the nodes, with the tag filter_ if given"""
+        query = self._compile_filter(filter_) if filter_ else {}
+        nodes = self._db.nodes.find(query, {'_id': 1}, session=self._session,
+                                    batch_size=self.stream_size)
+        for node in nodes:
+            yield node["_id"]
+
+    def lazy_list_node_ids(self, filter=None):
+        return self.listnodes(filter_=filter)
+
+    def list_node_ids_page(self, limit, after=None, before=None,
+                           filter=None):
+        query = self._compile_filter(filter) if filter else {}
+        if before is not None:
+            query['_id'] = {'$lt': before}
+            order = pymongo.DESCENDING
         else:
-            matching = []
-            ce = CryptoEngine.get()
-            nodes = list(self._db.nodes.find({}, {'_id': 1, 'tags': 1}))
-            for node in nodes:
-                node['tags'] = [ce.decrypt(t) for t in node['tags']]
-                if filter_ in node['tags']:
-                    matching.append(node)
-            return [node["_id"] for node in matching]
+            query['_id'] = {'$gt': after or 0}
+            order = pymongo.ASCENDING
+        nodes = self._db.nodes.find(query, {'_id': 1}, session=self._session)
+        ids = [node['_id'] for node in nodes.sort('_id', order).limit(limit)]
+        return ids[::-1] if before is not None else ids
 
     def add_node(self, node):
-        nid = self._get_next_node_id()
-        node = node.to_encdict()
-        node['_id'] = nid
-        self._db.nodes.insert_one(node)
-        return nid
+        return self.add_nodes([node])[0]
+
+    def add_nodes(self, nodes, batch_size=1000):
+        nids = []
+        nodes = iter(nodes)
+        while True:
+            batch = [node.to_encdict() for node in islice(nodes, batch_size)]
+            if not batch:
+                return nids
+            with self.transaction():
+                first = self._get_next_node_id(len(batch)) - len(batch) + 1
+                for nid, node in enumerate(batch, first):
+                    node['_id'] = nid
+                    node['tagidx'] = self._tags_index(node['tags'])
+                    nids.append(nid)
+                self._db.nodes.insert_many(batch, session=self._session)
+                self._update_search_index(nids[-len(batch):])
+                self._tags = None
+
+    def dump_nodes(self):
+        nodes = self._db.nodes.find({}, session=self._session,
+                                    batch_size=self.stream_size)
+        for node in nodes.sort('_id', pymongo.ASCENDING):
+            yield ([node[f] for f in ('username', 'password', 'url',
+                                      'notes')],
+                   list(zip(node['tags'], node['tagidx'])))
+
+    def load_nodes(self, entries, batch_size=1000):
+        count = 0
+        entries = iter(entries)
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                return count
+            with self.transaction():
+                first = self._get_next_node_id(len(batch)) - len(batch) + 1
+                docs = [{'_id': nid, 'username': fields[0],
+                         'password': fields[1], 'url': fields[2],
+                         'notes': fields[3], 'mdate': None,
+                         'tags': [tag for tag, _ in tags],
+                         'tagidx': [idx for _, idx in tags]}
+                        for nid, (fields, tags) in enumerate(batch, first)]
+                self._db.nodes.insert_many(docs, session=self._session)
+                self._tags = None
+                self._index_loaded_nodes([doc['_id'] for doc in docs])
+            count += len(batch)
 
     def listtags(self):
-        tags = self._db.nodes.distinct('tags')
+        tags = self._db.nodes.distinct('tags', session=self._session)
         return tags
 
+    def tag_names(self):
+        """
+        return the sorted clear text names of the tags. Each node has
+        its own cipher texts of its tags, which are decrypted once and
+        kept until the nodes change or the key is forgotten.
+        """
+        if self._tags is None:
+            enc = CryptoEngine.get()
+            ciphers = self.listtags()
+            self._tags = dict(zip(ciphers, enc.decrypt_many(ciphers)))
+            enc.register_cache(self)
+        return sorted({tag.decode() for tag in self._tags.values()})
+
     def editnode(self, nid, **kwargs):
-        self._db.nodes.find_one_and_update({'_id': nid}, kwargs)
+        if kwargs.get('tags'):
+            kwargs['tagidx'] = self._tags_index(kwargs['tags'])
+        with self.transaction():
+            self._db.nodes.find_one_and_update({'_id': nid}, {'$set': kwargs},
+                                               session=self._session)
+            self._update_search_index([nid])
+            self._tags = None
 
     def removenodes(self, nid):
         nid = list(map(int, nid))
-        self._db.nodes.delete_one({'_id': {'$in': nid}})
+        with self.transaction():
+            self._db.nodes.delete_many({'_id': {'$in': nid}},
+                                       session=self._session)
+            self._update_search_index(removed=nid)
+            self._tags = None
+
+    def _load_search_blob(self):
+        doc = self._db.search.find_one({'_id': 'index'},
+                                       session=self._session)
+        return doc['data'] if doc else None
+
+    def _store_search_blob(self, data):
+        if data is None:
+            self._db.search.delete_one({'_id': 'index'},
+                                       session=self._session)
+        else:
+            self._db.search.replace_one({'_id': 'index'},
+                                        {'_id': 'index', 'data': data},
+                                        upsert=True, session=self._session)
+
+    def _node_pairs(self, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        for node in self.getnodes(ids):
+            yield node[:5], node[5:]
+
+    def vacuum(self):
+        # the tags are removed with their nodes
+        return 0
 
     def fetch_crypto_info(self):
         pass
@@ -105,14 +287,82 @@ class MongoDB(Database):
     def savekey(self, key):
         coll = self._db['crypto']
         salt, digest = key.split('$6$')
-        coll.insert_one({'salt': salt, 'key': digest})
+        digest, _, kdf = digest.partition('$')
+        coll.replace_one({}, {'salt': salt, 'key': digest, 'kdf': kdf},
+                         upsert=True, session=self._session)
+
+    def pending_key(self):
+        state = self._db.rekey.find_one({'_id': 'rekey'})
+        return state['key'] if state else None
+
+    def reencrypt(self, recrypter, progress=None):
+        """
+        Write the re-encrypted nodes to the nodes_new collection, in
+        batches, and keep the last id done in the rekey collection. A
+        change which was interrupted goes on from there, if it is given
+        the same new password. At the end nodes_new replaces nodes and
+        the new key is stored; a swap which was interrupted is finished
+        when the database is opened.
+        """
+        state = self._db.rekey.find_one({'_id': 'rekey'})
+        if state is None or state['key'] != recrypter.key:
+            self._db.nodes_new.drop()
+            state = {'_id': 'rekey', 'key': recrypter.key, 'last': 0,
+                     'done': 0, 'swap': False}
+            self._db.rekey.replace_one({'_id': 'rekey'}, state, upsert=True)
+
+        fields = ('username', 'password', 'url', 'notes')
+        done = state['done']
+        nodes = self._db.nodes.find({'_id': {'$gt': state['last']}},
+                                    batch_size=self.stream_size)
+        nodes = nodes.sort('_id', pymongo.ASCENDING)
+        while True:
+            batch = list(islice(nodes, self.fetch_size))
+            if not batch:
+                break
+            values = iter(recrypter.recrypt_many(
+                [n[f] for n in batch for f in fields]))
+            tags = iter(recrypter.recrypt_tags(
+                [t for n in batch for t in n['tags']]))
+            writes = []
+            for node in batch:
+                node.update((f, next(values)) for f in fields)
+                pairs = [next(tags) for _ in node['tags']]
+                node['tags'] = [t for t, _ in pairs]
+                node['tagidx'] = [idx for _, idx in pairs]
+                writes.append(pymongo.ReplaceOne({'_id': node['_id']}, node,
+                                                 upsert=True))
+            # replacing makes a batch which is written twice harmless
+            self._db.nodes_new.bulk_write(writes)
+            done += len(batch)
+            self._db.rekey.update_one(
+                {'_id': 'rekey'},
+                {'$set': {'last': batch[-1]['_id'], 'done': done}})
+            if progress is not None:
+                progress(done)
+
+        state['swap'] = True
+        self._db.rekey.update_one({'_id': 'rekey'}, {'$set': {'swap': True}})
+        self._swap_rekey(state)
+        return done
+
+    def _swap_rekey(self, state):
+        """replace the nodes and the key by the re-encrypted ones"""
+        if 'nodes_new' in self._db.list_collection_names():
+            self._db.nodes_new.rename('nodes', dropTarget=True)
+            self._db.nodes.create_index('tagidx')
+        self.savekey(state['key'])
+        self._store_search_blob(None)
+        self._db.rekey.delete_one({'_id': 'rekey'})
+        self.clear_cache()
 
     def loadkey(self):
         coll = self._db['crypto']
         try:
-            key = coll.find_one({}, {'_id': 0})
-            key = key['salt'] + '$6$' + key['key']
-        except TypeError:
+            key = coll.find_one({}, {'_id': 0}, session=self._session)
+            kdf = key.get('kdf')
+            key = key['salt'] + '$6$' + key['key'] + ('$' + kdf if kdf else '')
+        except AttributeError:
             key = None
         return key
 
@@ -22,6 +22,8 @@
 # grant all on pwmantest.* to 'pwman'@'localhost';
 
 """MySQL Database implementation."""
+from contextlib import contextmanager
+
 from pwman.data.database import Database, __DB_FORMAT__
 
 import pymysql
@@ -31,25 +33,39 @@ mysql.install_as_MySQLdb()
 
 class MySQLDatabase(Database):
 
+    reuse_connection = True
+
+    # the connection of _stream_cursor, and whether a stream reads it
+    _stream_con = None
+    _streaming = False
+
     @classmethod
-    def check_db_version(cls, dburi):
+    def connect(cls, dburi):
         port = 3306
         credentials, host = dburi.netloc.split('@')
         user, passwd = credentials.split(':')
         if ':' in host:
             host, port = host.split(':')
             port = int(port)
-        con = mysql.connect(host=host, port=port, user=user, passwd=passwd,
-                            db=dburi.path.lstrip('/'))
+        return mysql.connect(host=host, port=port, user=user, passwd=passwd,
+                             db=dburi.path.lstrip('/'))
+
+    @classmethod
+    def check_db_version(cls, dburi, con=None):
+        own = con is None
+        if own:
+            con = cls.connect(dburi)
         cur = con.cursor()
         try:
             cur.execute("SELECT VERSION FROM DBVERSION")
             version = cur.fetchone()
             cur.close()
-            con.close()
             return version[-1]
         except mysql.ProgrammingError:
             con.rollback()
+        finally:
+            if own:
+                con.close()
 
         return str(__DB_FORMAT__)
 
@@ -57,31 +73,57 @@ class MySQLDatabase(Database):
         self.dburi = mysqluri
         self.dbversion = dbformat
         self._sub = "%s"
-        self._list_nodes_sql = "SELECT NODEID FROM LOOKUP WHERE TAGID = %s "
         self._add_node_sql = ("INSERT INTO NODE(USERNAME, PASSWORD, URL, "
                               "NOTES) "
                               "VALUES(%s, %s, %s, %s)")
-        self._insert_tag_sql = "INSERT INTO TAG(DATA) VALUES(%s)"
+        self._insert_tag_sql = "INSERT INTO TAG(DATA, BLINDIDX) VALUES(%s, %s)"
         self._get_node_sql = "SELECT * FROM NODE WHERE ID = %s"
         self._data_wrapper = lambda x: x
         self.ProgrammingError = mysql.ProgrammingError
         self.autoincr = "AUTO_INCREMENT"
         self.integer = "INT"
+        self.longtext = "LONGTEXT"
 
     def _open(self):
-
-        port = 3306
-        credentials, host = self.dburi.netloc.split('@')
-        user, passwd = credentials.split(':')
-        if ':' in host:
-            host, port = host.split(':')
-            port = int(port)
-
-        self._con = mysql.connect(host=host, port=port, user=user,
-                                  passwd=passwd,
-                                  db=self.dburi.path.lstrip('/'))
+        self._con = self._take_handover() or self.connect(self.dburi)
         self._cur = self._con.cursor()
         try:
             self._create_tables()
         except pymysql.err.InternalError:
             pass
+
+    @contextmanager
+    def _stream_cursor(self):
+        """
+        an unbuffered SSCursor. It blocks its connection until all the
+        rows are read, so it uses a second connection, which is kept
+        open until the database is closed. It does not see what the
+        current transaction did not commit yet. A stream started while
+        another one is still read gets a connection of its own.
+        """
+        con = self._stream_con
+        if con is None or self._streaming:
+            con = self.connect(self.dburi)
+            # every query sees the rows committed before it started
+            con.autocommit(True)
+            if self._stream_con is None:
+                self._stream_con = con
+        else:
+            con.ping(reconnect=True)
+        own = con is not self._stream_con
+        if not own:
+            self._streaming = True
+        try:
+            with con.cursor(pymysql.cursors.SSCursor) as cur:
+                yield cur
+        finally:
+            if own:
+                con.close()
+            else:
+                self._streaming = False
+
+    def close(self):
+        if self._stream_con is not None:
+            self._stream_con.close()
+            self._stream_con = None
+        super(MySQLDatabase, self).close()
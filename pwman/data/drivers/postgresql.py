@@ -20,10 +20,16 @@
 # ============================================================================
 
 """Postgresql Database implementation."""
+from contextlib import contextmanager
+from itertools import count
+
 import psycopg2 as pg
+from psycopg2.errors import DuplicateTable
 
 from pwman.data.database import Database, __DB_FORMAT__
-from pwman.util.crypto_engine import CryptoEngine
+
+# named cursors need a name which is unique in their connection
+_cursor_ids = count()
 
 
 class PostgresqlDatabase(Database):
@@ -41,22 +47,32 @@ class PostgresqlDatabase(Database):
     the Postgresql server.
     """
 
+    reuse_connection = True
+
     @classmethod
-    def check_db_version(cls, dburi):
+    def connect(cls, dburi):
+        return pg.connect(dburi)
+
+    @classmethod
+    def check_db_version(cls, dburi, con=None):
         """
-        Check the database version
+        Check the database version, con is left open if it is given
         """
-        con = pg.connect(dburi)
+        own = con is None
+        if own:
+            con = cls.connect(dburi)
         cur = con.cursor()
         try:
             cur.execute("SELECT VERSION from DBVERSION")
             version = cur.fetchone()
             cur.close()
-            con.close()
             return version[-1]
         except pg.ProgrammingError:
             con.rollback()
             return __DB_FORMAT__
+        finally:
+            if own:
+                con.close()
 
     def __init__(self, pgsqluri, dbformat=__DB_FORMAT__):
         """
@@ -65,121 +81,115 @@ class PostgresqlDatabase(Database):
         self._pgsqluri = pgsqluri
         self.dbversion = dbformat
         self._sub = "%s"
-        self._list_nodes_sql = "SELECT NODEID FROM LOOKUP WHERE TAGID = %s "
         self._add_node_sql = ('INSERT INTO NODE(USERNAME, PASSWORD, URL, '
                               'NOTES) VALUES(%s, %s, %s, %s) RETURNING ID')
-        self._insert_tag_sql = "INSERT INTO TAG(DATA) VALUES(%s) RETURNING ID"
+        self._insert_tag_sql = ("INSERT INTO TAG(DATA, BLINDIDX) "
+                                "VALUES(%s, %s) RETURNING ID")
         self._get_node_sql = "SELECT * FROM NODE WHERE ID = %s"
         self.ProgrammingError = pg.ProgrammingError
         self._data_wrapper = lambda x: pg.Binary(x)
 
     def _open(self):
 
-        self._con = pg.connect(self._pgsqluri.geturl())
+        self._con = self._take_handover() or self.connect(
+            self._pgsqluri.geturl())
         self._cur = self._con.cursor()
         self._create_tables()
 
-    def _get_tag(self, tagcipher):
-        sql_search = "SELECT * FROM TAG"
-        self._cur.execute(sql_search)
-        ce = CryptoEngine.get()
-
+    @contextmanager
+    def _stream_cursor(self):
+        """
+        a named cursor, which keeps the result on the server. With hold
+        it stays open if the transaction is committed while reading.
+        """
+        cur = self._con.cursor(name='pwman_stream_%d' % next(_cursor_ids),
+                               withhold=True)
+        cur.itersize = self.stream_size
         try:
-            tag = ce.decrypt(tagcipher)
-            encrypted = True
-        except Exception:
-            tag = tagcipher
-            encrypted = False
-
-        rv = self._cur.fetchall()
-        for idx, cipher in rv:
-            cipher = cipher.tobytes()
-            if encrypted and tag == ce.decrypt(cipher):
-                return idx
-            elif tag == cipher:
-                return idx
+            yield cur
+        finally:
+            cur.close()
 
     def _create_tables(self):
         if self._check_tables():
+            with self.transaction():
+                self._create_search_table()
             return
         try:
-            self._cur.execute("CREATE TABLE NODE(ID SERIAL PRIMARY KEY, "
-                              "USERNAME BYTEA NOT NULL, "
-                              "PASSWORD BYTEA NOT NULL, "
-                              "URL BYTEA NOT NULL, "
-                              "NOTES BYTEA NOT NULL"
-                              ")")
+            with self.transaction():
+                self._cur.execute("CREATE TABLE NODE(ID SERIAL PRIMARY KEY, "
+                                  "USERNAME BYTEA NOT NULL, "
+                                  "PASSWORD BYTEA NOT NULL, "
+                                  "URL BYTEA NOT NULL, "
+                                  "NOTES BYTEA NOT NULL"
+                                  ")")
+
+                self._cur.execute("CREATE TABLE TAG"
+                                  "(ID  SERIAL PRIMARY KEY,"
+                                  "DATA BYTEA NOT NULL, "
+                                  "BLINDIDX VARCHAR(64))")
 
-            self._cur.execute("CREATE TABLE TAG"
-                              "(ID  SERIAL PRIMARY KEY,"
-                              "DATA BYTEA NOT NULL)")
+                self._cur.execute("CREATE INDEX TAG_BLINDIDX ON TAG(BLINDIDX)")
 
-            self._cur.execute("CREATE TABLE LOOKUP ("
-                              "nodeid INTEGER NOT NULL REFERENCES NODE(ID),"
-                              "tagid INTEGER NOT NULL REFERENCES TAG(ID)"
-                              ")")
+                self._cur.execute("CREATE TABLE LOOKUP ("
+                                  "nodeid INTEGER NOT NULL "
+                                  "REFERENCES NODE(ID),"
+                                  "tagid INTEGER NOT NULL REFERENCES TAG(ID)"
+                                  ")")
 
-            self._cur.execute("CREATE TABLE CRYPTO "
-                              "(SEED BYTEA, DIGEST BYTEA)")
+                self._create_lookup_indexes()
 
-            self._cur.execute("CREATE TABLE DBVERSION("
-                              "VERSION TEXT NOT NULL)")
+                self._cur.execute("CREATE TABLE CRYPTO "
+                                  "(SEED BYTEA, DIGEST BYTEA, KDF TEXT)")
 
-            self._cur.execute("INSERT INTO DBVERSION VALUES(%s)",
-                              (self.dbversion,))
+                self._cur.execute("CREATE TABLE DBVERSION("
+                                  "VERSION TEXT NOT NULL)")
 
-            self._con.commit()
-        except Exception:  # pragma: no cover
-            self._con.rollback()
+                self._cur.execute("INSERT INTO DBVERSION VALUES(%s)",
+                                  (self.dbversion,))
+
+                self._create_search_table()
+        except DuplicateTable:  # pragma: no cover
+            # another client created the tables in the meantime, any
+            # other error is raised after the transaction rolled back
+            with self.transaction():
+                self._create_search_table()
 
     def savekey(self, key):
         salt, digest = key.split('$6$')
+        digest, _, kdf = digest.partition('$')
         try:
             salt, digest = salt.encode(), digest.encode()
         except AttributeError:
             pass
 
-        sql = "INSERT INTO CRYPTO(SEED, DIGEST) VALUES({},{})".format(self._sub,  # noqa
-                                                                      self._sub)  # noqa
-        self._cur.execute("DELETE FROM CRYPTO")
-        self._cur.execute(sql, list(map(self._data_wrapper, (salt, digest))))
+        sql = "INSERT INTO CRYPTO(SEED, DIGEST, KDF) VALUES({},{},{})".format(
+            self._sub, self._sub, self._sub)
+        with self.transaction():
+            self._cur.execute("DELETE FROM CRYPTO")
+            self._cur.execute(sql, list(map(self._data_wrapper,
+                                            (salt, digest))) + [kdf or None])
         self._digest = digest
         self._salt = salt
-        self._con.commit()
 
     def loadkey(self):
         """
-        return _keycrypted
+        return _keycrypted, as a str like the other drivers do
         """
-        sql = "SELECT * FROM CRYPTO"
         try:
-            self._cur.execute(sql)
-            seed, digest = self._cur.fetchone()
-            return seed.tobytes() + b'$6$' + digest.tobytes()
+            self._cur.execute(self._key_sql())
+            seed, digest, kdf = self._cur.fetchone()
+            return (seed.tobytes().decode() + '$6$' +
+                    digest.tobytes().decode() + ('$' + kdf if kdf else ''))
         except TypeError:  # pragma: no cover
             return None
 
-    def getnodes(self, ids):
-        if ids:
-            sql = ("SELECT * FROM NODE WHERE ID IN ({})"
-                   "".format(','.join(self._sub for i in ids)))
-        else:
-            sql = "SELECT * FROM NODE"
-        self._cur.execute(sql, (ids))
-        nodes = self._cur.fetchall()
-        if not nodes:
-            return []
-
-        nodes_w_tags = []
-        for node in nodes:
-            tags = [t.tobytes() for t in self._get_node_tags(node)]
-            nodes_w_tags.append([node[0]] + [item.tobytes() for item in node[1:]] + tags)
-
-        return nodes_w_tags
+    def _value(self, value):
+        return value.tobytes() if value else b''
 
     def listtags(self):
-        self._clean_orphans()
-        get_tags = "select DATA from TAG"
+        get_tags = ("select DATA from TAG where ID in "
+                    "(select TAGID from LOOKUP)")
         self._cur.execute(get_tags)
         tags = self._cur.fetchall()
         if tags:
@@ -58,8 +58,7 @@ class SQLite(Database):
 
         self._add_node_sql = ("INSERT INTO NODE(USERNAME, PASSWORD, URL, NOTES)"
                               "VALUES(?, ?, ?, ?)")
-        self._list_nodes_sql = "SELECT NODEID FROM LOOKUP WHERE TAGID = ? "
-        self._insert_tag_sql = "INSERT INTO TAG(DATA) VALUES(?)"
+        self._insert_tag_sql = "INSERT INTO TAG(DATA, BLINDIDX) VALUES(?, ?)"
         self._get_node_sql = "SELECT * FROM NODE WHERE ID = ?"
         self._sub = '?'
         self._data_wrapper = lambda x: x
@@ -75,3 +74,9 @@ class SQLite(Database):
 
         self._cur = self._con.cursor()
         self._create_tables()
+
+    def vacuum(self):
+        """delete the unused tags, and rebuild the file to free space"""
+        deleted = super(SQLite, self).vacuum()
+        self._cur.execute("VACUUM")
+        return deleted
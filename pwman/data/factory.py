@@ -17,13 +17,26 @@
 # Copyright (C) 2012-2016 Oz Nahum Tiram <oz.tiram@gmail.com>
 # ============================================================================
 
+"""
+Create database objects from URIs.
+
+The drivers are kept in a registry of URI schemes. A driver is imported
+only when its scheme is used. Other packages can add drivers with an
+entry point in the ``pwman3.drivers`` group, whose name is the scheme::
+
+    [project.entry-points."pwman3.drivers"]
+    redis = "pwman_redis:RedisDatabase"
+"""
+import importlib
 import sys
+from collections import namedtuple
 from urllib.parse import urlparse
 
 import os
 
 from pwman.data.database import DatabaseException
-from pwman.data import drivers
+
+ENTRY_POINT_GROUP = 'pwman3.drivers'
 
 
 def parse_sqlite_uri(dburi):
@@ -42,49 +55,102 @@ def no_parse_uri(dburi):
     return dburi
 
 
-class_db_map = {'sqlite':
-                ['SQLite', parse_sqlite_uri],
-                'postgresql': ['PostgresqlDatabase', parse_postgres_uri,
-                               'python-psycopg2'],
-                'mysql': ['MySQLDatabase', no_parse_uri, 'pymysql'],
-                'mongodb': ['MongoDB', no_parse_uri, 'pymongo']
-                }
-create_db_map = {'sqlite':
-                 ['SQLite', parse_sqlite_uri],
-                 'postgresql': ['PostgresqlDatabase', no_parse_uri,
-                                'python-psycopg2'],
-                 'mysql': ['MySQLDatabase', no_parse_uri, 'pymysql'],
-                 'mongodb': ['MongoDB', no_parse_uri, 'pymongo']
-                 }
+# target is "module:class", check_uri and create_uri convert the parsed
+# URI to what the check_db_version and the constructor of the class take
+Driver = namedtuple('Driver', 'target, check_uri, create_uri, requires')
 
+_drivers = {
+    'sqlite': Driver('pwman.data.drivers.sqlite:SQLite',
+                     parse_sqlite_uri, parse_sqlite_uri, 'sqlite3'),
+    'postgresql': Driver('pwman.data.drivers.postgresql:PostgresqlDatabase',
+                         parse_postgres_uri, no_parse_uri, 'python-psycopg2'),
+    'mysql': Driver('pwman.data.drivers.mysql:MySQLDatabase',
+                    no_parse_uri, no_parse_uri, 'pymysql'),
+    'mongodb': Driver('pwman.data.drivers.mongodb:MongoDB',
+                      no_parse_uri, no_parse_uri, 'pymongo'),
+}
 
-def check_db_version(dburi):
 
-    dburi = urlparse(dburi)
-    dbtype = dburi.scheme
+def register(scheme, target, check_uri=no_parse_uri, create_uri=no_parse_uri,
+             requires=None):
+    """
+    Register the driver target, a class or a "module:class" string, for
+    the URI scheme.
+    """
+    _drivers[scheme] = Driver(target, check_uri, create_uri,
+                              requires or str(target))
 
-    if not dbtype:
-        print("Your URI seems incorrect ...")
-        sys.exit(1)
 
+def _entry_points():
+    from importlib import metadata
     try:
-        cls = getattr(drivers, class_db_map[dbtype][0])
-        ver = cls.check_db_version(class_db_map[dbtype][1](dburi))
-        return ver
-    except AttributeError:
-        raise DatabaseException(
-            '%s not installed? ' % class_db_map[dbtype][-1])
+        return metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # pragma: no cover
+        # python 3.9
+        return metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+
+
+def get_driver(scheme):
+    """
+    Return the class which handles the URI scheme and its registry
+    entry. Schemes which are not built in are looked up in the entry
+    points.
+    """
+    if scheme not in _drivers:
+        for entry_point in _entry_points():
+            if entry_point.name == scheme:
+                register(scheme, entry_point.value)
+                break
+        else:
+            raise DatabaseException(
+                'Unknown database [%s] given ...' % (scheme))
+
+    driver = _drivers[scheme]
+    cls = driver.target
+    if isinstance(cls, str):
+        module, _, name = cls.partition(':')
+        try:
+            cls = getattr(importlib.import_module(module), name)
+        except ImportError:
+            raise DatabaseException('%s not installed? ' % driver.requires)
+        _drivers[scheme] = driver = driver._replace(target=cls)
+    return cls, driver
 
 
-def createdb(dburi, version):
+def check_db_version(dburi):
 
-    dburi = urlparse(dburi)
-    dbtype = dburi.scheme
-    try:
-        cls = getattr(drivers, create_db_map[dbtype][0])
-        return cls(create_db_map[dbtype][1](dburi))
-    except AttributeError:
-        raise DatabaseException(
-            '%s not installed? ' % class_db_map[dbtype][-1])
-    except KeyError:
-        raise DatabaseException('Unknown database [%s] given ...' % (dbtype))
+    parsed = urlparse(dburi)
+    dbtype = parsed.scheme
+
+    if not dbtype:
+        print("Your URI seems incorrect ...")
+        sys.exit(1)
+
+    cls, driver = get_driver(dbtype)
+    return cls.check_db_version(driver.check_uri(parsed))
+
+
+def createdb(dburi, version=None):
+    """
+    Return a database object for dburi. If version is None, the version
+    of the database is checked first. Drivers which reuse_connection
+    check it on a connection which is handed to the database, so _open
+    does not connect again.
+    """
+    parsed = urlparse(dburi)
+    cls, driver = get_driver(parsed.scheme)
+    con = None
+    if version is None:
+        if not cls.reuse_connection:
+            cls.check_db_version(driver.check_uri(parsed))
+        else:
+            uri = driver.check_uri(parsed)
+            con = cls.connect(uri)
+            try:
+                cls.check_db_version(uri, con)
+            except BaseException:
+                con.close()
+                raise
+    db = cls(driver.create_uri(parsed))
+    db._handover = con
+    return db
@@ -18,27 +18,175 @@
 # ============================================================================
 # Copyright (C) 2006 Ivan Kelly <ivan@ivankelly.net>
 # ============================================================================
+import json
 from builtins import bytes
-from colorama import Fore
+from itertools import islice
 from pwman.util.crypto_engine import CryptoEngine
 import pwman.ui.tools
 
+# marks a username column which holds all the fields of a node
+RECORD_PREFIX = b'rec$'
+RECORD_FIELDS = ('username', 'password', 'url', 'notes')
+
+
+def _text(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode()
+    return value if value is not None else ''
+
 
 class Node:
-    """Represents a password or a secret in the database"""
+    """
+    Represents a password or a secret in the database
+
+    A node is stored either with each field encrypted on its own, or as
+    a record: all fields are serialized and encrypted as a single token,
+    which is kept in the username column while the other columns are
+    empty. A record needs only one decryption to read every field.
+    """
+
+    # Decrypted fields are cached per node. The cache is dropped by the
+    # setters and by the CryptoEngine when it forgets the key or the
+    # lock times out.
+    __slots__ = ('_username', '_password', '_url', '_notes', '_tags',
+                 '_mdate', '_cache', '_id', 'id', '__weakref__')
+
+    # store new nodes as records, set from the configuration
+    record = False
 
-    def __init__(self, clear_text=True, **kwargs):
+    def __init__(self, clear_text=True, record=None, **kwargs):
+        self._cache = {}
         if clear_text:
             enc = CryptoEngine.get()
-            self._username = enc.encrypt(kwargs.get('username')).strip()
-            self._password = enc.encrypt(kwargs.get('password')).strip()
-            self._url = enc.encrypt(kwargs.get('url')).strip()
-            self._notes = enc.encrypt(kwargs.get('notes')).strip()
+            if self.record if record is None else record:
+                self._encode_record({f: _text(kwargs.get(f)) for f in
+                                     RECORD_FIELDS})
+            else:
+                self._username = enc.encrypt(kwargs.get('username')).strip()
+                self._password = enc.encrypt(kwargs.get('password')).strip()
+                self._url = enc.encrypt(kwargs.get('url')).strip()
+                self._notes = enc.encrypt(kwargs.get('notes')).strip()
             self._mdate = kwargs.get('mdate')
             self._tags = [enc.encrypt(t).strip() for t in
                           kwargs.get('tags', '')]
 
+    @classmethod
+    def many(cls, entries, record=None):
+        """
+        Create nodes from dictionaries of clear text fields, which are
+        the keyword arguments of Node. All the values are encrypted with
+        a single call to CryptoEngine.encrypt_many.
+        """
+        record = cls.record if record is None else record
+        entries = list(entries)
+        texts = []
+        for entry in entries:
+            if record:
+                texts.append(json.dumps({f: _text(entry.get(f)) for f in
+                                         RECORD_FIELDS}))
+            else:
+                texts.extend(entry.get(f) for f in RECORD_FIELDS)
+            texts.extend(entry.get('tags', ''))
+
+        enc = CryptoEngine.get()
+        ciphers = (c.strip() for c in enc.encrypt_many(texts))
+        nodes = []
+        for entry in entries:
+            node = cls(clear_text=False)
+            if record:
+                node._username = RECORD_PREFIX + next(ciphers)
+                node._password = node._url = node._notes = b''
+            else:
+                (node._username, node._password,
+                 node._url, node._notes) = islice(ciphers, 4)
+            node._mdate = entry.get('mdate')
+            node._tags = list(islice(ciphers, len(entry.get('tags', ''))))
+            nodes.append(node)
+        return nodes
+
+    @staticmethod
+    def prefetch(nodes, tags=True):
+        """
+        Decrypt the fields, and the tags if asked, of many nodes with a
+        single call to CryptoEngine.decrypt_many and fill their caches.
+        If something can not be decrypted, the nodes are left to decrypt
+        their fields one by one.
+        """
+        jobs = []
+        for node in nodes:
+            if node.is_record:
+                jobs.append((node, None, node._username[len(RECORD_PREFIX):]))
+            else:
+                jobs.extend((node, f, getattr(node, '_' + f))
+                            for f in RECORD_FIELDS)
+            if tags:
+                node._cache['tags'] = []
+                jobs.extend((node, 'tags', t) for t in filter(None,
+                                                              node._tags))
+        enc = CryptoEngine.get()
+        try:
+            plain = enc.decrypt_many(job[-1] for job in jobs)
+        except Exception:
+            for node in nodes:
+                node.clear_cache()
+            return
+
+        for (node, name, _), value in zip(jobs, plain):
+            if name is None:
+                node._cache.update(json.loads(value))
+            elif name == 'tags':
+                node._cache['tags'].append(value)
+            else:
+                node._cache[name] = value.strip().decode()
+            enc.register_cache(node)
+
+    @property
+    def is_record(self):
+        """True if the fields of this node are stored as one record"""
+        return self._username.startswith(RECORD_PREFIX)
+
+    def clear_cache(self):
+        """drop the decrypted fields"""
+        self._cache.clear()
+
+    def _encode_record(self, fields):
+        enc = CryptoEngine.get()
+        self._username = RECORD_PREFIX + enc.encrypt(
+            json.dumps(fields)).strip()
+        self._password = self._url = self._notes = b''
+
+    def _cached(self, name, decrypt):
+        """
+        return the cached value of name, calling decrypt to fill the
+        cache on a miss
+        """
+        enc = CryptoEngine.get()
+        # drops the caches if the lock timed out since the last access
+        enc._is_timedout()
+        if name not in self._cache:
+            self._cache.update(decrypt(enc))
+            enc.register_cache(self)
+        return self._cache[name]
+
+    def _get_field(self, name):
+        if self.is_record:
+            return self._cached(name, lambda enc: json.loads(
+                enc.decrypt(self._username[len(RECORD_PREFIX):])))
+        return self._cached(name, lambda enc: {name: enc.decrypt(
+            getattr(self, '_' + name)).strip().decode()})
+
+    def _set_field(self, name, value):
+        if self.is_record:
+            fields = {f: self._get_field(f) for f in RECORD_FIELDS}
+            fields[name] = _text(value)
+            self._encode_record(fields)
+        else:
+            enc = CryptoEngine.get()
+            setattr(self, '_' + name, enc.encrypt(value).strip())
+        self.clear_cache()
+
     def __str__(self):
+        red = pwman.ui.tools.color('RED')
         tags = self.tags
         if tags:
             tags = ", ".join(t.decode() for t in tags)
@@ -46,19 +194,19 @@ class Node:
             tags = ""
 
         p = "{entry_title:>{width}} {entry:<{width}}\n".format(
-            entry_title=pwman.ui.tools.typeset('Username:', Fore.RED),
+            entry_title=pwman.ui.tools.typeset('Username:', red),
             width=10, entry=str(self.username))
         p += "{entry_title:>{width}} {entry:<{width}}\n".format(
-            entry_title=pwman.ui.tools.typeset('Password:', Fore.RED),
+            entry_title=pwman.ui.tools.typeset('Password:', red),
             width=10, entry=str(self.password))
         p += "{entry_title:>{width}} {entry:<{width}}\n".format(
-            entry_title=pwman.ui.tools.typeset('URL:', Fore.RED),
+            entry_title=pwman.ui.tools.typeset('URL:', red),
             width=10, entry=str(self.url))
         p += "{entry_title:>{width}} {entry:<{width}}\n".format(
-            entry_title=pwman.ui.tools.typeset('Notes:', Fore.RED),
+            entry_title=pwman.ui.tools.typeset('Notes:', red),
             width=10, entry=str(self.notes))
         p += "{entry_title:>{width}} {entry:<{width}}\n".format(
-            entry_title=pwman.ui.tools.typeset('Tags:', Fore.RED),
+            entry_title=pwman.ui.tools.typeset('Tags:', red),
             width=10,
             entry=tags)
         return p
@@ -118,68 +266,59 @@ class Node:
     @property
     def password(self):
         """Get the current password."""
-        enc = CryptoEngine.get()
-        p = enc.decrypt(self._password).strip()
-        return p.decode()
+        return self._get_field('password')
 
     @property
     def username(self):
         """Get the current username."""
-        enc = CryptoEngine.get()
-        u = enc.decrypt(self._username).strip()
-        return u.decode()
+        return self._get_field('username')
 
     @username.setter
     def username(self, value):
         """Set the username."""
-        enc = CryptoEngine.get()
-        self._username = enc.encrypt(value).strip()
+        self._set_field('username', value)
 
     @password.setter
     def password(self, value):
         """Set the Notes."""
-        enc = CryptoEngine.get()
-        self._password = enc.encrypt(value).strip()
+        self._set_field('password', value)
 
     @property
     def tags(self):
-        enc = CryptoEngine.get()
-        try:
-            return [enc.decrypt(tag) for tag in
-                    filter(None, self._tags)]
-        except Exception:
-            return [tag for tag in filter(None, self._tags)]
+        def decrypt(enc):
+            try:
+                return {'tags': [enc.decrypt(tag) for tag in
+                                 filter(None, self._tags)]}
+            except Exception:
+                return {'tags': [tag for tag in filter(None, self._tags)]}
+
+        return list(self._cached('tags', decrypt))
 
     @tags.setter
     def tags(self, value):
         enc = CryptoEngine.get()
         self._tags = [enc.encrypt(tag).strip() for tag in value]
+        self.clear_cache()
 
     @property
     def url(self):
         """Get the current url."""
-        enc = CryptoEngine.get()
-        u = enc.decrypt(self._url).strip()
-        return u.decode()
+        return self._get_field('url')
 
     @url.setter
     def url(self, value):
         """Set the Notes."""
-        enc = CryptoEngine.get()
-        self._url = enc.encrypt(value).strip()
+        self._set_field('url', value)
 
     @property
     def notes(self):
         """Get the current notes."""
-        enc = CryptoEngine.get()
-        n = enc.decrypt(self._notes).strip()
-        return n.decode()
+        return self._get_field('notes')
 
     @notes.setter
     def notes(self, value):
         """Set the Notes."""
-        enc = CryptoEngine.get()
-        self._notes = enc.encrypt(value).strip()
+        self._set_field('notes', value)
 
     @property
     def mdate(self):
@@ -0,0 +1,97 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+An inverted index of the words in the username, URL and notes of the
+nodes. The database keeps it encrypted as a single value, so it is
+decrypted once and searches do not decrypt any node.
+"""
+import json
+import re
+from collections import defaultdict
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(*texts):
+    """return the set of lower case words in texts"""
+    return {word.lower() for text in texts
+            for word in _WORD.findall(text or '')}
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        # the URL and the words of each node id, and the ids of each word
+        self._urls = {}
+        self._words = {}
+        self._postings = defaultdict(set)
+
+    def __len__(self):
+        return len(self._words)
+
+    def __contains__(self, nid):
+        return nid in self._words
+
+    def add(self, nid, username, url, notes):
+        """index a node, replacing what was indexed for it before"""
+        self.remove(nid)
+        self._urls[nid] = url
+        self._words[nid] = tokenize(username, url, notes)
+        for word in self._words[nid]:
+            self._postings[word].add(nid)
+
+    def remove(self, nid):
+        for word in self._words.pop(nid, ()):
+            self._postings[word].discard(nid)
+            if not self._postings[word]:
+                del self._postings[word]
+        self._urls.pop(nid, None)
+
+    def search(self, text):
+        """
+        return the sorted ids of the nodes which have a word starting
+        with each of the words in text
+        """
+        found = None
+        for prefix in tokenize(text):
+            ids = set()
+            for word, nids in self._postings.items():
+                if word.startswith(prefix):
+                    ids |= nids
+            found = ids if found is None else found & ids
+        return sorted(found or ())
+
+    def match_url(self, pattern):
+        """return the sorted ids of the nodes whose URL contains pattern"""
+        return sorted(nid for nid, url in self._urls.items() if pattern in url)
+
+    def dumps(self):
+        return json.dumps({nid: [self._urls[nid], sorted(words)]
+                           for nid, words in self._words.items()}).encode()
+
+    @classmethod
+    def loads(cls, data):
+        index = cls()
+        for nid, (url, words) in json.loads(data).items():
+            nid = int(nid)
+            index._urls[nid] = url
+            index._words[nid] = set(words)
+            for word in words:
+                index._postings[word].add(nid)
+        return index
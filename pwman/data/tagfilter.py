@@ -0,0 +1,103 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+Tag filters like ``prod AND db AND NOT legacy``, which the database
+drivers compile to a single query. The grammar is::
+
+    expr   := term (OR term)*
+    term   := factor ([AND] factor)*
+    factor := NOT factor | ( expr ) | tag
+
+Tags next to each other without an operator are joined with AND. The
+operators are only recognized in upper case, so a tag can be called
+``and``.
+
+A parsed filter is a tuple: ``('tag', b'name')``, ``('not', filter)``
+or ``('and', filter, filter, ...)`` and ``('or', ...)``.
+"""
+import re
+
+_TOKEN = re.compile(r'\(|\)|[^\s()]+')
+
+
+class TagFilterError(ValueError):
+    pass
+
+
+def parse(text):
+    """parse a tag filter, raise TagFilterError if it is not valid"""
+    tokens = _TOKEN.findall(text)
+    if not tokens:
+        raise TagFilterError("empty tag filter")
+    expr, pos = _parse_or(tokens, 0)
+    if pos < len(tokens):
+        raise TagFilterError("unexpected %r" % tokens[pos])
+    return expr
+
+
+def _join(op, items):
+    return items[0] if len(items) == 1 else (op,) + tuple(items)
+
+
+def _parse_or(tokens, pos):
+    items = []
+    while True:
+        item, pos = _parse_and(tokens, pos)
+        items.append(item)
+        if pos < len(tokens) and tokens[pos] == 'OR':
+            pos += 1
+        else:
+            return _join('or', items), pos
+
+
+def _parse_and(tokens, pos):
+    items = []
+    while True:
+        item, pos = _parse_factor(tokens, pos)
+        items.append(item)
+        if pos < len(tokens) and tokens[pos] == 'AND':
+            pos += 1
+        elif pos == len(tokens) or tokens[pos] in ('OR', ')'):
+            return _join('and', items), pos
+
+
+def _parse_factor(tokens, pos):
+    if pos == len(tokens):
+        raise TagFilterError("the tag filter ends too early")
+    token = tokens[pos]
+    if token == 'NOT':
+        item, pos = _parse_factor(tokens, pos + 1)
+        return ('not', item), pos
+    if token == '(':
+        item, pos = _parse_or(tokens, pos + 1)
+        if pos == len(tokens) or tokens[pos] != ')':
+            raise TagFilterError("missing )")
+        return item, pos + 1
+    if token in ('AND', 'OR', ')'):
+        raise TagFilterError("unexpected %r" % token)
+    return ('tag', token.encode()), pos + 1
+
+
+def tags(expr):
+    """yield the tags of a parsed filter"""
+    if expr[0] == 'tag':
+        yield expr[1]
+    else:
+        for item in expr[1:]:
+            yield from tags(item)
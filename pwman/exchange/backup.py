@@ -0,0 +1,192 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+A binary backup of a database. The cipher texts are copied as they are
+and nothing is decrypted, so a backup works with every driver and takes
+about as long as reading the database.
+
+The file starts with MAGIC and the format version as an unsigned short,
+followed by a gzip stream of records. A record is a type byte and the
+length of its payload as an unsigned int, big endian::
+
+    H  a JSON header, with the key of the database the cipher texts
+       were made with
+    T  a tag: its blind index and its cipher text
+    N  a node: the cipher texts of username, password, url and notes,
+       followed by the blind indexes of its tags
+    E  the end, with the number of nodes, so a cut off file is noticed
+
+The payloads of T and N records are byte strings, each prefixed by its
+length as an unsigned int.
+"""
+import gzip
+import json
+import struct
+import zlib
+from contextlib import contextmanager
+
+from pwman.data.database import __DB_FORMAT__
+from pwman.util.crypto_engine import CryptoEngine
+
+MAGIC = b'PWMANBAK'
+VERSION = 1
+
+_VERSION = struct.Struct('>H')
+_LENGTH = struct.Struct('>I')
+_RECORD = struct.Struct('>cI')
+
+
+class BackupError(Exception):
+    pass
+
+
+def _pack(fields):
+    return b''.join(_LENGTH.pack(len(f)) + f for f in fields)
+
+
+def _unpack(payload):
+    fields, pos = [], 0
+    while pos < len(payload):
+        length, = _LENGTH.unpack_from(payload, pos)
+        pos += _LENGTH.size
+        fields.append(payload[pos:pos + length])
+        pos += length
+    return fields
+
+
+def _bytes(value):
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+def _write(stream, kind, payload):
+    stream.write(_RECORD.pack(kind, len(payload)))
+    stream.write(payload)
+
+
+def _read_exact(stream, size):
+    try:
+        data = stream.read(size)
+    except (EOFError, zlib.error):
+        data = b''
+    if len(data) != size:
+        raise BackupError("The backup is cut off")
+    return data
+
+
+def _records(stream):
+    while True:
+        kind, length = _RECORD.unpack(_read_exact(stream, _RECORD.size))
+        yield kind, _read_exact(stream, length)
+
+
+def backup(db, filename):
+    """write a backup of db to filename, return the number of nodes"""
+    count, tags = 0, set()
+    with open(filename, 'wb') as fh:
+        fh.write(MAGIC + _VERSION.pack(VERSION))
+        with gzip.GzipFile(fileobj=fh, mode='wb', compresslevel=6) as out:
+            header = {'key': db.loadkey(), 'dbformat': str(__DB_FORMAT__)}
+            _write(out, b'H', json.dumps(header).encode())
+            for fields, node_tags in db.dump_nodes():
+                for tag, idx in node_tags:
+                    if idx not in tags:
+                        tags.add(idx)
+                        _write(out, b'T', _pack([idx.encode(), _bytes(tag)]))
+                _write(out, b'N', _pack([_bytes(f) for f in fields] +
+                                        [idx.encode() for _, idx in
+                                         node_tags]))
+                count += 1
+            _write(out, b'E', _LENGTH.pack(count))
+    return count
+
+
+def _entries(stream, records):
+    """yield the nodes of a backup as dump_nodes does"""
+    tags, count = {}, 0
+    for kind, payload in records:
+        if kind == b'T':
+            idx, tag = _unpack(payload)
+            tags[idx.decode()] = tag
+        elif kind == b'N':
+            fields = _unpack(payload)
+            count += 1
+            yield fields[:4], [(tags[idx.decode()], idx.decode())
+                               for idx in fields[4:]]
+        elif kind == b'E':
+            if _LENGTH.unpack(payload)[0] != count:
+                raise BackupError("The backup is incomplete")
+            # reading to the end checks the CRC of the gzip stream
+            try:
+                rest = stream.read()
+            except (EOFError, zlib.error, OSError):
+                raise BackupError("The backup is damaged")
+            if rest:
+                raise BackupError("The backup has data after its end")
+            return
+        else:
+            raise BackupError("Unknown record {!r}".format(kind))
+
+
+@contextmanager
+def _open_backup(filename):
+    """yield the header and the nodes of a backup"""
+    with open(filename, 'rb') as fh:
+        head = fh.read(len(MAGIC) + _VERSION.size)
+        if len(head) < len(MAGIC) + _VERSION.size or \
+                not head.startswith(MAGIC):
+            raise BackupError("{} is not a pwman backup".format(filename))
+        version, = _VERSION.unpack(head[len(MAGIC):])
+        if version > VERSION:
+            raise BackupError("The backup format {} is newer than this "
+                              "pwman3 supports".format(version))
+        with gzip.GzipFile(fileobj=fh, mode='rb') as stream:
+            records = _records(stream)
+            kind, payload = next(records)
+            if kind != b'H':
+                raise BackupError("The backup has no header")
+            yield json.loads(payload), _entries(stream, records)
+
+
+def restore(db, filename, batch_size=1000):
+    """
+    Add the nodes of a backup to db, and return how many were added. A
+    database without a key gets the key of the backup. The cipher texts
+    can not be read with another key, so a database with a different
+    key is refused.
+
+    The backup is read through once before anything is written, so a
+    broken one leaves the database as it was, and the nodes are written
+    in one transaction.
+    """
+    with _open_backup(filename) as (header, entries):
+        for _ in entries:
+            pass
+
+    with _open_backup(filename) as (header, entries):
+        key, backup_key = db.loadkey(), header['key']
+        if backup_key and key is not None and key != backup_key:
+            raise BackupError("The backup was made with another master "
+                              "password than this database has")
+        with db.transaction():
+            if backup_key and key is None:
+                db.savekey(backup_key)
+            count = db.load_nodes(entries, batch_size)
+    if backup_key and key is None:
+        CryptoEngine.get().set_salt_digest(backup_key)
+    return count
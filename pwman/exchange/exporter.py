@@ -0,0 +1,119 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+'''
+A module to hold the exporter classes
+'''
+import csv
+import json
+import sys
+import time
+
+
+class BaseExporter(object):
+
+    """
+    The base class of the exporters, which write one node at a time to
+    an open file, so the memory used does not grow with the database.
+    """
+
+    def __init__(self, fh, **options):
+        self.fh = fh
+        self.options = options
+
+    def start(self):
+        pass
+
+    def write(self, node):  # pragma: no cover
+        raise NotImplementedError
+
+    @staticmethod
+    def _tags(node):
+        return [t.strip().decode() for t in node.tags]
+
+
+class CSVExporter(BaseExporter):
+
+    """Write the nodes in the CSV format which the CSVImporter reads"""
+
+    def start(self):
+        self.writer = csv.writer(self.fh,
+                                 delimiter=self.options.get('delimiter', ';'))
+        self.writer.writerow(['Username', 'URL', 'Password', 'Notes',
+                              'Tags'])
+
+    def write(self, node):
+        self.writer.writerow([node.username, node.url, node.password,
+                              node.notes, ','.join(self._tags(node))])
+
+
+class JSONLinesExporter(BaseExporter):
+
+    """Write every node as a JSON object on a line of its own"""
+
+    def write(self, node):
+        self.fh.write(json.dumps({'username': node.username,
+                                  'url': node.url,
+                                  'password': node.password,
+                                  'notes': node.notes,
+                                  'tags': self._tags(node)}) + '\n')
+
+
+FORMATS = {'csv': CSVExporter, 'jsonl': JSONLinesExporter}
+
+
+class Exporter(object):
+
+    """
+    Export nodes to a file. The format is given, or taken from the
+    extension of the file name. nodes is an iterable, which should read
+    and decrypt the nodes in batches, like BaseCommands._iter_nodes.
+    """
+
+    def __init__(self, filename, format=None, report_every=1000, **options):
+        self.filename = filename
+        if format is None:
+            format = filename.rpartition('.')[-1].lower()
+            format = format if format in FORMATS else 'csv'
+        if format not in FORMATS:
+            raise ValueError("Unknown export format {}, use one of {}".format(
+                format, ', '.join(sorted(FORMATS))))
+        self.invoke = FORMATS[format]
+        self.report_every = report_every
+        self.options = options
+
+    def _report(self, count, started):
+        rate = count / max(time.time() - started, 1e-6)
+        print("\rExported {} nodes ({:.0f} nodes/s)".format(count, rate),
+              end="")
+        sys.stdout.flush()
+
+    def run(self, nodes):
+        """write the nodes and return how many were written"""
+        count, started = 0, time.time()
+        with open(self.filename, 'w', newline='') as fh:
+            exporter = self.invoke(fh, **self.options)
+            exporter.start()
+            for node in nodes:
+                exporter.write(node)
+                count += 1
+                if not count % self.report_every:
+                    self._report(count, started)
+        self._report(count, started)
+        print("")
+        return count
@@ -21,6 +21,10 @@ A module to hold the importer class
 '''
 import csv
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 from pwman.data.nodes import Node
 from pwman.util.crypto_engine import CryptoEngine
 from pwman.ui.tools import CLICallback
@@ -41,43 +45,70 @@ class CSVImporter(BaseImporter):
 
     """
     A reference implementation which imports a CSV to the pwman database
+
+    The file is read lazily and imported in batches of ``batch_size``
+    rows. The fields of a whole batch are encrypted with a single call
+    to CryptoEngine.encrypt_many, in the background while the previous
+    batch is written to the database.
     """
     def __init__(self, args, config, db):
         self.args = args
         self.config = config
         self._db = db
+        self.batch_size = getattr(args, 'batch_size', None) or 1000
 
     def _read_file(self):
-        """read the csv file, remove empty lines and the header"""
+        """yield the rows of the csv file, skip empty lines and the header"""
         try:
             fh, delim = open(self.args.file_delim[0]), self.args.file_delim[1]
-            csv_f = csv.reader(fh, delimiter=delim)
         except FileNotFoundError:
             fh, delim = open(self.args.file_delim[1]), self.args.file_delim[0]
-            csv_f = csv.reader(fh, delimiter=delim)
-
-        lines = [line for line in csv_f]
-        lines = list(filter(None, lines))
-        fh.close()
-        return lines[1:]
 
-    def _create_node(self, row):
-        """create a node object with encrypted properties"""
+        with fh:
+            rows = filter(None, csv.reader(fh, delimiter=delim))
+            next(rows, None)
+            yield from rows
+
+    def _batches(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def _row_to_entry(self, row):
+        """map a csv row to the clear text fields of a node"""
         try:
-            n = {'clear_text': True,
-                 'username': row[0], 'password': row[2], 'url': row[1],
-                 'notes': row[3],
-                 'tags': row[4].split(',')}
-            node = Node(**n)
+            return {'username': row[0], 'password': row[2], 'url': row[1],
+                    'notes': row[3],
+                    'tags': row[4].split(',')}
         except IndexError as err:
             print('{}\nDid you specify the correct delimiter?'.format(err))
             sys.exit(1)
-        return node
+
+    def _create_node(self, row):
+        """create a node object with encrypted properties"""
+        return Node(clear_text=True, **self._row_to_entry(row))
+
+    def _create_nodes(self, rows):
+        """create node objects for a batch of rows"""
+        return Node.many(self._row_to_entry(row) for row in rows)
 
     def _insert_node(self, node):
         "insert the node object to the database"
         self._db.add_node(node)
 
+    def _insert_nodes(self, nodes):
+        "insert a batch of node objects to the database"
+        return len(self._db.add_nodes(nodes, self.batch_size))
+
+    def _report(self, count, started):
+        rate = count / max(time.time() - started, 1e-6)
+        print("\rImported {} nodes ({:.0f} nodes/s)".format(count, rate),
+              end="")
+        sys.stdout.flush()
+
     def _open_db(self):
         """
         open existing db or create a new db
@@ -87,7 +118,6 @@ class CSVImporter(BaseImporter):
         """
         self._db._open()
         self._db._create_tables()
-        self._db._con.commit()
         self._db.open()
 
     def run(self, callback=CLICallback):
@@ -95,10 +125,22 @@ class CSVImporter(BaseImporter):
         enc = CryptoEngine.get()
         enc.callback = callback()
         self._open_db()
-
-        for row in self._read_file():
-            node = self._create_node(row)
-            self._insert_node(node)
+        # make sure the password is asked here and not in a worker thread
+        enc.encrypt("")
+
+        count, started = 0, time.time()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = None
+            for batch in self._batches(self._read_file()):
+                nodes = pool.submit(self._create_nodes, batch)
+                if pending is not None:
+                    count += self._insert_nodes(pending.result())
+                    self._report(count, started)
+                pending = nodes
+            if pending is not None:
+                count += self._insert_nodes(pending.result())
+                self._report(count, started)
+        print("")
 
         self._db.close()
 
@@ -17,7 +17,6 @@
 # Copyright (C) 2013-2017 Oz Nahum Tiram <oz.tiram@gmail.com>
 # ============================================================================
 import ast
-import csv
 import datetime
 import os
 import re
@@ -25,11 +24,12 @@ import select as uselect
 import shutil
 import sys
 import time
+from itertools import islice
 
-from colorama import Fore
+from pwman.data import tagfilter
 from pwman.data.nodes import Node
 from pwman.ui import tools
-from pwman.util.crypto_engine import CryptoEngine
+from pwman.util.crypto_engine import CryptoEngine, CryptoException
 from pwman.util.crypto_engine import zerome
 from pwman.ui.tools import CliMenuItem
 from pwman.ui.tools import CMDLoop, get_or_create_pass
@@ -78,11 +78,30 @@ class HelpUIMixin:  # pragma: no cover
         print("Clear the Screen from information.")
 
     def help_list(self):
-        self._usage("list|ls|l [[u:<url>] [<tag>]] ...")
+        self._usage("list|ls|l [--page-size N] [[u:<url>] [<tags>]] ...")
         print("List nodes that match current or specified filter.")
         print("You can also limit the search by a url prefixed ",
               "with `u`.\nFor example `ls u:example.com work`.",
               "\nl or ls are aliases.")
+        print("Tags can be combined with AND, OR, NOT and parentheses,",
+              "e.g. `ls prod AND (db OR web) AND NOT legacy`. Tags",
+              "without an operator between them must all match.")
+        print("With --page-size only N nodes are listed at a time.",
+              "Use `next` and `prev` to move between the pages.")
+
+    def help_search(self):
+        self._usage("search <word> ...")
+        print("List nodes with words in their username, URL or notes,",
+              "which start with all the given words. For example",
+              "`search exam` finds a node with the URL example.com.")
+
+    def help_next(self):
+        self._usage("next")
+        print("Lists the next page of `list --page-size N`.")
+
+    def help_prev(self):
+        self._usage("prev")
+        print("Lists the previous page of `list --page-size N`.")
 
     def help_delete(self):
         self._usage("delete|rm <ID|tag> ...")
@@ -98,8 +117,11 @@ class HelpUIMixin:  # pragma: no cover
         print("Edits a nodes.")
 
     def help_export(self):
-        self._usage("export [{'filename': 'foo.csv', 'delimiter':'|'}] ")
+        self._usage("export [{'filename': 'foo.csv', 'delimiter':'|', "
+                    "'format': 'csv', 'filter': 'prod AND NOT legacy'}] ")
         print("All nodes under the current filter are exported.")
+        print("The format is csv or jsonl, by default it is taken from",
+              "the extension of the file name.")
 
     def help_new(self):
         self._usage("new")
@@ -125,9 +147,11 @@ class HelpUIMixin:  # pragma: no cover
         print("Exits the application.")
 
     def help_passwd(self):
-        self._usage("passwd")
-        print("Changes the password on the database. (Not implemented!)")
-        print("To change the password, export and re-import the database.")
+        self._usage("passwd [--rotate]")
+        print("Changes the master password of the database. The nodes are",
+              "encrypted with a random data key, which is only wrapped with",
+              "the new password. --rotate makes a new data key instead, and",
+              "re-encrypts every node with it, in one transaction.")
 
     def help_forget(self):
         self._usage("forget")
@@ -141,6 +165,21 @@ class HelpUIMixin:  # pragma: no cover
     def help_info(self):
         print("Show information about the current database.")
 
+    def help_backup(self):
+        self._usage("backup <filename>")
+        print("Writes the encrypted nodes to a compressed binary file.",
+              "Nothing is decrypted, so it is fast for any size.")
+
+    def help_restore(self):
+        self._usage("restore <filename>")
+        print("Adds the nodes of a backup to the database. The backup must",
+              "be of a database with the same master password.")
+
+    def help_vacuum(self):
+        self._usage("vacuum")
+        print("Deletes the tags which no node uses any more. Tags which",
+              "lose a node are checked when pwman exits, this checks all.")
+
 
 class AliasesMixin:  # pragma: no cover
 
@@ -259,25 +298,23 @@ class BaseUtilsMixin:
                                 node_url,
                                 tagstring,
                                 node.mdate)
-        formatted_entry = tools.typeset(fmt, Fore.YELLOW, False)
+        formatted_entry = tools.typeset(fmt, tools.color('YELLOW'), False)
         print(formatted_entry)
 
+    def _parse_filter(self, args):
+        """
+        parse a tag filter like `prod AND db AND NOT legacy`, raises
+        TagFilterError if it is not valid
+        """
+        if not args.strip():
+            return None
+        return tagfilter.parse(args)
+
     def _get_node_ids(self, args):
-        filter = None
-        if args:
-            filter = args.split()[0]
-            ce = CryptoEngine.get()
-            filter = ce.encrypt(filter)
-        return self._db.listnodes(filter=filter)
+        return list(self._lazy_get_node_ids(args))
 
     def _lazy_get_node_ids(self, args):
-        filter = None
-        if args:
-            filter = args.split()[0]
-            ce = CryptoEngine.get()
-            filter = ce.encrypt(filter)
-        for node_id in self._db.lazy_list_node_ids(filter=filter):
-            yield node_id
+        return self._db.lazy_list_node_ids(filter=self._parse_filter(args))
 
     def _db_entry_to_node(self, raw_node, tags):
         # user, pass, url, notes
@@ -299,6 +336,20 @@ class BaseUtilsMixin:
         node_inst._id = raw_node[0]
         return node_inst
 
+    def _iter_nodes(self, ids, tags=True):
+        """
+        yield a Node for each id. The nodes are read in batches, and the
+        fields of each batch are decrypted together by Node.prefetch.
+        """
+        pairs = self._db.getnodes(ids)
+        while True:
+            batch = [self._db_entry_to_node(node, node_tags) for
+                     node, node_tags in islice(pairs, self._db.fetch_size)]
+            if not batch:
+                return
+            Node.prefetch(batch, tags=tags)
+            yield from batch
+
     def _get_input(self, prompt):
         print(prompt, end="")
         sys.stdout.flush()
@@ -324,8 +375,9 @@ class BaseUtilsMixin:
         return node
 
     def _do_rm(self, nodes):
-        for i in nodes:
-            self._db.removenodes([i])
+        with self._db.transaction():
+            for i in nodes:
+                self._db.removenodes([i])
 
     def _get_node(self, nodeid):
         if not nodeid.isdigit():
@@ -342,6 +394,9 @@ class BaseUtilsMixin:
 
 class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
 
+    # the state of `list --page-size N`, used by next and prev
+    _pager = None
+
     @property
     def _xsel(self):  # pragma: no cover
         if self.hasxsel:
@@ -368,20 +423,16 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
 
         if m:
             url_filter, args = m.groups()
-            ids = self._db.lazy_list_node_ids()
+            ids = self._db.search_index().match_url(url_filter)
         else:
             ids = args.split()
             if len(ids) > 1:
                 print("Can copy only 1 password at a time...")
                 return
 
-        nodes = self._db.getnodes(ids)
-
-        ce = CryptoEngine.get()
-        for node in nodes:
-            if ce.decrypt(node[3]).find(url_filter.encode()) != -1:
-                password = ce.decrypt(node[2])
-                tools.text_to_clipboards(password)
+        for node in self._iter_nodes(ids, tags=False):
+            if node.url.find(url_filter) != -1:
+                tools.text_to_clipboards(node.password.encode())
                 flushtimeout = self.config.get_value('Global', 'cp_timeout')
                 flushtimeout = flushtimeout or 10
                 print("erasing in {} sec...".format(flushtimeout))
@@ -392,10 +443,8 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
             self.help_open()
             return
 
-        nodes = self._db.getnodes(ids)
-        ce = CryptoEngine.get()
-        for node in nodes:
-            url = ce.decrypt(node[3]).decode()
+        for node, tags in self._db.getnodes(ids):
+            url = self._db_entry_to_node(node, tags).url
             if not url.startswith(("http://", "https://")):
                 url = "https://" + url
             if url:
@@ -419,37 +468,47 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
         except Exception:
             args = {}
 
+        from pwman.exchange.exporter import Exporter
+
         filename = args.get('filename', 'pwman-export.csv')
-        delim = args.get('delimiter', ';')
-
-        node_ids = list(self._db.lazy_list_node_ids())
-        nodes_tags_pairs = list(self._db.getnodes(node_ids))
-
-        with open(filename, 'w') as csvfile:
-            writer = csv.writer(csvfile, delimiter=delim)
-            writer.writerow(['Username', 'URL', 'Password', 'Notes',
-                             'Tags'])
-            for node_tags in nodes_tags_pairs:
-                node = node_tags[0]
-                tags = node_tags[1]
-                n = Node.from_encrypted_entries(username=node[1],
-                                                password=node[2],
-                                                url=node[3],
-                                                notes=node[4],
-                                                tags=tags,
-                                                mdate="")
-                tags = n.tags
-                tags = ','.join(t.strip().decode() for t in tags)
-                r = list([n.username, n.url, n.password, n.notes])
-                writer.writerow(r + [tags])
-
-        with open(filename) as f:
-            for line in f.readlines():
-                print(line)
+        try:
+            filter = self._parse_filter(args.get('filter', ''))
+            exporter = Exporter(filename, format=args.get('format'),
+                                delimiter=args.get('delimiter', ';'))
+        except ValueError as e:
+            print(e)
+            return
 
+        exporter.run(self._iter_nodes(
+            self._db.lazy_list_node_ids(filter=filter)))
         print("Successfuly exported database to {}".format(
             os.path.join(os.getcwd(), filename)))
 
+    def do_backup(self, args):
+        """write a binary backup of the database"""
+        from pwman.exchange.backup import BackupError, backup
+        filename = args.strip() or 'pwman.bak'
+        try:
+            count = backup(self._db, filename)
+        except (BackupError, OSError) as e:
+            print(e)
+            return
+        print("Backed up {} nodes to {}".format(
+            count, os.path.join(os.getcwd(), filename)))
+
+    def do_restore(self, args):
+        """add the nodes of a binary backup to the database"""
+        from pwman.exchange.backup import BackupError, restore
+        if not args.strip():
+            self.help_restore()
+            return
+        try:
+            count = restore(self._db, args.strip())
+        except (BackupError, OSError) as e:
+            print(e)
+            return
+        print("Restored {} nodes".format(count))
+
     def do_forget(self, args):
         """
         drop saved key forcing the user to re-enter the master
@@ -471,28 +530,54 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
             print(f"Automatic lock at: {lock.strftime('%Y-%m-%d %H:%M:%S')}.")
 
     def do_passwd(self, args):  # pragma: no cover
-        """change the master password of the database"""
-        """old_enc = CryptoEngine.get()
-        CryptoEngine._instance = None
-        new_enc = CryptoEngine.get()
+        """change the master password, or rotate the data key"""
+        from pwman.util.agent import key_changed
+        enc = CryptoEngine.get()
+        if args.strip() != '--rotate':
+            try:
+                key = enc.changepassword()
+            except CryptoException as e:
+                print(e)
+                return
+            self._db.savekey(key)
+            key_changed(enc)
+            print("Changed the master password")
+            return
 
-        TODO: backup tables: NODE, TAG, CRYPTO, LOOKUP
-        TODO: create new tables
-        TODO: Iterate on old entries, create new entries with new crypto
-        TODO: If no errors encountered remove backup tables.
+        recrypter = enc.rekey(self._db.pending_key())
+        started = time.time()
 
-        TODO: expand list nodes to accept table name
-        """
+        def progress(count):
+            rate = count / max(time.time() - started, 1e-6)
+            print("\rRe-encrypted {} nodes ({:.0f} nodes/s)".format(
+                count, rate), end="")
+            sys.stdout.flush()
+
+        count = self._db.reencrypt(recrypter, progress)
+        enc.switch_key(recrypter)
+        key_changed(enc)
+        print("\nRotated the data key, {} nodes were re-encrypted".format(
+            count))
 
     def do_tags(self, args):
         """
         print all existing tags
         """
-        ce = CryptoEngine.get()
         print("Tags:")
-        tags = self._db.listtags()
-        for t in tags:
-            print(ce.decrypt(t).decode())
+        for t in self._db.tag_names():
+            print(t)
+
+    def complete_list(self, text, line, begidx, endidx):
+        """complete the names of tags, if the database is unlocked"""
+        enc = CryptoEngine.get()
+        if enc.is_locked():
+            return []
+        with enc.idle():
+            names = self._db.tag_names()
+        return [word for word in names + ['AND', 'OR', 'NOT']
+                if word.startswith(text)]
+
+    complete_l = complete_ls = complete_list
 
     def do_edit(self, args, menu=None):
         ids = self._get_ids(args)
@@ -522,19 +607,92 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
         """
         list all existing nodes in database
         """
-        rows, cols = self._prep_term()
+        page_size = 0
+        m = re.search(r'--page-size[ =](\d+) ?', args)
+        if m:
+            page_size = int(m.group(1))
+            args = args[:m.start()] + args[m.end():]
+
         url_filter = ""
         m = re.search('^u:([^ ]+) ?(.*)$', args)
 
         if m:
             url_filter, args = m.groups()
 
-        nodeids_gen = self._lazy_get_node_ids(args)
+        try:
+            filter = self._parse_filter(args)
+        except tagfilter.TagFilterError as e:
+            print("Invalid tag filter: {}".format(e))
+            return
+
+        if page_size:
+            self._pager = {'size': page_size, 'filter': filter,
+                           'url_filter': url_filter, 'first': None,
+                           'last': None}
+            self._list_page()
+            return
+
+        rows, cols = self._prep_term()
+        nodeids_gen = self._db.lazy_list_node_ids(filter=filter)
+        if url_filter:
+            urls = set(self._db.search_index().match_url(url_filter))
+            nodeids_gen = (nid for nid in nodeids_gen if nid in urls)
+        head = self._format_line(cols - 32)
+        print(tools.typeset(head, tools.color('YELLOW'), False))
+        for node in self._iter_nodes(nodeids_gen):
+            self._print_node_line(node, rows, cols, url_filter)
+
+    def _list_page(self, after=None, before=None):
+        """
+        list a page of ``list --page-size N``. Only the nodes on the page
+        are read and decrypted.
+        """
+        pager = self._pager
+        ids = self._db.list_node_ids_page(pager['size'], after=after,
+                                          before=before,
+                                          filter=pager['filter'])
+        if not ids:
+            print("No more nodes ...")
+            return
+
+        pager['first'], pager['last'] = ids[0], ids[-1]
+        rows, cols = self._prep_term()
         head = self._format_line(cols - 32)
-        print(tools.typeset(head, Fore.YELLOW, False))
-        for node, tags in self._db.getnodes(nodeids_gen):
-            self._print_node_line(self._db_entry_to_node(node, tags), rows, cols,
-                                  url_filter)
+        print(tools.typeset(head, tools.color('YELLOW'), False))
+        for node in self._iter_nodes(ids):
+            self._print_node_line(node, rows, cols, pager['url_filter'])
+        print("Nodes {}-{}, `next` or `prev` to list more".format(
+            ids[0], ids[-1]))
+
+    def do_next(self, args):
+        """list the next page of list --page-size N"""
+        if not self._pager:
+            print("Start with `list --page-size N` ...")
+            return
+        self._list_page(after=self._pager['last'])
+
+    def do_prev(self, args):
+        """list the previous page of list --page-size N"""
+        if not self._pager:
+            print("Start with `list --page-size N` ...")
+            return
+        self._list_page(before=self._pager['first'])
+
+    def do_search(self, args):
+        """
+        list the nodes which have words in their username, URL or notes
+        starting with each of the given words
+        """
+        if not args.strip():
+            self.help_search()
+            return
+
+        ids = self._db.search_index().search(args)
+        rows, cols = self._prep_term()
+        head = self._format_line(cols - 32)
+        print(tools.typeset(head, tools.color('YELLOW'), False))
+        for node in self._iter_nodes(ids):
+            self._print_node_line(node, rows, cols, "")
 
     def do_new(self, args):  # pragma: no cover
         # The cmd module stops if any of do_* return something
@@ -580,6 +738,10 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
         if ans.lower() == 'y':
             self._do_rm(ids)
 
+    def do_vacuum(self, args):
+        """delete all the tags which no node uses"""
+        print("Deleted {} unused tags".format(self._db.vacuum()))
+
     def do_info(self, args):
         print("Currently connected to: {}".format(
               self.config.get_value("Database", "dburi")))
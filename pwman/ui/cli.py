@@ -30,12 +30,12 @@ except ImportError as e:  # pragma: no cover
     _readline_available = True
 
 from pwman.ui.baseui import BaseCommands
-from pwman import (get_conf_options, get_db_version, version, website,
-                   parser_options, has_cryptography, calculate_client_info,
-                   is_latest_version)
+from pwman import (get_conf_options, version, website, parser_options,
+                   has_cryptography, calculate_client_info,
+                   is_latest_version, start_version_check)
 from pwman.ui.tools import CLICallback
 from pwman.data import factory
-from pwman.exchange.importer import Importer
+from pwman.data.nodes import Node
 from pwman.util.crypto_engine import CryptoEngine
 
 
@@ -89,8 +89,16 @@ def get_ui_platform(platform):  # pragma: no cover
     return PwmanCli, OSX
 
 
-def check_version(version, client_info):
-    _, latest = is_latest_version(version, client_info)
+def check_version(version, client_info, background=False):
+    """
+    Tell the user if a newer version was released. In the background,
+    the result of the last check is used while the next check runs in a
+    thread, so the start up does not wait for the network.
+    """
+    if background:
+        latest, _ = start_version_check(version, client_info)
+    else:
+        _, latest = is_latest_version(version, client_info)
     if not latest:
         print("A newer version of Pwman3 was released, you should consider updating")  # noqa
     return latest
@@ -124,16 +132,84 @@ def main():  # pragma: no cover
 
     elif config.get_value('Updater',
                           'supress_version_check').lower() != 'yes':
-        check_version(version, client_info)
+        check_version(version, client_info, background=True)
 
     print(dburi)
-    dbver = get_db_version(config, args)
     timeout = int(config.get_value('Global', 'lock_timeout'))
-    CryptoEngine.get(timeout)
+    enc = CryptoEngine.get(timeout)
+    enc.workers = int(
+        config.get_value('Crypto', 'workers').split('#')[0].strip() or 0)
+    enc.kdf = config.get_value('Crypto', 'kdf').split('#')[0].strip() or \
+        enc.kdf
+    enc.kdf_time = float(
+        config.get_value('Crypto', 'kdf_time').split('#')[0].strip() or 0)
+
+    db = factory.createdb(dburi)
+    db.stream_size = int(config.get_value(
+        'Database', 'stream_size').split('#')[0].strip() or db.stream_size)
+    Node.record = config.get_value(
+        'Crypto', 'record_format').split('#')[0].strip().lower() == 'yes'
+
+    if args.cmd == "convert":
+        from pwman.data.convertdb import RecordConverter
+        RecordConverter(db).run()
+        config.set_value('Crypto', 'record_format', 'yes')
+        config.save()
+        sys.exit(0)
+
+    if args.cmd == "migrate":
+        from pwman.data.convertdb import DBMigrator, MigrationError
+        source = factory.createdb(args.source) if args.source else db
+        target = factory.createdb(args.target)
+        try:
+            DBMigrator(source, target).run()
+        except MigrationError as e:
+            print(e)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.cmd in ("backup", "restore"):
+        from pwman.exchange.backup import BackupError, backup, restore
+        # the cipher texts are copied as they are, so no password is asked
+        # unless an old database has to be migrated first
+        db._open_migrated()
+        try:
+            if args.cmd == "backup":
+                print("Backed up %d nodes" % backup(db, args.file))
+            else:
+                print("Restored %d nodes" % restore(db, args.file))
+        except (BackupError, OSError) as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            db.close()
+        sys.exit(0)
+
+    if args.cmd == "agent":
+        from pwman.util.agent import Agent, socket_path
+        enc.callback = CLICallback()
+        db.open()
+        enc._auth()
+        try:
+            server = Agent(socket_path(), enc)
+        except OSError as e:
+            print(e)
+            sys.exit(1)
+        print("pwman3 agent listening on %s" % server.path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        sys.exit(0)
 
-    db = factory.createdb(dburi, dbver)
+    if args.cmd in ("p", "cp"):
+        from pwman.util.agent import AgentClient, socket_path
+        enc.agent = AgentClient(socket_path())
 
     if args.file_delim:
+        from pwman.exchange.importer import Importer
         importer = Importer((args, config, db))
         importer.run()
         sys.exit(0)
@@ -25,7 +25,6 @@ import time
 # all mac os  related classes
 from pwman.ui.cli import PwmanCli
 from pwman.ui import tools
-from pwman.util.crypto_engine import CryptoEngine
 
 # pylint: disable=R0904
 
@@ -41,10 +40,9 @@ class PwmanCliMac(PwmanCli):
             return None
 
         nodes = self._db.getnodes(ids)
-        ce = CryptoEngine.get()
 
-        for node in nodes:
-            password = ce.decrypt(node[2])
+        for node, tags in nodes:
+            password = self._db_entry_to_node(node, tags).password.encode()
             tools.text_to_mcclipboard(password)
             flushtimeout = self.config.get_value('Global', 'cp_timeout')
             flushtimeout = flushtimeout or 10
@@ -26,8 +26,6 @@ import subprocess as sp
 import getpass
 import sys
 
-import colorama
-
 from pwman.util.callback import Callback
 from pwman.util.crypto_engine import generate_password
 
@@ -59,11 +57,18 @@ class ANSI(enum.Enum):
     Underscore = 2
 
 
+def color(name):
+    """return the colorama foreground color name"""
+    import colorama
+    return getattr(colorama.Fore, name)
+
+
 def typeset(text, color, bold=False, underline=False,
             has_colorama=True):  # pragma: no cover
     """
     print colored strings using colorama
     """
+    import colorama
     if not has_colorama:
         return text
     if bold:
@@ -35,7 +35,6 @@ except ImportError:
 import colorama
 
 from pwman.ui.cli import PwmanCli
-from pwman.util.crypto_engine import CryptoEngine
 
 
 colorama.init()
@@ -111,11 +110,10 @@ class PwmanCliWin(PwmanCli):
             print("Can copy only 1 password at a time...")
             return None
 
-        ce = CryptoEngine.get()
         nodes = self._db.getnodes(ids)
 
-        for node in nodes:
-            password = ce.decrypt(node[2])
+        for node, tags in nodes:
+            password = self._db_entry_to_node(node, tags).password.encode()
             winSetClipboard(password)
             flushtimeout = self.config.get_value('Global', 'cp_timeout')
             flushtimeout = flushtimeout or 10
@@ -0,0 +1,209 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+A key agent, which keeps the key of an unlocked database in memory and
+hands it over a Unix socket to one shot commands like ``pwman3 p``, so
+they do not have to ask for the password and derive the key again.
+
+The protocol is one JSON object per line and connection::
+
+    {"cmd": "get", "key_id": "<salt$6$digest>"} -> {"key": "..."}
+    {"cmd": "put", "key_id": "...", "key": "..."} -> {"ok": true}
+    {"cmd": "forget"} -> {"ok": true}
+
+The key is only handed out for the database it belongs to, and only
+until the lock timeout of the agent's CryptoEngine expires. An agent
+without a key takes the key of another database, which is how it
+follows a change of the master password, see key_changed.
+
+The socket lives in a directory which must belong to the user and have
+the mode 0700, and both ends check that the process at the other end
+of a connection runs as the same user (where SO_PEERCRED is available).
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import time
+
+_PEERCRED = struct.Struct('3i')
+
+
+def socket_path():
+    """
+    The path of the agent socket, PWMAN_AGENT_SOCK if it is set, else a
+    file in a private directory under XDG_RUNTIME_DIR or the temp dir.
+    """
+    path = os.getenv("PWMAN_AGENT_SOCK")
+    if path:
+        return path
+    rundir = os.getenv("XDG_RUNTIME_DIR")
+    if rundir:
+        return os.path.join(rundir, "pwman", "agent.sock")
+    return os.path.join(tempfile.gettempdir(), "pwman-%d" % os.getuid(),
+                        "agent.sock")
+
+
+def check_rundir(rundir):
+    """
+    raise PermissionError unless rundir is a directory, not a link, which
+    belongs to the user and which nobody else can enter
+    """
+    st = os.lstat(rundir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError("{} must be a directory of the user with "
+                              "the mode 0700".format(rundir))
+
+
+def peer_uid(sock):
+    """
+    return the uid of the process at the other end of the Unix socket
+    sock, or None where the platform does not tell
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            _PEERCRED.size)
+    return _PEERCRED.unpack(creds)[1]
+
+
+def _same_user(sock):
+    uid = peer_uid(sock)
+    return uid is None or uid == os.getuid()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.dispatch(request)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            response = {'error': 'bad request'}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class Agent(socketserver.UnixStreamServer):
+
+    """
+    Serve the key of the CryptoEngine enc on the Unix socket path.
+    The key is forgotten when the lock timeout of enc expires.
+    """
+
+    def __init__(self, path, enc):
+        self.path = path
+        self.enc = enc
+        rundir = os.path.dirname(path)
+        os.makedirs(rundir, mode=0o700, exist_ok=True)
+        check_rundir(rundir)
+        if os.path.exists(path):
+            os.remove(path)
+        umask = os.umask(0o177)
+        try:
+            super(Agent, self).__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def verify_request(self, request, client_address):
+        return _same_user(request)
+
+    def _key_id(self):
+        return self.enc.get_salt_digest()
+
+    def dispatch(self, request):
+        enc = self.enc
+        if request['cmd'] == 'get':
+            if request['key_id'] != self._key_id() or enc._key is None or \
+                    enc._is_timedout():
+                return {'key': None}
+            return {'key': enc._key.decode()}
+        if request['cmd'] == 'put':
+            key_id = self._key_id()
+            if request['key_id'] != key_id:
+                if not enc.is_locked():
+                    return {'ok': False}
+                enc.set_salt_digest(request['key_id'])
+            ok = enc._unlock(request['key'].encode())
+            if not ok:
+                enc.set_salt_digest(key_id)
+            return {'ok': ok}
+        if request['cmd'] == 'forget':
+            enc.forget()
+            return {'ok': True}
+        return {'error': 'unknown command'}
+
+    def service_actions(self):
+        # unlike enc._is_timedout this does not extend the lock
+        if self.enc._timeout > 0 and time.time() > self.enc._expires_at:
+            self.enc.forget()
+
+    def server_close(self):
+        super(Agent, self).server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AgentClient(object):
+
+    """
+    Talk to an agent, every failure to reach it is the same as an agent
+    which does not have the key. So is an agent in a directory which is
+    not private, or one which runs as another user.
+    """
+
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+
+    def _request(self, **request):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                check_rundir(os.path.dirname(self.path))
+                sock.connect(self.path)
+                if not _same_user(sock):
+                    return {}
+                sock.sendall(json.dumps(request).encode() + b'\n')
+                with sock.makefile('rb') as response:
+                    return json.loads(response.readline())
+        except (OSError, ValueError):
+            return {}
+
+    def get_key(self, key_id):
+        key = self._request(cmd='get', key_id=key_id).get('key')
+        return key.encode() if key else None
+
+    def put_key(self, key_id, key):
+        return self._request(cmd='put', key_id=key_id,
+                             key=key.decode()).get('ok', False)
+
+    def forget(self):
+        return self._request(cmd='forget').get('ok', False)
+
+
+def key_changed(enc):
+    """
+    tell the agent to forget its key, after the master password or the
+    data key of enc changed, as the old key does not open it any more
+    """
+    (enc.agent or AgentClient(socket_path())).forget()
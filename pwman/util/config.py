@@ -99,10 +99,20 @@ default_config = {
               'saved'),
      'lock_timeout': '600'
      },
-    'Database': {'dburi': ('sqlite://$XDG_DATA_HOME/pwman.db # ')},
+    'Database': {'dburi': ('sqlite://$XDG_DATA_HOME/pwman.db # '),
+                 'stream_size': ('1000 # number of rows read from the '
+                                 'database at a time when listing')},
     'Readline': {'history': os.path.join(data_dir,
                                          'history')},
-    'Crypto': {'supress_warning': 'no'},
+    'Crypto': {'supress_warning': 'no',
+               'record_format': ('no # set to `yes` to encrypt all the fields '
+                                 'of a new node as a single record'),
+               'workers': ('0 # number of threads used to encrypt and '
+                           'decrypt many values, 0 is one per CPU'),
+               'kdf': ('pbkdf2 # key derivation function of a new '
+                       'database, pbkdf2 or scrypt'),
+               'kdf_time': ('0.5 # seconds it takes to derive the key of '
+                            'a new database')},
     'Updater': {'supress_version_check': ('no # set to `yes` to supress check '
                                           'for newer versions of pwman3'),
                 'client_info': ('"" #  sha256 digest of host name and '
@@ -194,9 +204,39 @@ class Config:
                              MongoDB example:
                                  `mongodb://<user>:<pass>@<host[:port]>/<database>`
     ---------------------    -----------
+    stream_size              Number of rows read from the database at a
+                             time when listing or exporting. The rows are
+                             streamed with a server side cursor, so memory
+                             does not grow with the size of the database.
+    ---------------------    -----------
+    **Section**              *Crypto*
+    ---------------------    -----------
+    record_format            yes or no - store new nodes as a single
+                             encrypted record, which is decrypted once.
+                             Convert existing nodes with
+                             ``pwman3 convert``.
+    ---------------------    -----------
+    workers                  Number of threads used to encrypt or decrypt
+                             many values at once, e.g. when listing,
+                             exporting or importing. 0 means one thread
+                             per CPU.
+    ---------------------    -----------
+    kdf                      pbkdf2 or scrypt - the function which derives
+                             the key from the master password of a new
+                             database. Its parameters are stored in the
+                             database.
+    ---------------------    -----------
+    kdf_time                 The cost of the kdf is calibrated, when a new
+                             database is created, to derive the key in
+                             this number of seconds. Higher is stronger,
+                             but slower to unlock.
+    ---------------------    -----------
     **Section**              *Updater*
     ---------------------    -----------
     supress_version_check    yes or no - check for newer versions of pwman3
+                             The check runs in the background, and its
+                             result is cached for a day in
+                             ``$XDG_CACHE_HOME/pwman/version.json``.
     ---------------------    -----------
     client_info              sha256 digest of host name and username,
                              used for identifying the client
@@ -242,13 +282,12 @@ class Config:
         self.save()
 
     def _add_defaults(self, defaults, parser):
-        loc_defaults = defaults.copy()
-        loc_defaults.update({'Database':
-                             {
-                              'dburi':  'sqlite://' + os.path.join(data_dir,
-                                                                   'pwman.db')},  # noqa
-                              'Readline': {'history': os.path.join(data_dir,
-                                                                   'history')}})  # noqa
+        loc_defaults = {section: dict(options)
+                        for section, options in defaults.items()}
+        loc_defaults.setdefault('Database', {})['dburi'] = (
+            'sqlite://' + os.path.join(data_dir, 'pwman.db'))
+        loc_defaults.setdefault('Readline', {})['history'] = os.path.join(
+            data_dir, 'history')
         for section, options in loc_defaults.items():
             if not parser.has_section(section):
                 parser.add_section(section)
@@ -21,16 +21,22 @@ import base64
 import binascii
 import ctypes
 import datetime
+import hashlib
+import hmac
 import os
 import random
 import string
 import sys
 import time
+import weakref
+from contextlib import contextmanager
 
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
 from pwman.util.callback import Callback
 
@@ -80,29 +86,100 @@ class CryptoException(Exception):
     pass
 
 
-def get_digest(password, salt):
+# the key derivation functions, with their minimal parameters. The
+# first parameter is the cost which is raised by calibrate_kdf.
+KDFS = {
+    'pbkdf2': (lambda salt, iterations: PBKDF2HMAC(
+        algorithm=hashes.SHA256(), length=32, salt=salt,
+        iterations=iterations, backend=default_backend()),
+        (('iterations', 5000),)),
+    'scrypt': (lambda salt, n, r, p: Scrypt(
+        salt=salt, length=32, n=n, r=r, p=p, backend=default_backend()),
+        (('n', 2**14), ('r', 8), ('p', 1))),
+}
+
+# used by databases which were created before the KDF was stored
+LEGACY_KDF = 'pbkdf2:iterations=5000'
+
+
+def parse_kdf(spec):
     """
-    Get a digest based on clear text password
+    Split a KDF specification, e.g. ``scrypt:n=16384,r=8,p=1``, in the
+    name of the function and a dictionary of its parameters
     """
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=5000,
-        backend=default_backend()
-    )
-    key = base64.urlsafe_b64encode(kdf.derive(password))
+    name, _, params = (spec or LEGACY_KDF).partition(':')
+    if name not in KDFS:
+        raise CryptoException("Unknown key derivation function %s" % name)
+    defaults = dict(KDFS[name][1])
+    for param in filter(None, params.split(',')):
+        key, _, value = param.partition('=')
+        if key not in defaults:
+            raise CryptoException("Unknown parameter %s of %s" % (key, name))
+        defaults[key] = int(value)
+    return name, defaults
+
+
+def format_kdf(name, params):
+    """the reverse of parse_kdf"""
+    return name + ':' + ','.join('%s=%d' % (key, params[key]) for key, _ in
+                                 KDFS[name][1])
+
+
+def get_digest(password, salt, kdf=None):
+    """
+    Get a digest based on clear text password, kdf is the specification
+    of the key derivation function, see parse_kdf.
+    """
+    name, params = parse_kdf(kdf)
+    derive = KDFS[name][0](salt, **params)
+    key = base64.urlsafe_b64encode(derive.derive(password))
     return key
 
 
-def get_cipher(password, salt):
+def get_cipher(password, salt, kdf=None):
     """
     Create a chiper object from a hashed password
     """
-    dig = get_digest(password, salt)
+    dig = get_digest(password, salt, kdf)
     return Fernet(dig)
 
 
+def calibrate_kdf(name='pbkdf2', seconds=0.5):
+    """
+    Return the specification of the KDF name with the highest cost which
+    derives a key in about the given number of seconds on this machine.
+    The cost never goes below the minimal parameters in KDFS.
+    """
+    name, params = parse_kdf(name)
+    cost, minimum = KDFS[name][1][0]
+    started = time.perf_counter()
+    get_digest(b'calibrate', os.urandom(32), format_kdf(name, params))
+    elapsed = max(time.perf_counter() - started, 1e-6)
+
+    scaled = minimum * seconds / elapsed
+    if name == 'scrypt':
+        # n must be a power of two, and takes 128 * r * n bytes of memory
+        scaled = 2 ** min(max(int(scaled).bit_length() - 1, 0), 20)
+    params[cost] = max(int(scaled), minimum)
+    return format_kdf(name, params)
+
+
+def get_index_key(digest):
+    """
+    Derive the key used for blind indexes from the digest of the password.
+    The result is independent of the encryption key, so an index value
+    reveals nothing about the cipher texts.
+    """
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'pwman3 blind index',
+        backend=default_backend()
+    )
+    return hkdf.derive(digest)
+
+
 def prepare_data(text, block_size):
     """
     prepare data before encryption so the lenght matches the expected
@@ -113,6 +190,63 @@ def prepare_data(text, block_size):
     return text.ljust(newdatasize)
 
 
+def format_key(salt, digest, kdf=None):
+    """the form of a key stored in the database: ``salt$6$digest$kdf``"""
+    return (salt + b'$6$' + digest +
+            (b'$' + kdf.encode() if kdf else b'')).decode('utf-8')
+
+
+def is_wrapped(digest):
+    """
+    Tell if a digest is a data key wrapped with the password key. Older
+    databases store the hex of the password key, which encrypts the data
+    itself.
+    """
+    return bool(digest) and not set(digest) <= set(b'0123456789abcdef')
+
+
+class Recrypter(object):
+
+    """
+    Re-encrypt the cipher texts of one data key with another, in the
+    worker threads of the CryptoEngine. Made by CryptoEngine.rekey.
+    key is the new key to store in the database, and password_key the
+    key which unwraps it.
+    """
+
+    def __init__(self, engine, key, data_key, password_key):
+        self._engine = engine
+        self._old = engine._cipher
+        self._new = Fernet(data_key)
+        self._index_key = get_index_key(data_key)
+        self.key = key
+        self.password_key = password_key
+
+    def _recrypt(self, cipher_text):
+        if not cipher_text:
+            return cipher_text
+        return encode_AES(self._new, decode_AES(self._old, cipher_text))
+
+    def recrypt_many(self, cipher_texts):
+        """re-encrypt cipher_texts in order, empty values stay empty"""
+        return self._engine._map(self._recrypt, cipher_texts)
+
+    def _recrypt_tag(self, cipher_text):
+        try:
+            text = decode_AES(self._old, cipher_text)
+        except Exception:
+            # tags which are not encrypted are encrypted now
+            text = cipher_text
+        if not isinstance(text, bytes):
+            text = text.encode()
+        return (encode_AES(self._new, text),
+                hmac.new(self._index_key, text, hashlib.sha256).hexdigest())
+
+    def recrypt_tags(self, cipher_texts):
+        """return the new cipher text and blind index of each tag"""
+        return self._engine._map(self._recrypt_tag, cipher_texts)
+
+
 class CryptoEngine(object):
     _instance = None
     _callback = None
@@ -126,16 +260,38 @@ class CryptoEngine(object):
         return CryptoEngine._instance
 
     def __init__(self, salt=None, digest=None, algorithm='AES',
-                 timeout=-1, reader=None):
+                 timeout=-1, reader=None, workers=0, kdf='pbkdf2',
+                 kdf_time=0):
         """
         Initialise the Cryptographic Engine
+
+        workers is the number of threads used by encrypt_many and
+        decrypt_many, 0 means one thread per CPU.
+
+        kdf is the key derivation function used for a new password, and
+        kdf_time the number of seconds its cost is calibrated to. With
+        kdf_time 0 the minimal cost is used.
         """
         self._algo = algorithm
         self._digest = digest if digest else None
         self._salt = salt if salt else None
+        self._kdf = None
+        self.kdf = kdf
+        self.kdf_time = kdf_time
         self._timeout = timeout
         self._expires_at = -1
         self._cipher = None
+        # the key derived from the password, which unwraps the data key
+        self._key = None
+        self._data_key = None
+        self._index_key = None
+        self._caches = weakref.WeakSet()
+        # a pwman.util.agent.AgentClient which is asked for the key
+        # before the password is
+        self.agent = None
+        self.workers = workers
+        self._pool = None
+        self._pool_workers = 0
         self._reader = reader
         self._callback = None
         self._getsecret = None  # This is set in callback.setter
@@ -144,27 +300,56 @@ class CryptoEngine(object):
         """
         salt and digest are stored in a file or a database
         """
-        dig = get_digest(password, self._salt)
-        if binascii.hexlify(dig) == self._digest or dig == self._digest:
-            self._cipher = get_cipher(password, self._salt)
-            if self._timeout > 0:
-                self._expires_at = int(time.time()) + self._timeout
-            return True
-        return False
+        return self._unlock(get_digest(password, self._salt, self._kdf))
 
-    def _auth(self):
+    def _unlock(self, dig):
+        """
+        check a key derived from the password against the stored digest
+        and keep it if it matches. The digest is the data key wrapped
+        with that key, or in older databases the key itself.
+        """
+        if is_wrapped(self._digest):
+            try:
+                data_key = Fernet(dig).decrypt(self._digest)
+            except (InvalidToken, ValueError):
+                return False
+        elif hmac.compare_digest(binascii.hexlify(dig), self._digest) or \
+                hmac.compare_digest(dig, self._digest):
+            data_key = dig
+        else:
+            return False
+        self._key = dig
+        self._data_key = data_key
+        self._cipher = Fernet(data_key)
+        self._index_key = get_index_key(data_key)
+        if self._timeout > 0:
+            self._expires_at = int(time.time()) + self._timeout
+        return True
+
+    def needs_upgrade(self):
+        """tell if the data is encrypted with the password key itself"""
+        return self._digest is not None and not is_wrapped(self._digest)
+
+    def _auth(self, use_agent=True):
         """
         Read password from the user, if the password is correct,
         finish the execution an return the password and salt which
         are read from the file.
         """
         salt = self._salt
+        if self.agent is not None and use_agent:
+            key = self.agent.get_key(self.get_salt_digest())
+            if key and self._unlock(key):
+                return None, salt
+
         tries = 0
         while tries < 5:
             passwd = self._getsecret("Please type in your master password")
             if not isinstance(passwd, bytes):
                 passwd = passwd.encode()
             if self.authenticate(passwd):
+                if self.agent is not None:
+                    self.agent.put_key(self.get_salt_digest(), self._key)
                 return passwd, salt
 
             print("You entered a wrong password...")
@@ -173,28 +358,92 @@ class CryptoEngine(object):
 
     def encrypt(self, text):
         if not self._is_authenticated():
-            p, s = self._auth()
-            cipher = get_cipher(p, s)
-            self._cipher = cipher
-            del(p)
+            self._auth()
 
         return encode_AES(self._cipher, text)
 
     def decrypt(self, cipher_text):
         if not self._is_authenticated():
-            p, s = self._auth()
-            cipher = get_cipher(p, s)
-            self._cipher = cipher
-            del(p)
+            self._auth()
 
         return decode_AES(self._cipher, cipher_text)
 
+    def _map(self, func, items):
+        """
+        apply func to items, split in one chunk per worker thread.
+        OpenSSL releases the GIL, so the chunks run in parallel.
+        """
+        items = list(items)
+        workers = self.workers or os.cpu_count() or 1
+        if workers < 2 or len(items) < 2 * workers:
+            return [func(item) for item in items]
+
+        if self._pool is None or self._pool_workers != workers:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+            self._pool_workers = workers
+        size = -(-len(items) // workers)
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        results = []
+        for part in self._pool.map(lambda c: [func(i) for i in c], chunks):
+            results.extend(part)
+        return results
+
+    def encrypt_many(self, texts):
+        """
+        Encrypt many values, checking the authentication once for all.
+        The results are returned in the order of texts.
+        """
+        if not self._is_authenticated():
+            self._auth()
+        cipher = self._cipher
+        return self._map(lambda text: encode_AES(cipher, text), texts)
+
+    def decrypt_many(self, cipher_texts):
+        """
+        Decrypt many values, checking the authentication once for all.
+        The results are returned in the order of cipher_texts.
+        """
+        if not self._is_authenticated():
+            self._auth()
+        cipher = self._cipher
+        return self._map(lambda text: decode_AES(cipher, text), cipher_texts)
+
+    def blind_index(self, text):
+        """
+        Return a deterministic keyed digest of text.
+        Equal values give equal digests, so stored values can be
+        looked up with an equality query instead of decrypting them.
+        """
+        if not self._is_authenticated() or self._index_key is None:
+            self._auth()
+
+        if not isinstance(text, bytes):
+            text = text.encode()
+        return hmac.new(self._index_key, text, hashlib.sha256).hexdigest()
+
+    def register_cache(self, cache):
+        """
+        register an object holding decrypted data. Its clear_cache method
+        is called when the key is discarded.
+        """
+        self._caches.add(cache)
+
+    def _clear_caches(self):
+        for cache in list(self._caches):
+            cache.clear_cache()
+        self._caches.clear()
+
     def forget(self):
         """
         discard cipher
         """
         self._cipher = None
+        self._key = None
+        self._data_key = None
+        self._index_key = None
         self._expires_at = -1
+        self._clear_caches()
 
     def _is_authenticated(self):
         if self._is_timedout():
@@ -211,11 +460,37 @@ class CryptoEngine(object):
         now = int(time.time())
         if now > self._expires_at:
             self._cipher = None
+            self._key = None
+            self._data_key = None
+            self._index_key = None
+            self._clear_caches()
             return True
         # reset the time
         self._expires_at = int(time.time()) + self._timeout
         return False
 
+    def is_locked(self):
+        """
+        tell if the key is not available, unlike _is_timedout this does
+        not extend the lock timeout
+        """
+        if self._cipher is None:
+            return True
+        return self._timeout >= 0 and int(time.time()) > self._expires_at
+
+    @contextmanager
+    def idle(self):
+        """
+        use the key without extending the lock timeout, for work the
+        user did not ask for, like completion
+        """
+        expires_at = self._expires_at
+        try:
+            yield self
+        finally:
+            if self._cipher is not None:
+                self._expires_at = expires_at
+
     def lock_info(self):
         if self._expires_at < 0:
             return datetime.MAXYEAR
@@ -224,12 +499,21 @@ class CryptoEngine(object):
         return datetime.datetime.fromtimestamp(self._expires_at)
 
     def changepassword(self, reader=input):
+        """
+        Ask for the current and twice for the new master password, and
+        return the key to store in the database. The current password is
+        asked for even if the engine is unlocked. The data key is kept
+        and only wrapped with the new password, so nothing has to be
+        re-encrypted. An engine without a key gets a new random data key.
+        """
         if self._callback is None:
             raise CryptoException("No callback class has been specified")
 
-        # if you change the password of the database you have to Change
-        # all the cipher texts in the databse!!!
-        self._keycrypted = self._create_password()
+        data_key = None
+        if self._digest is not None:
+            self._auth(use_agent=False)
+            data_key = self._data_key
+        self._keycrypted = self._create_password(data_key)
         self.set_salt_digest(self._keycrypted)
         return self._keycrypted
 
@@ -248,24 +532,100 @@ class CryptoEngine(object):
         else:
             raise Exception("callback must be an instance of Callback!")
 
-    def _create_password(self):
+    def _new_salt_kdf(self):
+        kdf = self.kdf
+        if self.kdf_time > 0:
+            kdf = calibrate_kdf(kdf, self.kdf_time)
+        return base64.b64encode(os.urandom(32)), format_kdf(*parse_kdf(kdf))
+
+    def _create_password(self, data_key=None):
         """
-        Create a secret password as a hash and the salt used for this hash.
-        Change reader to manipulate how input is given.
+        Create a secret password as a hash and the salt used for this hash,
+        and wrap the data key with it, or a new one if none is given.
+        The password is asked for twice, and nothing changes if the two
+        differ.
         """
-        salt = base64.b64encode(os.urandom(32))
-        passwd = self._getsecret("Please type in the master password")
-        if not isinstance(passwd, bytes):
-            passwd = passwd.encode()
-        key = get_digest(passwd, salt)
-        hpk = salt+'$6$'.encode('utf8')+binascii.hexlify(key)
-        self._digest = key
+        passwds = []
+        for question in ("Please type in the new master password",
+                         "Please type the new master password again"):
+            passwd = self._getsecret(question)
+            if not isinstance(passwd, bytes):
+                passwd = passwd.encode()
+            passwds.append(passwd)
+        if not hmac.compare_digest(*passwds):
+            raise CryptoException("The passwords do not match, the master "
+                                  "password was not changed")
+        salt, kdf = self._new_salt_kdf()
+        key = get_digest(passwd, salt, kdf)
+        data_key = data_key or Fernet.generate_key()
+        self._digest = Fernet(key).encrypt(data_key)
         self._salt = salt
-        self._cipher = get_cipher(passwd, salt)
-        return hpk.decode('utf-8')
+        self._kdf = kdf
+        self._key = key
+        self._data_key = data_key
+        self._cipher = Fernet(data_key)
+        self._index_key = get_index_key(data_key)
+        return format_key(salt, self._digest, kdf)
+
+    def rekey(self, pending=None):
+        """
+        Make a new random data key, wrapped with the key of the password,
+        and return a Recrypter from the current data key to it. Older
+        databases store the key of the password itself, so for them the
+        password is asked for and derived with a new salt. The engine
+        keeps the current key until switch_key is called. pending is the
+        key of an interrupted rotation, whose data key is taken up again.
+        """
+        if self.needs_upgrade():
+            passwd, _ = self._auth(use_agent=False)
+            salt, kdf = self._new_salt_kdf()
+
+            def derive(salt, kdf):
+                return get_digest(passwd, salt, kdf)
+        else:
+            if not self._is_authenticated():
+                self._auth()
+            salt, kdf = self._salt, self._kdf
+
+            def derive(salt, kdf):
+                return self._key if salt == self._salt else None
+
+        if pending:
+            pending_salt, digest = pending.split('$6$')
+            digest, _, pending_kdf = digest.partition('$')
+            key = derive(pending_salt.encode(), pending_kdf or None)
+            try:
+                if key is not None:
+                    return Recrypter(self, pending,
+                                     Fernet(key).decrypt(digest.encode()),
+                                     key)
+            except (InvalidToken, ValueError):
+                pass
+        key = derive(salt, kdf)
+        data_key = Fernet.generate_key()
+        return Recrypter(self, format_key(salt, Fernet(key).encrypt(data_key),
+                                          kdf), data_key, key)
+
+    def switch_key(self, recrypter):
+        """use the new key of recrypter, once the data is re-encrypted"""
+        self.set_salt_digest(recrypter.key)
+        self._clear_caches()
+        self._unlock(recrypter.password_key)
 
     def set_salt_digest(self, key):
-        self._salt, self._digest = (i.encode('utf-8') for i in key.split('$6$'))  # noqa
+        """
+        set the salt, the digest and the KDF from a key of the form
+        ``salt$6$digest$kdf``. Keys without a KDF use LEGACY_KDF.
+        """
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        salt, digest = key.split('$6$')
+        digest, _, kdf = digest.partition('$')
+        self._salt, self._digest = salt.encode('utf-8'), digest.encode('utf-8')
+        self._kdf = kdf or None
 
     def get_salt_digest(self):
-        return self._salt.decode() + u'$6$' + self._digest.decode()
+        key = self._salt.decode() + u'$6$' + self._digest.decode()
+        if self._kdf:
+            key += u'$' + self._kdf
+        return key
@@ -0,0 +1,149 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from pwman.util.agent import Agent, AgentClient, key_changed, peer_uid
+from pwman.util.crypto_engine import CryptoEngine
+from .test_crypto_engine import DummyCallback
+
+
+def no_password(question):
+    raise AssertionError("the password should come from the agent")
+
+
+class TestAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.ce = CryptoEngine.get()
+        self.ce._getsecret = lambda x: b'12345'
+        self.ce.encrypt(b"")
+        self.key_id = self.ce.get_salt_digest()
+
+        enc = CryptoEngine(timeout=60)
+        enc.set_salt_digest(self.key_id)
+        self.assertTrue(enc.authenticate(b'12345'))
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'agent', 'agent.sock')
+        self.agent = Agent(self.path, enc)
+        self.thread = threading.Thread(target=self.agent.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.client = AgentClient(self.path)
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self.thread.join()
+        self.agent.server_close()
+        os.rmdir(os.path.dirname(self.path))
+        os.rmdir(self.tmpdir)
+
+    def engine(self):
+        enc = CryptoEngine()
+        enc.set_salt_digest(self.key_id)
+        enc._getsecret = no_password
+        enc.agent = self.client
+        return enc
+
+    def test_socket_mode(self):
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+        self.assertEqual(0o700,
+                         os.stat(os.path.dirname(self.path)).st_mode & 0o777)
+
+    def test_get_key(self):
+        self.assertIsNotNone(self.client.get_key(self.key_id))
+        self.assertIsNone(self.client.get_key('other$6$database'))
+        self.assertIsNone(AgentClient(self.path + '.missing').get_key(
+            self.key_id))
+
+    def test_decrypt_with_agent(self):
+        secret = self.ce.encrypt(b"topsecret")
+        self.assertEqual(b"topsecret", self.engine().decrypt(secret))
+
+    def test_lock_timeout(self):
+        self.agent.enc._expires_at = 0
+        self.agent.service_actions()
+        self.assertIsNone(self.client.get_key(self.key_id))
+        self.assertRaises(AssertionError, self.engine().encrypt, b"")
+
+        # a client which was given the password unlocks the agent again
+        enc = self.engine()
+        enc._getsecret = lambda x: b'12345'
+        enc.encrypt(b"")
+        self.assertEqual(enc._key, self.client.get_key(self.key_id))
+        self.assertFalse(self.client.put_key(self.key_id, b'wrong'))
+
+    def test_open_rundir(self):
+        rundir = os.path.dirname(self.path)
+        os.chmod(rundir, 0o755)
+        try:
+            self.assertIsNone(self.client.get_key(self.key_id))
+            self.assertRaises(PermissionError, Agent,
+                              os.path.join(rundir, 'other.sock'), self.ce)
+        finally:
+            os.chmod(rundir, 0o700)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_PEERCRED'), "no SO_PEERCRED")
+    def test_other_user(self):
+        left, right = socket.socketpair(socket.AF_UNIX)
+        with left, right:
+            self.assertEqual(os.getuid(), peer_uid(left))
+            self.assertTrue(self.agent.verify_request(left, None))
+            with mock.patch('pwman.util.agent.peer_uid',
+                            return_value=os.getuid() + 1):
+                self.assertFalse(self.agent.verify_request(left, None))
+                self.assertIsNone(self.client.get_key(self.key_id))
+        self.assertIsNotNone(self.client.get_key(self.key_id))
+
+    def test_password_change(self):
+        enc = self.engine()
+        enc.encrypt(b"")
+        enc.callback = DummyCallback()
+        answers = iter([b'12345', b'new secret', b'new secret'])
+        enc._getsecret = lambda x: next(answers)
+        new_key = enc.changepassword()
+        # the agent still has the key of the old password
+        self.assertIsNone(self.client.get_key(new_key))
+        with mock.patch.dict(os.environ, {'PWMAN_AGENT_SOCK': self.path}):
+            key_changed(CryptoEngine())
+        self.assertIsNone(self.client.get_key(self.key_id))
+
+        # the next command which is given the password unlocks the agent
+        other = CryptoEngine()
+        other.set_salt_digest(new_key)
+        other._getsecret = lambda x: b'new secret'
+        other.agent = self.client
+        other.encrypt(b"")
+        self.assertEqual(other._key, self.client.get_key(new_key))
+        self.assertIsNone(self.client.get_key(self.key_id))
+        # an unlocked agent does not take the key of another database
+        self.assertFalse(self.client.put_key(self.key_id, other._key))
+
+    def test_forget(self):
+        self.assertTrue(self.client.forget())
+        self.assertIsNone(self.client.get_key(self.key_id))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
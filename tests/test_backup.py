@@ -0,0 +1,124 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pwman.data.drivers.sqlite import SQLite
+from pwman.data.nodes import Node
+from pwman.exchange.backup import MAGIC, BackupError, backup, restore
+from pwman.util.crypto_engine import CryptoEngine
+
+
+class TestBackup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = self.open('source.db')
+        self.source.savekey(CryptoEngine.get().get_salt_digest())
+        for i in range(5):
+            tags = ['foo', 'bar'] if i % 2 else ['foo']
+            self.source.add_node(Node(clear_text=True, username='user%d' % i,
+                                      password='secret', url='example.com',
+                                      notes='note %d' % i, tags=tags))
+        self.target = self.open('target.db')
+
+    def tearDown(self):
+        self.source.close()
+        self.target.close()
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def open(self, name):
+        db = SQLite(self.path(name))
+        db._open()
+        return db
+
+    def nodes(self, db):
+        return sorted((node.username, node.notes, sorted(node.tags))
+                      for node in (Node.from_encrypted_entries(*row[1:5],
+                                                               tags)
+                                   for row, tags in
+                                   db.getnodes(db.lazy_list_node_ids())))
+
+    def test_round_trip(self):
+        self.assertEqual(5, backup(self.source, self.path('pwman.bak')))
+        with open(self.path('pwman.bak'), 'rb') as f:
+            self.assertTrue(f.read().startswith(MAGIC))
+        self.assertEqual(5, restore(self.target, self.path('pwman.bak'),
+                                    batch_size=2))
+        self.assertEqual(self.source.loadkey(), self.target.loadkey())
+        self.assertEqual(self.nodes(self.source), self.nodes(self.target))
+        self.assertEqual(['bar', 'foo'], self.target.tag_names())
+        self.assertEqual([1], self.target.search_index().search('user0'))
+
+    def test_restore_twice(self):
+        backup(self.source, self.path('pwman.bak'))
+        restore(self.target, self.path('pwman.bak'))
+        restore(self.target, self.path('pwman.bak'))
+        self.assertEqual(10, len(list(self.target.lazy_list_node_ids())))
+        self.assertEqual(['bar', 'foo'], self.target.tag_names())
+
+    def test_other_key(self):
+        backup(self.source, self.path('pwman.bak'))
+        self.target.savekey('SECRET$6$KEY')
+        with self.assertRaises(BackupError):
+            restore(self.target, self.path('pwman.bak'))
+        self.assertEqual([], list(self.target.lazy_list_node_ids()))
+
+    def test_not_a_backup(self):
+        with open(self.path('pwman.bak'), 'wb') as f:
+            f.write(b'PWMAN')
+        with self.assertRaises(BackupError):
+            restore(self.target, self.path('pwman.bak'))
+
+    def assertUnchanged(self):
+        self.assertEqual([], list(self.target.lazy_list_node_ids()))
+        self.assertIsNone(self.target.loadkey())
+
+    def test_cut_off(self):
+        backup(self.source, self.path('pwman.bak'))
+        with open(self.path('pwman.bak'), 'rb') as f:
+            data = f.read()
+        for size in (len(data) // 2, len(data) - 8):
+            with open(self.path('pwman.bak'), 'wb') as f:
+                f.write(data[:size])
+            with self.assertRaises(BackupError):
+                restore(self.target, self.path('pwman.bak'), batch_size=2)
+            self.assertUnchanged()
+
+    def test_wrong_count(self):
+        backup(self.source, self.path('pwman.bak'))
+        with open(self.path('pwman.bak'), 'rb') as f:
+            head, data = f.read(len(MAGIC) + 2), gzip.decompress(f.read())
+        # the end record is last, with the number of nodes
+        with open(self.path('pwman.bak'), 'wb') as f:
+            f.write(head + gzip.compress(data[:-4] + struct.pack('>I', 6)))
+        with self.assertRaises(BackupError):
+            restore(self.target, self.path('pwman.bak'), batch_size=2)
+        self.assertUnchanged()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
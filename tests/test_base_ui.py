@@ -16,9 +16,11 @@
 # ============================================================================
 # Copyright (C) 2014 Oz Nahum Tiram <nahumoz@gmail.com>
 # ============================================================================
+import json
 import os
 import unittest
 import sys
+import time
 from io import StringIO, BytesIO
 
 from pwman.util.crypto_engine import CryptoEngine
@@ -107,6 +109,45 @@ class TestBaseUI(unittest.TestCase):
         sys.stdout = sys.__stdout__
         self.output.getvalue()
 
+    def test_2a_do_list_pages(self):
+        sys.stdout = StringIO()
+        self.tester.cli.do_next('')
+        self.assertIn('list --page-size N', sys.stdout.getvalue())
+        self.tester.cli.do_list('--page-size 1')
+        self.assertIn('alice', sys.stdout.getvalue())
+        self.assertNotIn('harry', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_next('')
+        self.assertIn('harry', sys.stdout.getvalue())
+        self.assertNotIn('alice', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_next('')
+        self.assertIn('No more nodes', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_prev('')
+        self.assertIn('alice', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_list('--page-size 5 nosuchtag')
+        self.assertIn('No more nodes', sys.stdout.getvalue())
+        sys.stdout = sys.__stdout__
+
+    def test_2b_do_search(self):
+        sys.stdout = StringIO()
+        self.tester.cli.do_search('alic')
+        self.assertIn('alice', sys.stdout.getvalue())
+        self.assertNotIn('harry', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_list('u:example foo')
+        self.assertIn('alice', sys.stdout.getvalue())
+        self.assertIn('harry', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_list('foo AND NOT')
+        self.assertIn('Invalid tag filter', sys.stdout.getvalue())
+        sys.stdout = StringIO()
+        self.tester.cli.do_list('u:nowhere')
+        self.assertNotIn('alice', sys.stdout.getvalue())
+        sys.stdout = sys.__stdout__
+
     def test_3_do_export(self):
         self.tester.cli.do_export("{'filename':'foo.csv'}")
         with open('foo.csv') as f:
@@ -123,6 +164,18 @@ class TestBaseUI(unittest.TestCase):
         self.assertIn('alice;example.com;secret;some notes;foo,bar,baz\n',
                       lines)
 
+    def test_3b_do_export_jsonl(self):
+        sys.stdout = StringIO()
+        self.tester.cli.do_export("{'filename': 'foo.jsonl', "
+                                  "'filter': 'foo AND NOT nosuchtag'}")
+        self.assertNotIn('secret', sys.stdout.getvalue())
+        sys.stdout = sys.__stdout__
+        with open('foo.jsonl') as f:
+            rows = [json.loads(line) for line in f]
+        os.unlink('foo.jsonl')
+        self.assertEqual(['alice', 'harry'], [r['username'] for r in rows])
+        self.assertEqual(['foo', 'bar', 'baz'], rows[0]['tags'])
+
     def test_4_do_forget(self):
         self.tester.cli.do_forget('')
         ce = CryptoEngine.get()
@@ -147,6 +200,31 @@ class TestBaseUI(unittest.TestCase):
             t in v
         sys.stdout = sys.__stdout__
 
+    def test_6a_complete_list(self):
+        self.assertEqual(['bar', 'baz'],
+                         self.tester.cli.complete_list('ba', 'ls ba', 3, 5))
+        self.assertEqual(['NOT'],
+                         self.tester.cli.complete_ls('N', 'ls foo N', 7, 8))
+
+    def test_6b_complete_list_locked(self):
+        enc = CryptoEngine.get()
+        saved = enc._timeout, enc._expires_at
+        try:
+            expires_at = int(time.time()) + 60
+            enc._timeout, enc._expires_at = 600, expires_at
+            # the tags are decrypted again
+            self.tester.cli._db.clear_cache()
+            self.assertEqual(['bar', 'baz'], self.tester.cli.complete_list(
+                'ba', 'ls ba', 3, 5))
+            # completing does not keep the database unlocked
+            self.assertEqual(expires_at, enc._expires_at)
+            enc._expires_at = 0
+            self.assertEqual([], self.tester.cli.complete_list(
+                'ba', 'ls ba', 3, 5))
+            self.assertIsNotNone(enc._cipher)
+        finally:
+            enc._timeout, enc._expires_at = saved
+
     def test_7_get_ids(self):
         # used by do_cp or do_open,
         # this spits many time could not understand your input
@@ -196,6 +274,12 @@ class TestBaseUI(unittest.TestCase):
         self.assertNotIn('alice', sys.stdout.getvalue())
         sys.stdout = sys.__stdout__
 
+    def test_9a_do_vacuum(self):
+        sys.stdout = StringIO()
+        self.tester.cli.do_vacuum('')
+        self.assertIn('unused tags', sys.stdout.getvalue())
+        sys.stdout = sys.__stdout__
+
     def test_10_do_info(self):
         self.output = StringIO()
         sys.stdout = self.output
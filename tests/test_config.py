@@ -107,6 +107,16 @@ class TestConfig(unittest.TestCase):
         config = self.conf.get_value('Readline', 'history')
         self.assertEqual(path, config)
 
+    def test_database_defaults(self):
+        defaults = {'Database': {'stream_size': '1000 # rows at a time'}}
+        conf = config.Config(filename='dummy.cfg', defaults=defaults)
+        # the default dburi is added, the other defaults are kept
+        self.assertEqual('1000 # rows at a time',
+                         conf.get_value('Database', 'stream_size'))
+        self.assertTrue(conf.get_value('Database', 'dburi'))
+        self.assertEqual({'stream_size': '1000 # rows at a time'},
+                         defaults['Database'])
+
     def test_has_user_db(self):
         self.assertNotEqual(os.path.join(config.find_config_dir("pwman")[1],'pwman.db'),
                             self.conf.get_value('Database', 'filename'))
@@ -21,8 +21,12 @@ import os
 import time
 import string
 from pwman.util.callback import Callback
+import binascii
+from cryptography.fernet import Fernet
 from pwman.util.crypto_engine import (CryptoEngine, CryptoException,
-                                      generate_password)
+                                      generate_password, parse_kdf,
+                                      format_kdf, calibrate_kdf,
+                                      get_digest, encode_AES, is_wrapped)
 
 # set cls_timout to negative number (e.g. -1) to disable
 default_config = {'Global': {'umask': '0100', 'colors': 'yes',
@@ -150,6 +154,135 @@ class CryptoEngineTest(unittest.TestCase):
         decrypt = ce.decrypt(secret)
         self.assertEqual(decrypt.decode(), "topsecret")
 
+    def test_f_blind_index(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        idx = ce.blind_index(b"topsecret")
+        self.assertEqual(idx, ce.blind_index("topsecret"))
+        self.assertNotEqual(idx, ce.blind_index(b"topsecret2"))
+        self.assertEqual(64, len(idx))
+
+    def test_f_encrypt_decrypt_many(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        workers = ce.workers
+        ce.workers = 2
+        try:
+            texts = ["secret%d" % i for i in range(10)]
+            ciphers = ce.encrypt_many(texts)
+            self.assertEqual([ce.decrypt(c) for c in ciphers],
+                             [t.encode() for t in texts])
+            self.assertEqual(ce.decrypt_many(ciphers),
+                             [t.encode() for t in texts])
+        finally:
+            ce.workers = workers
+
+    def test_f_kdf_spec(self):
+        self.assertEqual(('pbkdf2', {'iterations': 5000}), parse_kdf(None))
+        self.assertEqual(('scrypt', {'n': 2**15, 'r': 8, 'p': 1}),
+                         parse_kdf('scrypt:n=32768'))
+        self.assertEqual('scrypt:n=32768,r=8,p=1',
+                         format_kdf(*parse_kdf('scrypt:n=32768')))
+        self.assertRaises(CryptoException, parse_kdf, 'md5')
+        self.assertRaises(CryptoException, parse_kdf, 'pbkdf2:n=1')
+
+    def test_f_calibrate_kdf(self):
+        name, params = parse_kdf(calibrate_kdf('pbkdf2', 0.05))
+        self.assertGreaterEqual(params['iterations'], 5000)
+        name, params = parse_kdf(calibrate_kdf('scrypt', 0.01))
+        self.assertGreaterEqual(params['n'], 2**14)
+        self.assertEqual(0, params['n'] & (params['n'] - 1))
+
+    def test_f_scrypt_key(self):
+        ce = CryptoEngine(kdf='scrypt')
+        ce._getsecret = lambda x: b'12345'
+        key = ce._create_password()
+        self.assertTrue(key.endswith('$scrypt:n=16384,r=8,p=1'))
+
+        ce = CryptoEngine()
+        ce.set_salt_digest(key)
+        self.assertEqual(key, ce.get_salt_digest())
+        self.assertFalse(ce.authenticate(b'verywrong'))
+        self.assertTrue(ce.authenticate(b'12345'))
+
+    def test_f_envelope(self):
+        ce = CryptoEngine()
+        ce.callback = DummyCallback()
+        key = ce.changepassword()
+        self.assertTrue(is_wrapped(ce._digest))
+        self.assertFalse(ce.needs_upgrade())
+        secret = ce.encrypt(b'secret')
+
+        # a new password only wraps the data key again
+        answers = iter([b'12345', b'new secret', b'new secret'])
+        ce._getsecret = lambda x: next(answers)
+        new_key = ce.changepassword()
+        ce = CryptoEngine()
+        ce.set_salt_digest(new_key)
+        self.assertFalse(ce.authenticate(b'12345'))
+        self.assertTrue(ce.authenticate(b'new secret'))
+        self.assertEqual(b'secret', ce.decrypt(secret))
+        ce.set_salt_digest(key)
+        self.assertTrue(ce.authenticate(b'12345'))
+        self.assertEqual(b'secret', ce.decrypt(secret))
+
+    def test_f_changepassword_checks(self):
+        ce = CryptoEngine()
+        ce.callback = DummyCallback()
+        key = ce.changepassword()
+        self.assertIsNotNone(ce._cipher)
+
+        # the new password is typed twice
+        answers = iter([b'12345', b'new secret', b'new secrte'])
+        ce._getsecret = lambda x: next(answers)
+        self.assertRaises(CryptoException, ce.changepassword)
+        self.assertEqual(key, ce.get_salt_digest())
+
+        # the engine is unlocked, the current password is still needed
+        ce._getsecret = lambda x: b'wrong'
+        self.assertRaises(CryptoException, ce.changepassword)
+        self.assertEqual(key, ce.get_salt_digest())
+        self.assertTrue(ce.authenticate(b'12345'))
+
+    def test_f_rekey(self):
+        ce = CryptoEngine()
+        ce.callback = DummyCallback()
+        ce.changepassword()
+        ciphers = [ce.encrypt(b'secret'), b'']
+        recrypter = ce.rekey()
+        # the engine keeps the old key until switch_key
+        self.assertEqual(b'secret', ce.decrypt(ciphers[0]))
+        new = recrypter.recrypt_many(ciphers)
+        self.assertEqual(b'', new[1])
+        (tag, idx), = recrypter.recrypt_tags([ce.encrypt(b'foo')])
+
+        ce.switch_key(recrypter)
+        self.assertEqual(recrypter.key, ce.get_salt_digest())
+        self.assertEqual(b'secret', ce.decrypt(new[0]))
+        self.assertEqual(b'foo', ce.decrypt(tag))
+        self.assertEqual(ce.blind_index(b'foo'), idx)
+        self.assertRaises(Exception, ce.decrypt, ciphers[0])
+        # the data key of an interrupted rotation is used again
+        self.assertEqual(recrypter.key, ce.rekey(recrypter.key).key)
+        self.assertNotEqual(recrypter.key, ce.rekey('x$6$y').key)
+
+    def test_f_upgrade(self):
+        key = get_digest(b'12345', salt)
+        secret = encode_AES(Fernet(key), b'secret')
+        ce = CryptoEngine()
+        ce.callback = DummyCallback()
+        ce.set_salt_digest(salt + b'$6$' + binascii.hexlify(key))
+        self.assertTrue(ce.needs_upgrade())
+
+        recrypter = ce.rekey()
+        self.assertTrue(ce.authenticate(b'12345'))
+        self.assertNotIn(salt.decode(), recrypter.key)
+        new = recrypter.recrypt_many([secret])[0]
+        ce.switch_key(recrypter)
+        self.assertFalse(ce.needs_upgrade())
+        self.assertEqual(b'secret', ce.decrypt(new))
+        self.assertTrue(ce.authenticate(b'12345'))
+
     def test_g_encrypt_decrypt_wrong_pass(self):
         ce = CryptoEngine.get()
         ce._cipher = None
@@ -0,0 +1,84 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import namedtuple
+from io import StringIO
+
+from pwman.exchange.exporter import Exporter
+
+FakeNode = namedtuple('FakeNode', 'username url password notes tags')
+
+
+def fake_nodes(count):
+    for i in range(count):
+        yield FakeNode('user%d' % i, 'example.com', 'secret;%d' % i,
+                       'notes', [b'foo', b'bar'])
+
+
+class TestExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = sys.__stdout__
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_csv(self):
+        exporter = Exporter(self.path('export.csv'), delimiter=';')
+        self.assertEqual(3, exporter.run(fake_nodes(3)))
+        with open(self.path('export.csv')) as f:
+            lines = f.read().splitlines()
+        self.assertEqual('Username;URL;Password;Notes;Tags', lines[0])
+        self.assertEqual('user2;example.com;"secret;2";notes;foo,bar',
+                         lines[3])
+        self.assertIn('Exported 3 nodes', sys.stdout.getvalue())
+        self.assertNotIn('secret', sys.stdout.getvalue())
+
+    def test_jsonl(self):
+        Exporter(self.path('export.jsonl'), report_every=2).run(
+            fake_nodes(5))
+        with open(self.path('export.jsonl')) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(5, len(rows))
+        self.assertEqual({'username': 'user4', 'url': 'example.com',
+                          'password': 'secret;4', 'notes': 'notes',
+                          'tags': ['foo', 'bar']}, rows[4])
+        self.assertIn('Exported 4 nodes', sys.stdout.getvalue())
+
+    def test_format(self):
+        self.assertEqual('JSONLinesExporter', Exporter(
+            self.path('out.txt'), format='jsonl').invoke.__name__)
+        self.assertEqual('CSVExporter',
+                         Exporter(self.path('out.txt')).invoke.__name__)
+        self.assertRaises(ValueError, Exporter, self.path('out'),
+                          format='xml')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
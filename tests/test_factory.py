@@ -21,6 +21,8 @@ import os
 import os.path
 import unittest
 import sys
+from importlib.metadata import EntryPoint
+from unittest import mock
 
 from pwman.data import factory
 from pwman.data.database import DatabaseException
@@ -38,6 +40,37 @@ testdb = os.path.abspath(os.path.join(os.path.dirname(__file__), db))
 _saveconfig = False
 
 
+class FakeConnection(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDatabase(object):
+    """a driver of a remote database, which counts its connections"""
+
+    reuse_connection = True
+    connections = []
+    version = '0.9'
+
+    @classmethod
+    def connect(cls, dburi):
+        con = FakeConnection()
+        cls.connections.append(con)
+        return con
+
+    @classmethod
+    def check_db_version(cls, dburi, con=None):
+        if cls.version is None:
+            raise DatabaseException("no version")
+        return cls.version
+
+    def __init__(self, dburi):
+        self.dburi = dburi
+
+
 class TestFactory(unittest.TestCase):
 
     @classmethod
@@ -53,7 +86,7 @@ class TestFactory(unittest.TestCase):
 
     def test_factory_check_db_ver(self):
         self.assertEqual(
-            factory.check_db_version('sqlite://'+testdb), '0.6')
+            factory.check_db_version('sqlite://'+testdb), '0.9')
 
     @unittest.skip("not supported at the moment")
     def test_factory_check_db_file(self):
@@ -92,6 +125,52 @@ class TestFactory(unittest.TestCase):
         del db
 
 
+class TestDriverRegistry(unittest.TestCase):
+
+    def tearDown(self):
+        factory._drivers.pop('fake', None)
+        FakeDatabase.connections = []
+
+    def test_builtin_drivers_are_lazy(self):
+        cls, driver = factory.get_driver('sqlite')
+        self.assertIs(cls, SQLite)
+        self.assertIs(factory._drivers['sqlite'].target, SQLite)
+        self.assertIsInstance(factory._drivers['mongodb'].target, str)
+
+    def test_entry_point(self):
+        ep = EntryPoint(name='fake', group=factory.ENTRY_POINT_GROUP,
+                        value='tests.test_factory:FakeDatabase')
+        with mock.patch('importlib.metadata.entry_points',
+                        return_value=[ep]):
+            db = factory.createdb('fake://host/vault', __DB_FORMAT__)
+        self.assertIsInstance(db, FakeDatabase)
+        self.assertRaises(DatabaseException, factory.get_driver, 'unknown')
+
+    def test_connection_handover(self):
+        factory.register('fake', FakeDatabase)
+        # checking the version alone keeps no connection
+        self.assertEqual('0.9', factory.check_db_version('fake://host/vault'))
+        self.assertEqual([], FakeDatabase.connections)
+        db = factory.createdb('fake://host/vault', __DB_FORMAT__)
+        self.assertIsNone(db._handover)
+
+        db = factory.createdb('fake://host/vault')
+        con, = FakeDatabase.connections
+        self.assertIs(con, db._handover)
+        self.assertFalse(con.closed)
+
+    def test_connection_closed_on_error(self):
+        factory.register('fake', FakeDatabase)
+        FakeDatabase.version = None
+        try:
+            self.assertRaises(DatabaseException, factory.createdb,
+                              'fake://host/vault')
+        finally:
+            FakeDatabase.version = '0.9'
+        con, = FakeDatabase.connections
+        self.assertTrue(con.closed)
+
+
 if __name__ == '__main__':
     # make sure we use local pwman
     sys.path.insert(0, os.getcwd())
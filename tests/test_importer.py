@@ -106,6 +106,19 @@ class TestImporter(unittest.TestCase):
         importer = Importer((args, '', db))
         importer.importer.run(callback=DummyCallback)
 
+    def test_5_runner_batches(self):
+        Args = namedtuple('Args', 'file_delim, batch_size')
+        args = Args(file_delim=['import_file.csv', ';'], batch_size=1)
+        db = SQLite('importdummy.db')
+        importer = CSVImporter(args, '', db)
+        self.assertEqual(2, len(list(importer._batches(importer._read_file()))))
+        importer.run(callback=DummyCallback)
+        db = SQLite('importdummy.db')
+        db._open()
+        # two nodes from test_4_runner and two from this run
+        self.assertEqual(4, len(list(db.lazy_list_node_ids())))
+        db.close()
+
 
 if __name__ == '__main__':
 
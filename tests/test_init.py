@@ -18,15 +18,22 @@
 # ============================================================================
 import os
 import os.path
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 import sys
 
 from collections import namedtuple
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from pwman import set_xsel
 from pwman.data import factory
 from pwman.data.database import __DB_FORMAT__
-from pwman import (get_conf, get_conf_options, get_db_version)
+from pwman import (get_conf, get_conf_options, get_db_version,
+                   is_latest_version, parse_version, read_version_cache,
+                   start_version_check)
 from .test_tools import SetupTester
 
 dummyfile = """
@@ -85,9 +92,9 @@ class TestInit(unittest.TestCase):
 
     def test_get_db_version(self):
         v = get_db_version(self.tester.configp, 'sqlite')
-        self.assertEqual(v, '0.6')
+        self.assertEqual(v, '0.9')
         v = get_db_version(self.tester.configp, 'sqlite')
-        self.assertEqual(v, '0.6')
+        self.assertEqual(v, '0.9')
 
     def test_set_xsel(self):
         Args = namedtuple('args', 'cfile, dbase, algo')
@@ -108,6 +115,83 @@ class TestInit(unittest.TestCase):
         self.assertEqual(dburi, 'dummy.db')
 
 
+class StubUpdateServer(BaseHTTPRequestHandler):
+    """answer every request with the latest version of the server"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(self.server.latest.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestVersionCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubUpdateServer)
+        self.server.latest = '99.0.0'
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.cache = tempfile.mkdtemp()
+        self.env = {k: os.environ.get(k) for k in ('PWMAN_UPDATE_URL',
+                                                    'XDG_CACHE_HOME')}
+        os.environ['PWMAN_UPDATE_URL'] = 'http://127.0.0.1:%d/is_latest/' % (
+            self.server.server_port)
+        os.environ['XDG_CACHE_HOME'] = self.cache
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.cache)
+        for key, value in self.env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    def test_parse_version(self):
+        self.assertEqual((0, 13, 1), parse_version('0.13.1.dev3+g1234'))
+        self.assertLess(parse_version('0.9.11'), parse_version('0.13.0'))
+
+    def test_is_latest_version(self):
+        self.assertEqual((None, False), is_latest_version('0.13.0', 'id'))
+        self.server.latest = '0.13.0'
+        self.assertEqual((None, True), is_latest_version('0.13.0', 'id'))
+        self.assertIn('current_version=0.13.0', self.server.requests[0])
+
+    def test_background_check(self):
+        # nothing cached yet, the check runs in a thread
+        latest, thread = start_version_check('0.13.0', 'id')
+        self.assertTrue(latest)
+        thread.join()
+        self.assertEqual('99.0.0', read_version_cache())
+
+        # the cached result is used, without asking the server again
+        self.assertEqual((False, None), start_version_check('0.13.0', 'id'))
+        self.assertEqual(1, len(self.server.requests))
+
+        # a stale cache is refreshed
+        latest, thread = start_version_check('0.13.0', 'id', ttl=0)
+        thread.join()
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_offline(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        os.environ['PWMAN_UPDATE_URL'] = 'http://127.0.0.1:%d/' % port
+        latest, thread = start_version_check('0.13.0', 'id')
+        thread.join()
+        # the failure is cached, so the next start does not try again
+        self.assertEqual('', read_version_cache())
+        self.assertEqual((True, None), start_version_check('0.13.0', 'id'))
+
+
 if __name__ == '__main__':
 
     try:
@@ -91,7 +91,7 @@ class TestMongoDB(unittest.TestCase):
 
         node = Node(clear_text=True, **kwargs)
         self.db.add_node(node)
-        outnode = self.db.getnodes([1])[0]
+        outnode = list(self.db.getnodes([1]))[0]
         no = outnode[1:5]
         no.append(outnode[5:])
         o = Node.from_encrypted_entries(*no)
@@ -99,8 +99,9 @@ class TestMongoDB(unittest.TestCase):
 
     def test_6_list_nodes(self):
         ret = self.db.listnodes()
-        self.assertEqual(ret, [1])
+        self.assertEqual(list(ret), [1])
         ret = self.db.listnodes(filter_=b"footag")
+        self.assertEqual(list(ret), [1])
 
     def test_6a_list_tags(self):
         ret = self.db.listtags()
@@ -110,8 +111,8 @@ class TestMongoDB(unittest.TestCase):
             self.assertIn(tag, [b'footag', b'bartag'])
 
     def test_6b_get_nodes(self):
-        ret = self.db.getnodes([1])
-        retb = self.db.getnodes([])
+        ret = list(self.db.getnodes([1]))
+        retb = list(self.db.getnodes([]))
         self.assertListEqual(ret, retb)
 
     @unittest.skip("tags are created in situ in mongodb")
@@ -124,7 +125,7 @@ class TestMongoDB(unittest.TestCase):
 
     def test_8_remove_node(self):
         self.db.removenodes([1])
-        n = self.db.listnodes()
+        n = list(self.db.listnodes())
         self.assertEqual(len(n), 0)
 
     @unittest.skip("No schema migration with mongodb")
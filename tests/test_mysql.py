@@ -108,6 +108,17 @@ class TestMySQLDatabase(unittest.TestCase):
                               ["bartag", "footag"])
                              )
 
+    def test_6c_stream_connection(self):
+        self.assertEqual(list(self.db.lazy_list_node_ids()), [1])
+        con = self.db._stream_con
+        self.assertIsNotNone(con)
+        # a stream read while another is open gets its own connection
+        outer = self.db.lazy_list_node_ids()
+        self.assertEqual(next(outer), 1)
+        self.assertEqual(list(self.db.lazy_list_node_ids()), [1])
+        self.assertEqual(list(outer), [])
+        self.assertIs(con, self.db._stream_con)
+
     def test_7_get_or_create_tag(self):
         s = self.db._get_or_create_tag("SECRET")
         s1 = self.db._get_or_create_tag("SECRET")
@@ -129,11 +140,11 @@ class TestMySQLDatabase(unittest.TestCase):
 
         dburi = self.DBURI
         v = self.db.check_db_version(urlparse(dburi))
-        self.assertEqual(v, '0.6')
+        self.assertEqual(v, '0.9')
         self.db._cur.execute("DROP TABLE DBVERSION")
         self.db._con.commit()
         v = self.db.check_db_version(urlparse(dburi))
-        self.assertEqual(v, '0.6')
+        self.assertEqual(v, '0.9')
         self.db._cur.execute("CREATE TABLE DBVERSION("
                              "VERSION TEXT NOT NULL) ")
         self.db._con.commit()
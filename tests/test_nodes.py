@@ -16,8 +16,13 @@
 # ============================================================================
 # Copyright (C) 2014-2017 Oz Nahum Tiram <oz.tiram@gmail.com>
 # ============================================================================
+import os
 import unittest
+from itertools import islice
 from pwman.util.crypto_engine import CryptoEngine
+from pwman.data.convertdb import (RecordConverter, DBMigrator,
+                                  MigrationError, checksum)
+from pwman.data.drivers.sqlite import SQLite
 from pwman.data.nodes import Node
 from .test_crypto_engine import give_key, DummyCallback
 
@@ -61,6 +66,160 @@ class TestNode(unittest.TestCase):
         self.assertEqual(bytearray(getattr(self.node, 'password'), 'utf-8'), new_node['password'])
         self.assertEqual(getattr(self.node, 'tags'), new_node['tags'])
 
+    def test_cache(self):
+        ce = CryptoEngine.get()
+        self.assertEqual('example.com', self.node.url)
+        self.assertEqual('example.com', self.node._cache['url'])
+        self.node.url = b'example.org'
+        self.assertNotIn('url', self.node._cache)
+        self.assertEqual('example.org', self.node.url)
+        ce.forget()
+        self.assertEqual({}, self.node._cache)
+        self.assertEqual('foo', self.node.username)
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, self.node, 'foo', 1)
+
+    def test_many_and_prefetch(self):
+        entries = [{'username': 'u%d' % i, 'password': 'p%d' % i,
+                    'url': 'example.org', 'notes': '', 'tags': ['t%d' % i]}
+                   for i in range(3)]
+        for record in (False, True):
+            nodes = Node.many(entries, record=record)
+            self.assertEqual([n.is_record for n in nodes], [record] * 3)
+            for n in nodes:
+                n.clear_cache()
+            Node.prefetch(nodes)
+            self.assertEqual([n._cache['username'] for n in nodes],
+                             ['u0', 'u1', 'u2'])
+            self.assertEqual([n._cache['tags'] for n in nodes],
+                             [[b't0'], [b't1'], [b't2']])
+            self.assertEqual(nodes[2].password, 'p2')
+
+
+class TestRecordNode(unittest.TestCase):
+
+    def setUp(self):
+        self.node = Node(record=True, username=b'foo', password='s3kr3t',
+                         url='example.com', notes='a "quoted" note',
+                         tags=[b'baz'])
+
+    def test_record_layout(self):
+        self.assertTrue(self.node.is_record)
+        self.assertEqual([b'', b'', b''], list(self.node)[1:4])
+        self.assertFalse(Node(username='foo', password='bar', url='',
+                              notes='', tags=[]).is_record)
+
+    def test_from_encrypted_entries(self):
+        node = Node.from_encrypted_entries(*self.node, mdate="")
+        self.assertEqual('foo', node.username)
+        self.assertEqual('s3kr3t', node.password)
+        self.assertEqual('example.com', node.url)
+        self.assertEqual('a "quoted" note', node.notes)
+        self.assertEqual([b'baz'], node.tags)
+
+    def test_setters(self):
+        self.node.url = b'newexample.com'
+        node = Node.from_encrypted_entries(*self.node, mdate="")
+        self.assertEqual('newexample.com', node.url)
+        self.assertEqual('foo', node.username)
+
+
+class TestRecordConverter(unittest.TestCase):
+
+    def tearDown(self):
+        os.remove('test-records.db')
+
+    def test_convert(self):
+        db = SQLite('test-records.db')
+        db._open()
+        ce = CryptoEngine.get()
+        db.savekey(ce.get_salt_digest())
+        nid = db.add_node(Node(username='alice', password='secret',
+                               url='example.com', notes='', tags=['foo']))
+        RecordConverter(db).run(callback=DummyCallback)
+
+        db = SQLite('test-records.db')
+        db._open()
+        row, tags = db.get_node(nid)
+        node = Node.from_encrypted_entries(*row[1:5], tags)
+        self.assertTrue(node.is_record)
+        self.assertEqual('secret', node.password)
+        self.assertEqual([b'foo'], node.tags)
+        db.close()
+
+
+class TestDBMigrator(unittest.TestCase):
+
+    def setUp(self):
+        db = self.open('test-migrate-from.db')
+        db.savekey(CryptoEngine.get().get_salt_digest())
+        for i in range(5):
+            db.add_node(Node(clear_text=True, username='user%d' % i,
+                             password='secret', url='example.com', notes='',
+                             tags=['foo', 'bar%d' % (i % 2)]))
+        db.close()
+
+    def tearDown(self):
+        for name in ('test-migrate-from.db', 'test-migrate-to.db'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def open(self, name):
+        db = SQLite(name)
+        db._open()
+        return db
+
+    def migrate(self, batch_size=1000):
+        return DBMigrator(SQLite('test-migrate-from.db'),
+                          SQLite('test-migrate-to.db'), batch_size).run()
+
+    def checksums(self):
+        sums = []
+        for name in ('test-migrate-from.db', 'test-migrate-to.db'):
+            db = self.open(name)
+            sums.append(checksum(db.dump_nodes()))
+            db.close()
+        return sums
+
+    def test_migrate(self):
+        self.assertEqual(5, self.migrate(batch_size=2))
+        source, target = self.checksums()
+        self.assertEqual((5, 3), source[:2])
+        self.assertEqual(source, target)
+
+        db = self.open('test-migrate-to.db')
+        self.assertEqual(CryptoEngine.get().get_salt_digest(), db.loadkey())
+        row, tags = db.get_node(5)
+        node = Node.from_encrypted_entries(*row[1:5], tags)
+        self.assertEqual('user4', node.username)
+        db.close()
+
+    def test_resume(self):
+        source, target = (self.open('test-migrate-from.db'),
+                          self.open('test-migrate-to.db'))
+        target.load_nodes(islice(source.dump_nodes(), 2))
+        source.close()
+        target.close()
+        self.assertEqual(3, self.migrate())
+        source, target = self.checksums()
+        self.assertEqual(source, target)
+
+    def test_other_nodes(self):
+        db = self.open('test-migrate-to.db')
+        db.add_node(Node(clear_text=True, username='eve', password='secret',
+                         url='example.com', notes='', tags=['foo']))
+        db.close()
+        with self.assertRaises(MigrationError):
+            self.migrate()
+
+    def test_other_key(self):
+        db = self.open('test-migrate-to.db')
+        db.savekey('SECRET$6$KEY')
+        db.close()
+        with self.assertRaises(MigrationError):
+            self.migrate()
+
 
 if __name__ == '__main__':
     import os
@@ -18,11 +18,15 @@
 # ============================================================================
 import os
 import unittest
+from itertools import islice
 from .test_crypto_engine import give_key, DummyCallback
 from urllib.parse import urlparse
 
 import psycopg2 as pg
+from pwman.data.convertdb import DBMigrator, checksum
 from pwman.data.drivers.postgresql import PostgresqlDatabase
+from pwman.data.drivers.sqlite import SQLite
+from pwman.data.nodes import Node
 from pwman.util.crypto_engine import CryptoEngine
 ##
 # testing on linux host
@@ -68,12 +72,12 @@ class TestPostGresql(unittest.TestCase):
     def test_3_load_key(self):
         self.db.savekey('SECRET$6$KEY')
         secretkey = self.db.loadkey()
-        self.assertEqual(secretkey, b'SECRET$6$KEY')
+        self.assertEqual(secretkey, 'SECRET$6$KEY')
 
     def test_4_save_crypto(self):
         self.db.save_crypto_info(b"TOP", b"SECRET")
         secretkey = self.db.loadkey()
-        self.assertEqual(secretkey, b'TOP$6$SECRET')
+        self.assertEqual(secretkey, 'TOP$6$SECRET')
         row = self.db.fetch_crypto_info()
         self.assertEqual(list(map(bytearray, row)),
                          [bytearray(b'TOP'), bytearray(b'SECRET')])
@@ -82,8 +86,9 @@ class TestPostGresql(unittest.TestCase):
         innode = [b"TBONE", b"S3K43T", b"example.org", b"some note",
                   [b"footag", b"bartag"]]
         self.db.add_node(innode)
-        outnode = self.db.getnodes([1])[0]
-        self.assertEqual(innode[:-1] + [t for t in innode[-1]], outnode[1:])
+        node, tags = list(self.db.getnodes([1]))[0]
+        self.assertEqual(innode[:-1] + [t for t in innode[-1]],
+                         node[1:] + tags)
 
     def test_6_list_nodes(self):
         ret1 = self.db.lazy_list_node_ids()
@@ -96,9 +101,11 @@ class TestPostGresql(unittest.TestCase):
         self.assertListEqual(ret, [b'footag', b'bartag'])
 
     def test_6b_get_nodes(self):
-        ret = self.db.getnodes([1])
-        retb = self.db.getnodes([])
-        self.assertListEqual(ret, retb)
+        ret = list(self.db.getnodes([1]))
+        self.assertTupleEqual(ret[0], ([1, b"TBONE", b"S3K43T",
+                                        b"example.org", b"some note"],
+                                       [b"footag", b"bartag"]))
+        self.assertListEqual(list(self.db.getnodes([])), [])
 
     def test_7_get_or_create_tag(self):
         s = self.db._get_or_create_tag(b"SECRET")
@@ -121,17 +128,85 @@ class TestPostGresql(unittest.TestCase):
 
         dburi = DBURI
         v = self.db.check_db_version(dburi)
-        self.assertEqual(str(v), '0.6')
+        self.assertEqual(str(v), '0.9')
         self.db._cur.execute("DROP TABLE DBVERSION")
         self.db._con.commit()
         v = self.db.check_db_version(dburi)
-        self.assertEqual(str(v), '0.6')
+        self.assertEqual(str(v), '0.9')
         self.db._cur.execute("CREATE TABLE DBVERSION("
                              "VERSION TEXT NOT NULL DEFAULT {}"
-                             ")".format('0.6'))
+                             ")".format('0.9'))
         self.db._con.commit()
 
 
+class TestPostgresqlMigrator(unittest.TestCase):
+    """migrate between SQLite and PostgreSQL, which keeps the key as bytea"""
+
+    def setUp(self):
+        self.drop_tables()
+        db = SQLite('test-migrate-pg.db')
+        db._open()
+        db.savekey(CryptoEngine.get().get_salt_digest())
+        for i in range(5):
+            db.add_node(Node(clear_text=True, username='user%d' % i,
+                             password='secret', url='example.com', notes='',
+                             tags=['foo', 'bar%d' % (i % 2)]))
+        db.close()
+
+    def tearDown(self):
+        self.drop_tables()
+        for name in ('test-migrate-pg.db', 'test-migrate-back.db'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def drop_tables(self):
+        con = pg.connect(DBURI)
+        cur = con.cursor()
+        for table in ('LOOKUP', 'TAG', 'NODE', 'DBVERSION', 'CRYPTO',
+                      'SEARCHINDEX'):
+            cur.execute("DROP TABLE IF EXISTS {}".format(table))
+        con.commit()
+        con.close()
+
+    def pg(self):
+        return PostgresqlDatabase(urlparse(DBURI))
+
+    def sums(self, db):
+        db._open()
+        try:
+            return checksum(db.dump_nodes())
+        finally:
+            db.close()
+
+    def test_to_postgresql_and_back(self):
+        self.assertEqual(5, DBMigrator(SQLite('test-migrate-pg.db'),
+                                       self.pg(), 2).run())
+        self.assertEqual(5, DBMigrator(self.pg(),
+                                       SQLite('test-migrate-back.db')).run())
+        source = self.sums(SQLite('test-migrate-pg.db'))
+        self.assertEqual(source, self.sums(self.pg()))
+        self.assertEqual(source, self.sums(SQLite('test-migrate-back.db')))
+
+        db = SQLite('test-migrate-back.db')
+        db._open()
+        self.assertEqual(CryptoEngine.get().get_salt_digest(), db.loadkey())
+        db.close()
+
+    def test_resume(self):
+        source, target = SQLite('test-migrate-pg.db'), self.pg()
+        source._open()
+        target._open()
+        target.savekey(source.loadkey())
+        target.load_nodes(islice(source.dump_nodes(), 2))
+        source.close()
+        target.close()
+        # the target already has the key of the source
+        self.assertEqual(3, DBMigrator(SQLite('test-migrate-pg.db'),
+                                       self.pg()).run())
+        self.assertEqual(self.sums(SQLite('test-migrate-pg.db')),
+                         self.sums(self.pg()))
+
+
 if __name__ == '__main__':
 
     ce = CryptoEngine.get()
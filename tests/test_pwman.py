@@ -23,12 +23,21 @@ import sys
 import unittest
 from .test_crypto_engine import CryptoEngineTest, TestPassGenerator
 from .test_config import TestConfig
-from .test_sqlite import TestSQLite
+from .test_sqlite import (TestSQLite, TestSQLiteMigration, TestSQLiteOpenOld,
+                          TestSQLiteTransaction, TestSQLiteTagCache,
+                          TestSQLiteRekey)
 from .test_importer import TestImporter
-from .test_factory import TestFactory
+from .test_exporter import TestExporter
+from .test_backup import TestBackup
+from .test_factory import TestFactory, TestDriverRegistry
 from .test_base_ui import TestBaseUI
-from .test_init import TestInit
-from .test_nodes import TestNode
+from .test_init import TestInit, TestVersionCheck
+from .test_nodes import (TestNode, TestRecordNode, TestRecordConverter,
+                         TestDBMigrator)
+from .test_agent import TestAgent
+from .test_startup import TestStartup
+from .test_search import TestSearchIndex, TestSQLiteSearch
+from .test_tagfilter import TestTagFilter, TestSQLiteTagFilter
 
 
 if 'win' not in sys.platform:
@@ -49,12 +58,30 @@ def suite():
     suite.addTest(loader.loadTestsFromTestCase(TestPassGenerator))
     suite.addTest(loader.loadTestsFromTestCase(TestConfig))
     suite.addTest(loader.loadTestsFromTestCase(TestSQLite))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteMigration))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteOpenOld))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteTransaction))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteTagCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteRekey))
+    suite.addTest(loader.loadTestsFromTestCase(TestSearchIndex))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteSearch))
+    suite.addTest(loader.loadTestsFromTestCase(TestTagFilter))
+    suite.addTest(loader.loadTestsFromTestCase(TestSQLiteTagFilter))
     suite.addTest(loader.loadTestsFromTestCase(TestImporter))
+    suite.addTest(loader.loadTestsFromTestCase(TestExporter))
+    suite.addTest(loader.loadTestsFromTestCase(TestBackup))
     suite.addTest(loader.loadTestsFromTestCase(TestFactory))
+    suite.addTest(loader.loadTestsFromTestCase(TestDriverRegistry))
     suite.addTest(loader.loadTestsFromTestCase(TestBaseUI))
     suite.addTest(loader.loadTestsFromTestCase(TestInit))
+    suite.addTest(loader.loadTestsFromTestCase(TestVersionCheck))
     suite.addTest(loader.loadTestsFromTestCase(TestNode))
+    suite.addTest(loader.loadTestsFromTestCase(TestRecordNode))
+    suite.addTest(loader.loadTestsFromTestCase(TestRecordConverter))
+    suite.addTest(loader.loadTestsFromTestCase(TestDBMigrator))
+    suite.addTest(loader.loadTestsFromTestCase(TestStartup))
     if 'win' not in sys.platform:
+        suite.addTest(loader.loadTestsFromTestCase(TestAgent))
         suite.addTest(loader.loadTestsFromTestCase(Ferrum))
     return suite
 
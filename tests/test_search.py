@@ -0,0 +1,146 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import os
+import unittest
+from unittest import mock
+
+from pwman.data.drivers.sqlite import SQLite
+from pwman.data.nodes import Node
+from pwman.data.search import SearchIndex, tokenize
+from pwman.util.crypto_engine import CryptoEngine
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add(1, 'alice', 'https://mail.example.com', 'work mail')
+        self.index.add(2, 'bob', 'shop.example.org', 'Groceries')
+
+    def test_tokenize(self):
+        self.assertEqual({'mail', 'example', 'com'},
+                         tokenize('mail.Example.com', None, ''))
+
+    def test_search(self):
+        self.assertEqual([1, 2], self.index.search('exam'))
+        self.assertEqual([1], self.index.search('exam ma'))
+        self.assertEqual([2], self.index.search('GROC'))
+        self.assertEqual([], self.index.search('nothing'))
+        self.assertEqual([], self.index.search(''))
+
+    def test_match_url(self):
+        self.assertEqual([1], self.index.match_url('mail.ex'))
+        self.assertEqual([1, 2], self.index.match_url('example'))
+
+    def test_add_and_remove(self):
+        self.index.add(1, 'alice', 'bank.com', '')
+        self.assertEqual([2], self.index.search('example'))
+        self.index.remove(2)
+        self.index.remove(3)
+        self.assertEqual([], self.index.search('example'))
+        self.assertEqual([1], self.index.search('alice'))
+        self.assertNotIn(2, self.index)
+
+    def test_dumps(self):
+        index = SearchIndex.loads(self.index.dumps())
+        self.assertEqual(2, len(index))
+        self.assertEqual([1], index.search('work'))
+        self.assertEqual([2], index.match_url('shop'))
+
+
+class TestSQLiteSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLite('test-search.db')
+        self.db._open()
+        self.add('alice', 'mail.example.com')
+
+    def tearDown(self):
+        self.db.close()
+        os.remove('test-search.db')
+
+    def add(self, username, url):
+        return self.db.add_node(Node(clear_text=True, username=username,
+                                     password='secret', url=url,
+                                     notes='', tags=['foo']))
+
+    def stored(self):
+        data = self.db._load_search_blob()
+        if data:
+            return SearchIndex.loads(CryptoEngine.get().decrypt(data))
+
+    def test_build_and_update(self):
+        self.assertIsNone(self.stored())
+        self.assertEqual([1], self.db.search_index().search('alice'))
+        self.assertEqual([1], self.stored().search('alice'))
+
+        nid = self.add('bob', 'shop.example.org')
+        self.assertEqual([1, nid], self.db.search_index().search('example'))
+        enc = CryptoEngine.get()
+        self.db.editnode(nid, username=enc.encrypt("carol"))
+        self.assertEqual([nid], self.stored().search('carol'))
+        self.db.removenodes([1])
+        self.assertEqual([nid], self.stored().search('example'))
+
+    def test_store_once_per_transaction(self):
+        self.db.search_index()
+        with mock.patch.object(self.db, '_store_search_blob',
+                               wraps=self.db._store_search_blob) as store:
+            with self.db.transaction():
+                nid = self.add('bob', 'shop.example.org')
+                self.db.editnode(
+                    nid, url=CryptoEngine.get().encrypt('shop.example.net'))
+                self.add('carol', 'example.com')
+            self.assertEqual(1, store.call_count)
+        self.assertEqual([nid], self.stored().search('net'))
+        self.assertEqual([nid + 1], self.stored().search('carol'))
+
+    def test_update_index_not_loaded(self):
+        self.db.search_index()
+        # a new session, which did not search yet
+        self.db.close()
+        self.db = SQLite('test-search.db')
+        self.db._open()
+        nid = self.add('bob', 'shop.example.org')
+        self.assertEqual([nid], self.stored().search('bob'))
+        self.assertEqual([1], self.stored().search('alice'))
+
+    def test_no_index_stored(self):
+        self.add('bob', 'shop.example.org')
+        self.assertIsNone(self.stored())
+        self.assertEqual([2], self.db.search_index().search('bob'))
+
+    def test_load_nodes(self):
+        self.db.search_index()
+        entries = list(self.db.dump_nodes())
+        self.db._search = None
+        self.db.load_nodes(entries)
+        self.assertEqual([1, 2], self.stored().search('alice'))
+
+    def test_rollback(self):
+        self.db.search_index()
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.add('bob', 'shop.example.org')
+                raise ValueError
+        self.assertEqual([], self.db.search_index().search('bob'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -16,11 +16,14 @@
 # ============================================================================
 # Copyright (C) 2012-2017 Oz Nahum Tiram <nahumoz@gmail.com>
 # ============================================================================
+import binascii
 import os
+import sqlite3
 import unittest
+from pwman.data.database import DatabaseException
 from pwman.data.drivers.sqlite import SQLite
 from pwman.data.nodes import Node
-from pwman.util.crypto_engine import CryptoEngine
+from pwman.util.crypto_engine import CryptoEngine, get_digest, is_wrapped
 from .test_crypto_engine import give_key, DummyCallback
 
 
@@ -81,6 +84,13 @@ class TestSQLite(unittest.TestCase):
         self.assertEqual(3, rv)
         self.db._con.commit()
 
+    def test_4a_test_tag_blind_index(self):
+        ce = CryptoEngine.get()
+        self.db._cur.execute("SELECT BLINDIDX FROM TAG WHERE ID = 1")
+        self.assertEqual(self.db._cur.fetchone()[0], ce.blind_index(b'foo'))
+        self.assertEqual(1, self.db._get_tag(ce.encrypt(b'foo')))
+        self.assertIsNone(self.db._get_tag(ce.encrypt(b'nosuchtag')))
+
     def test_5_test_lookup(self):
         self.db._cur.execute('SELECT nodeid, tagid FROM LOOKUP')
         rows = self.db._cur.fetchall()
@@ -96,6 +106,25 @@ class TestSQLite(unittest.TestCase):
         ids = self.db.lazy_list_node_ids()
         self.assertEqual(2, len(list(ids)))
 
+    def test_6a_add_nodes(self):
+        nodes = [Node(clear_text=True,
+                      **{'username': "user%d" % i, 'password': "secret",
+                         'url': "example.com", 'notes': "",
+                         'tags': ['bulk', 'bulk', 'bulk%d' % (i % 2)]})
+                 for i in range(5)]
+        nids = self.db.add_nodes(nodes, batch_size=2)
+        self.assertEqual(5, len(set(nids)))
+        ce = CryptoEngine.get()
+        node, tags = self.db.get_node(nids[3])
+        self.assertEqual(b"user3", ce.decrypt(node[1]))
+        self.assertEqual([b"bulk", b"bulk1"], [ce.decrypt(t) for t in tags])
+        self.assertEqual(5, len(list(self.db.lazy_list_node_ids(
+            filter=ce.encrypt(b"bulk")))))
+        self.db._cur.execute("SELECT COUNT(*) FROM TAG")
+        self.assertEqual(6, self.db._cur.fetchone()[0])
+        for nid in nids:
+            self.db.removenodes([nid])
+
     def test_7_listnodes_w_filter(self):
         ce = CryptoEngine.get()
         # the tag 'bar' is found in a node created in:
@@ -115,6 +144,41 @@ class TestSQLite(unittest.TestCase):
         nodes = self.db.getnodes([1, 2])
         self.assertEqual(len(list(nodes)), 2)
 
+    def test_8a_getnodes_in_batches(self):
+        self.db.fetch_size = 1
+        ce = CryptoEngine.get()
+        nodes = list(self.db.getnodes([2, 1, 99]))
+        self.assertEqual([2, 1], [node[0] for node, tags in nodes])
+        node, tags = nodes[0]
+        self.assertEqual(b"hatman", ce.decrypt(node[1]))
+        self.assertEqual([b"bar", b"baz"], [ce.decrypt(t) for t in tags])
+        self.assertEqual(([], []), self.db.get_node(99))
+
+    def test_8b_stream_node_ids(self):
+        self.db.stream_size = 1
+        self.db.fetch_size = 1
+        ids = self.db.lazy_list_node_ids()
+        self.assertEqual(1, next(ids))
+        # _cur is free while the ids are read
+        self.assertEqual([2], [node[0] for node, tags in
+                               self.db.getnodes([2])])
+        self.assertEqual([2], list(ids))
+        ce = CryptoEngine.get()
+        self.assertEqual([], list(self.db.lazy_list_node_ids(
+            filter=ce.encrypt(b"no such tag"))))
+
+    def test_8c_list_node_ids_page(self):
+        self.assertEqual([1], self.db.list_node_ids_page(1))
+        self.assertEqual([2], self.db.list_node_ids_page(5, after=1))
+        self.assertEqual([], self.db.list_node_ids_page(5, after=2))
+        self.assertEqual([1, 2], self.db.list_node_ids_page(5, before=3))
+        self.assertEqual([2], self.db.list_node_ids_page(1, before=3))
+        ce = CryptoEngine.get()
+        self.assertEqual([2], self.db.list_node_ids_page(
+            5, after=1, filter=ce.encrypt(b'bar')))
+        self.assertEqual([2], self.db.list_node_ids_page(
+            5, filter=ce.encrypt(b'baz')))
+
     def test_9_editnode(self):
         # delibertly insert clear text into the database
         ce = CryptoEngine.get()
@@ -160,6 +224,319 @@ class TestSQLite(unittest.TestCase):
         self.assertEqual(ce.get_salt_digest(), self.db.loadkey())
 
 
+class TestSQLiteMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLite('test-migrate.db')
+        self.db._open()
+        # rebuild TAG, LOOKUP and DBVERSION the way format 0.6 created them
+        self.db._cur.execute("DROP TABLE TAG")
+        self.db._cur.execute("CREATE TABLE TAG"
+                             "(ID INTEGER PRIMARY KEY AUTOINCREMENT,"
+                             "DATA TEXT NOT NULL)")
+        self.db._cur.execute("DROP INDEX LOOKUP_NODE_TAG")
+        self.db._cur.execute("DROP INDEX LOOKUP_TAG")
+        self.db._cur.execute("DROP TABLE CRYPTO")
+        self.db._cur.execute("CREATE TABLE CRYPTO (SEED TEXT, DIGEST TEXT)")
+        self.db._cur.execute("INSERT INTO CRYPTO VALUES('salt', 'digest')")
+        self.db._cur.execute("UPDATE DBVERSION SET VERSION = '0.6'")
+        ce = CryptoEngine.get()
+        for tag in (b'foo', b'bar'):
+            self.db._cur.execute("INSERT INTO TAG(DATA) VALUES(?)",
+                                 (ce.encrypt(tag),))
+        self.db._cur.executemany("INSERT INTO LOOKUP VALUES(?, ?)",
+                                 [(1, 1), (1, 2), (1, 2)])
+        self.db._con.commit()
+
+    def tearDown(self):
+        self.db._cur.close()
+        self.db._con.close()
+        os.remove('test-migrate.db')
+
+    def test_migrate(self):
+        self.db._migrate()
+        self.assertEqual(self.db._get_dbversion(), 0.9)
+        ce = CryptoEngine.get()
+        self.assertEqual(2, self.db._get_tag(ce.encrypt(b'bar')))
+        self.db._cur.execute("SELECT nodeid, tagid FROM LOOKUP")
+        self.assertEqual([(1, 1), (1, 2)], sorted(self.db._cur.fetchall()))
+        self.assertRaises(sqlite3.IntegrityError, self.db._insert_lookup,
+                          [(1, 2)])
+        # a key saved before the KDF column existed uses the legacy KDF
+        self.assertEqual('salt$6$digest', self.db.loadkey())
+        # migrating a second time is a no-op
+        self.db._migrate()
+
+
+class TestSQLiteOpenOld(unittest.TestCase):
+
+    """open a vault the way format 0.6 wrote it, through Database.open"""
+
+    def setUp(self):
+        self.ce = CryptoEngine.get()
+        legacy = CryptoEngine()
+        legacy.callback = DummyCallback()
+        legacy.set_salt_digest(b'salt$6$' + binascii.hexlify(
+            get_digest(b'12345', b'salt')))
+        CryptoEngine._instance = legacy
+
+        db = SQLite('test-open-old.db')
+        db._open()
+        node = Node(clear_text=True, username='alice', password='secret',
+                    url='example.com', notes='', tags=[])
+        db._cur.execute("INSERT INTO NODE(USERNAME, PASSWORD, URL, NOTES) "
+                        "VALUES(?, ?, ?, ?)", (node._username,
+                                               node._password, node._url,
+                                               node._notes))
+        db._cur.execute("DROP TABLE TAG")
+        db._cur.execute("CREATE TABLE TAG (ID INTEGER PRIMARY KEY "
+                        "AUTOINCREMENT, DATA TEXT NOT NULL)")
+        db._cur.execute("INSERT INTO TAG(DATA) VALUES(?)",
+                        (legacy.encrypt(b'foo'),))
+        db._cur.execute("DROP INDEX LOOKUP_NODE_TAG")
+        db._cur.execute("DROP INDEX LOOKUP_TAG")
+        db._cur.execute("INSERT INTO LOOKUP VALUES(1, 1)")
+        db._cur.execute("DROP TABLE CRYPTO")
+        db._cur.execute("CREATE TABLE CRYPTO (SEED TEXT, DIGEST TEXT)")
+        seed, digest = legacy.get_salt_digest().split('$6$')
+        db._cur.execute("INSERT INTO CRYPTO VALUES(?, ?)", (seed, digest))
+        db._cur.execute("DROP TABLE SEARCHINDEX")
+        db._cur.execute("UPDATE DBVERSION SET VERSION = '0.6'")
+        db._con.commit()
+        db._cur.close()
+        db._con.close()
+        self.db = SQLite('test-open-old.db')
+
+    def tearDown(self):
+        CryptoEngine._instance = self.ce
+        self.db.close()
+        os.remove('test-open-old.db')
+
+    def test_open(self):
+        self.db.open()
+        self.assertEqual(0.9, self.db._get_dbversion())
+        row, tags = self.db.get_node(1)
+        node = Node.from_encrypted_entries(*row[1:5], tags)
+        self.assertEqual('alice', node.username)
+        self.assertEqual([b'foo'], node.tags)
+        self.assertEqual([1], list(self.db.lazy_list_node_ids(
+            filter=b'foo')))
+
+    def test_open_migrated(self):
+        # backup and restore copy the cipher texts, the key stays as it is
+        key = self.db._open_migrated()
+        self.assertEqual(CryptoEngine.get().get_salt_digest(), key)
+        self.assertEqual(0.9, self.db._get_dbversion())
+        self.assertEqual(key, self.db.loadkey())
+        self.assertEqual(1, len(list(self.db.dump_nodes())))
+
+    def test_upgrade_key(self):
+        self.db.open()
+        self.db._cur.execute("SELECT DIGEST FROM CRYPTO")
+        self.assertTrue(is_wrapped(self.db._cur.fetchone()[0].encode()))
+
+        ce = CryptoEngine()
+        ce.set_salt_digest(self.db.loadkey())
+        self.assertTrue(ce.authenticate(b'12345'))
+        CryptoEngine._instance = ce
+        row, tags = self.db.get_node(1)
+        node = Node.from_encrypted_entries(*row[1:5], tags)
+        self.assertEqual('secret', node.password)
+        self.assertEqual([b'foo'], node.tags)
+
+
+class TestSQLiteTransaction(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLite('test-transaction.db')
+        self.db._open()
+        self.other = sqlite3.connect('test-transaction.db')
+
+    def tearDown(self):
+        self.other.close()
+        self.db.close()
+        os.remove('test-transaction.db')
+
+    def count(self):
+        return self.other.execute("SELECT COUNT(*) FROM NODE").fetchone()[0]
+
+    def add(self, username):
+        self.db.add_node(Node(clear_text=True, username=username,
+                              password='pass', url='url', notes='notes'))
+
+    def test_commit_at_outermost_scope(self):
+        with self.db.transaction():
+            self.add('foo')
+            with self.db.transaction():
+                self.add('bar')
+            self.assertEqual(0, self.count())
+        self.assertEqual(2, self.count())
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.add('foo')
+                raise ValueError
+        self.assertEqual(0, self.count())
+        self.assertEqual([], list(self.db.lazy_list_node_ids()))
+
+    def test_rollback_on_failed_inner_scope(self):
+        with self.assertRaises(DatabaseException):
+            with self.db.transaction():
+                self.add('foo')
+                try:
+                    with self.db.transaction():
+                        raise ValueError
+                except ValueError:
+                    pass
+        self.assertEqual([], list(self.db.lazy_list_node_ids()))
+        # the next unit of work is not affected
+        self.add('bar')
+        self.assertEqual(1, self.count())
+
+
+class TestSQLiteTagCache(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLite('test-tagcache.db')
+        self.db._open()
+        self.add(['foo', 'bar'])
+
+    def tearDown(self):
+        self.db.close()
+        os.remove('test-tagcache.db')
+
+    def add(self, tags):
+        return self.db.add_node(Node(clear_text=True, username='user',
+                                     password='secret', url='url',
+                                     notes='', tags=tags))
+
+    def test_cache(self):
+        self.assertEqual(['bar', 'foo'], self.db.tag_names())
+        tags = self.db._tags
+        nid = self.add(['baz', 'foo'])
+        self.assertIs(tags, self.db._tags)
+        self.assertEqual(['bar', 'baz', 'foo'], self.db.tag_names())
+        ce = CryptoEngine.get()
+        self.assertEqual(self.db._get_tag(ce.encrypt(b'baz')),
+                         self.db._tag_ids[ce.blind_index(b'baz')])
+
+        self.db.removenodes([nid])
+        self.assertEqual(['bar', 'foo'], self.db.tag_names())
+        self.db._clean_orphans()
+        self.assertEqual([b'bar', b'foo'], sorted(self.db._tags.values()))
+        self.assertEqual(2, len(self.db._tag_ids))
+
+    def test_rollback(self):
+        self.db.tag_names()
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.add(['baz'])
+                raise ValueError
+        self.assertIsNone(self.db._tags)
+        self.assertEqual(['bar', 'foo'], self.db.tag_names())
+
+    def test_dirty_tags(self):
+        nid = self.add(['baz', 'foo'])
+        self.db._cur.execute("INSERT INTO TAG(DATA, BLINDIDX) "
+                             "VALUES('orphan', 'orphan')")
+        self.db.removenodes([nid])
+        self.assertEqual(2, len(self.db._dirty_tags))
+        # only baz and foo are checked, foo is still in use
+        self.assertEqual(1, self.db._clean_orphans(self.db._dirty_tags))
+        self.assertEqual(['bar', 'foo'], self.db.tag_names())
+        self.assertEqual(1, self.db.vacuum())
+        self.assertEqual(frozenset(), self.db._dirty_tags)
+        self.db._cur.execute("SELECT COUNT(*) FROM TAG")
+        self.assertEqual(2, self.db._cur.fetchone()[0])
+
+    def test_forget(self):
+        self.db.tag_names()
+        CryptoEngine.get()._clear_caches()
+        self.assertIsNone(self.db._tags)
+
+
+class TestSQLiteRekey(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLite('test-rekey.db')
+        self.db._open()
+        self.ce = CryptoEngine.get()
+        self.db.savekey(self.ce.get_salt_digest())
+        for i in range(5):
+            self.db.add_node(Node(clear_text=True, username='user%d' % i,
+                                  password='secret', url='example.com',
+                                  notes='', tags=['foo', 'bar%d' % i]))
+        self.db.search_index()
+        self.db.fetch_size = 2
+
+    def tearDown(self):
+        CryptoEngine._instance = self.ce
+        self.db.close()
+        os.remove('test-rekey.db')
+
+    def use_key(self, recrypter):
+        """make an engine with the new key the current one"""
+        ce = CryptoEngine()
+        ce.set_salt_digest(recrypter.key)
+        ce._unlock(recrypter.password_key)
+        CryptoEngine._instance = ce
+
+    def test_reencrypt(self):
+        recrypter = self.ce.rekey()
+        done = []
+        self.assertEqual(5, self.db.reencrypt(recrypter, done.append))
+        self.assertEqual([2, 4, 5], done)
+        self.assertEqual(recrypter.key, self.db.loadkey())
+
+        self.use_key(recrypter)
+        row, tags = self.db.get_node(3)
+        node = Node.from_encrypted_entries(*row[1:5], tags)
+        self.assertEqual('user2', node.username)
+        self.assertEqual([b'bar2', b'foo'], sorted(node.tags))
+        self.assertEqual(['bar0', 'bar1', 'bar2', 'bar3', 'bar4', 'foo'],
+                         self.db.tag_names())
+        self.assertEqual([1, 2, 3, 4, 5],
+                         list(self.db.lazy_list_node_ids(filter=b'foo')))
+        self.assertEqual([4], self.db.search_index().search('user3'))
+
+    def test_upgrade(self):
+        ce = CryptoEngine()
+        ce.callback = DummyCallback()
+        ce.set_salt_digest(b'salt$6$' + binascii.hexlify(
+            get_digest(b'12345', b'salt')))
+        CryptoEngine._instance = ce
+        self.db.savekey(ce.get_salt_digest())
+        self.db._cur.execute("DELETE FROM NODE")
+        self.db._cur.execute("DELETE FROM SEARCHINDEX")
+        self.db.add_node(Node(clear_text=True, username='alice',
+                              password='secret', url='example.com',
+                              notes='', tags=['foo']))
+
+        self.db.open()
+        self.assertTrue(is_wrapped(ce._digest))
+        self.assertEqual(ce.get_salt_digest(), self.db.loadkey())
+        ce = CryptoEngine()
+        ce.set_salt_digest(self.db.loadkey())
+        self.assertTrue(ce.authenticate(b'12345'))
+        CryptoEngine._instance = ce
+        row, tags = self.db.get_node(6)
+        self.assertEqual('alice', Node.from_encrypted_entries(
+            *row[1:5], tags).username)
+
+    def test_rollback(self):
+        old = self.db.loadkey()
+        row = self.db.get_node(1)
+
+        def fail(count):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.db.reencrypt(self.ce.rekey(), fail)
+        self.assertEqual(old, self.db.loadkey())
+        self.assertEqual(row, self.db.get_node(1))
+
+
 if __name__ == '__main__':
 
     ce = CryptoEngine.get()
@@ -0,0 +1,88 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+Guard the cold start of ``pwman3 p <id>`` against SQLite. The start up
+runs in a fresh interpreter, which reports the modules it imported and
+how long it took. The time is only checked if PWMAN_STARTUP_BUDGET is
+set to the allowed time in seconds, as it depends on the machine.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+STARTUP = """
+import json, sys, time
+before = set(sys.modules)
+started = time.perf_counter()
+from pwman.ui import cli
+args = cli.parser_options().parse_args(
+    ['-c', sys.argv[1], '-d', 'sqlite://' + sys.argv[2], 'p', '1'])
+PwmanCli, OSX = cli.get_ui_platform(sys.platform)
+xselpath, dburi, config = cli.get_conf_options(args, OSX)
+db = cli.factory.createdb(dburi)
+db._open()
+elapsed = time.perf_counter() - started
+print(json.dumps({'elapsed': elapsed,
+                  'modules': sorted(set(sys.modules) - before)}))
+"""
+
+# modules which are only needed by other commands or databases
+LAZY = ('psycopg2', 'pymysql', 'pymongo', 'urllib.request', 'ssl',
+        'importlib.metadata', 'colorama', 'concurrent.futures',
+        'pwman.exchange.importer', 'pwman.exchange.exporter',
+        'pwman.exchange.backup', 'pwman.data.convertdb',
+        'pwman.data.drivers.postgresql', 'pwman.data.drivers.mysql',
+        'pwman.data.drivers.mongodb')
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def start(self):
+        out = subprocess.check_output(
+            [sys.executable, '-c', STARTUP,
+             os.path.join(self.tmpdir, 'config'),
+             os.path.join(self.tmpdir, 'pwman.db')],
+            stderr=subprocess.DEVNULL)
+        return json.loads(out.decode().splitlines()[-1])
+
+    def test_lazy_imports(self):
+        modules = self.start()['modules']
+        self.assertIn('pwman.data.drivers.sqlite', modules)
+        for module in LAZY:
+            self.assertNotIn(module, modules)
+
+    @unittest.skipUnless(os.getenv('PWMAN_STARTUP_BUDGET'),
+                         "set PWMAN_STARTUP_BUDGET to check the time")
+    def test_startup_time(self):
+        budget = float(os.getenv('PWMAN_STARTUP_BUDGET'))
+        self.assertLess(self.start()['elapsed'], budget)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
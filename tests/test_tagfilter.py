@@ -0,0 +1,84 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2024 Oz N Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import os
+import unittest
+
+from pwman.data.drivers.sqlite import SQLite
+from pwman.data.nodes import Node
+from pwman.data.tagfilter import parse, tags, TagFilterError
+
+
+class TestTagFilter(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(('tag', b'prod'), parse('prod'))
+        self.assertEqual(('and', ('tag', b'prod'), ('tag', b'db'),
+                          ('not', ('tag', b'legacy'))),
+                         parse('prod AND db AND NOT legacy'))
+        self.assertEqual(parse('prod AND db'), parse('prod db'))
+        self.assertEqual(('or', ('and', ('tag', b'a'), ('tag', b'b')),
+                          ('tag', b'c')), parse('a b OR c'))
+        self.assertEqual(('and', ('tag', b'a'),
+                          ('or', ('tag', b'b'), ('tag', b'c'))),
+                         parse('a (b OR c)'))
+        self.assertEqual(('tag', b'and'), parse('and'))
+
+    def test_errors(self):
+        for text in ('', 'AND', 'a OR', '(a', 'a)', 'NOT', 'a AND OR b'):
+            self.assertRaises(TagFilterError, parse, text)
+
+    def test_tags(self):
+        self.assertEqual([b'a', b'b', b'c'],
+                         list(tags(parse('a AND NOT (b OR c)'))))
+
+
+class TestSQLiteTagFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLite('test-tagfilter.db')
+        self.db._open()
+        for node_tags in (['prod', 'db'], ['prod', 'db', 'legacy'],
+                          ['prod', 'web'], ['dev', 'db']):
+            self.db.add_node(Node(clear_text=True, username='user',
+                                  password='secret', url='url', notes='',
+                                  tags=node_tags))
+
+    def tearDown(self):
+        self.db.close()
+        os.remove('test-tagfilter.db')
+
+    def ids(self, text):
+        return list(self.db.lazy_list_node_ids(filter=parse(text)))
+
+    def test_filters(self):
+        self.assertEqual([1], self.ids('prod AND db AND NOT legacy'))
+        self.assertEqual([1, 2, 4], self.ids('db'))
+        self.assertEqual([3, 4], self.ids('web OR dev'))
+        self.assertEqual([1, 3], self.ids('prod (db OR web) NOT legacy'))
+        self.assertEqual([3], self.ids('NOT db'))
+        self.assertEqual([], self.ids('nosuchtag'))
+        self.assertEqual([1, 2, 3, 4], self.ids('NOT nosuchtag'))
+
+    def test_page(self):
+        self.assertEqual([2, 4], self.db.list_node_ids_page(
+            5, after=1, filter=parse('db')))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)